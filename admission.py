@@ -0,0 +1,320 @@
+"""
+Admission control for Staky AI
+
+A burst of uploads would otherwise start an unlimited number of Whisper
+and llama3 requests at once, and Groq then rate-limits every user
+together. Uploads are admitted in front of the Groq calls in two steps:
+
+1. Per-user token buckets: each user (or client address in local-only
+   mode) may start a number of uploads per hour with a small burst.
+   Limits depend on the user's tier; admins have their own budget.
+2. Concurrency lanes: at most max_concurrent uploads of a lane call
+   Groq at the same time, and at most max_waiting more may wait for a
+   slot. Admins use their own lane so a queue of user uploads never
+   blocks them. Uploads on the /async routes use the async lane, whose
+   waiters are coroutines rather than threads, so it can be much wider.
+
+When a bucket is empty or the wait queue is full the upload is refused at
+once with an estimate of how long to wait (HTTP 429 with Retry-After),
+instead of being left to time out.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+# Default limits per tier: (uploads per hour, burst)
+DEFAULT_TIER_LIMITS = {
+    'anonymous': (10, 3),
+    'free': (10, 3),
+    'pro': (60, 10),
+    'admin': (600, 30),
+}
+
+admission_rejected = REGISTRY.counter('staky_admission_rejected_total',
+                                      'Uploads refused by admission control', ['reason', 'tier'])
+admission_running = REGISTRY.gauge('staky_admission_running',
+                                   'Uploads currently calling Groq, by lane', ['lane'])
+admission_waiting = REGISTRY.gauge('staky_admission_waiting',
+                                   'Admitted uploads waiting for a Groq slot, by lane', ['lane'])
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when an upload is not admitted
+    retry_after is the estimated number of seconds until it would be
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second up to capacity
+    Not thread-safe; the controller holds its lock while using buckets
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_time(self):
+        """
+        Seconds until one token is available (0 if one is available now)
+        """
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+
+class Lane:
+    """
+    Concurrency limit with a bounded number of waiters
+    """
+
+    def __init__(self, name, max_concurrent, max_waiting):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.admitted = 0
+        self.running = 0
+        self.slots = threading.Semaphore(max_concurrent)
+        # Moving average of how long an upload holds a slot, for wait estimates
+        self.average_duration = 30.0
+
+    def estimated_wait(self):
+        ahead = self.admitted - self.max_concurrent + 1
+        return max(0, ahead) * self.average_duration / self.max_concurrent
+
+    def update_gauges(self):
+        admission_running.set(self.running, lane=self.name)
+        admission_waiting.set(self.admitted - self.running, lane=self.name)
+
+
+class Ticket:
+    """
+    A place in a lane, handed out by AdmissionController.reserve()
+
+    Use as a context manager around the Groq work: entering waits for a
+    slot, leaving frees it. release() gives up a ticket that will not be
+    used; releasing more than once has no effect. refund() also returns
+    the token it took, for an upload refused before it was processed.
+    """
+
+    def __init__(self, controller, lane, bucket=None):
+        self.controller = controller
+        self.lane = lane
+        self.bucket = bucket
+        self.acquired_at = None
+        self.released = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def acquire(self):
+        if self.released:
+            raise AdmissionRejected('Admission was cancelled', self.lane.average_duration)
+        if not self.lane.slots.acquire(timeout=self.controller.max_wait):
+            self._timed_out()
+        self._acquired()
+
+    async def acquire_async(self):
+        """
+        Wait for a slot without blocking the event loop
+        The semaphore is polled, backing off from 50ms to 1s between tries
+        """
+        if self.released:
+            raise AdmissionRejected('Admission was cancelled', self.lane.average_duration)
+        deadline = time.monotonic() + self.controller.max_wait
+        delay = 0.05
+        while not self.lane.slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                self._timed_out()
+            await asyncio.sleep(delay)
+            delay = min(1.0, delay * 2)
+        self._acquired()
+
+    def _acquired(self):
+        self.acquired_at = time.monotonic()
+        with self.controller.lock:
+            self.lane.running += 1
+            self.lane.update_gauges()
+
+    def _timed_out(self):
+        self.release()
+        raise AdmissionRejected('Timed out waiting for a free processing slot', self.lane.average_duration)
+
+    def release(self):
+        with self.controller.lock:
+            if self.released:
+                return
+            self.released = True
+            self.lane.admitted -= 1
+            if self.acquired_at is not None:
+                duration = time.monotonic() - self.acquired_at
+                self.lane.average_duration = 0.8 * self.lane.average_duration + 0.2 * duration
+                self.lane.running -= 1
+            self.lane.update_gauges()
+        if self.acquired_at is not None:
+            self.lane.slots.release()
+
+    def refund(self):
+        """
+        Release the ticket and give its token back to the user's bucket
+        The token is kept once the ticket was released or has held a slot
+        """
+        with self.controller.lock:
+            if self.bucket is not None and not self.released and self.acquired_at is None:
+                self.bucket.tokens = min(self.bucket.capacity, self.bucket.tokens + 1)
+        self.release()
+
+
+class AdmissionController:
+    """
+    Per-user token buckets in front of concurrency lanes
+    """
+
+    def __init__(self, tier_limits=None, max_concurrent=4, max_waiting=16,
+                 admin_max_concurrent=2, admin_max_waiting=8, max_wait=300.0,
+                 async_max_concurrent=100, async_max_waiting=400):
+        self.tier_limits = dict(DEFAULT_TIER_LIMITS, **(tier_limits or {}))
+        self.lanes = {
+            'default': Lane('default', max_concurrent, max_waiting),
+            'admin': Lane('admin', admin_max_concurrent, admin_max_waiting),
+            'async': Lane('async', async_max_concurrent, async_max_waiting),
+        }
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self._buckets = {}
+
+    def reserve(self, user_key, tier, lane='default', charge=True):
+        """
+        Admit one upload for user_key in tier, or raise AdmissionRejected
+        Returns a Ticket that must be used (with) or released
+        Admins always use the admin lane; lane='async' is for the /async routes
+        charge=False admits an upload whose token was already taken with take_token()
+        """
+        lane = self.lanes['admin' if tier == 'admin' else lane]
+        with self.lock:
+            bucket = self._checked_bucket(user_key, tier) if charge else None
+            if lane.admitted >= lane.max_concurrent + lane.max_waiting:
+                admission_rejected.inc(reason='queue_full', tier=tier)
+                raise AdmissionRejected('The service is busy', lane.estimated_wait())
+            if bucket is not None:
+                bucket.tokens -= 1
+            lane.admitted += 1
+            lane.update_gauges()
+        return Ticket(self, lane, bucket)
+
+    def take_token(self, user_key, tier):
+        """
+        Take one token from the user's bucket without a place in a lane, or raise AdmissionRejected
+        Used when a recording starts; its Groq calls are admitted later with
+        reserve(charge=False) and admit()
+        """
+        with self.lock:
+            self._checked_bucket(user_key, tier).tokens -= 1
+
+    def admit(self, tier, lane='default'):
+        """
+        Ticket for Groq work that was already charged to a bucket, such as one
+        window of a live recording
+        It is never refused for a full wait queue: the caller bounds how many
+        wait (the live transcription pool), and the ticket still waits for a slot
+        """
+        lane = self.lanes['admin' if tier == 'admin' else lane]
+        with self.lock:
+            lane.admitted += 1
+            lane.update_gauges()
+        return Ticket(self, lane)
+
+    def stats(self):
+        with self.lock:
+            return {name: {"running": lane.running, "waiting": lane.admitted - lane.running,
+                           "max_concurrent": lane.max_concurrent, "max_waiting": lane.max_waiting,
+                           "average_duration": lane.average_duration}
+                    for name, lane in self.lanes.items()}
+
+    def _checked_bucket(self, user_key, tier):
+        # The user's refilled bucket, raising AdmissionRejected if it has no token
+        # Called with the lock held
+        per_hour, burst = self.tier_limits.get(tier, self.tier_limits['free'])
+        bucket = self._bucket(user_key, tier, per_hour / 3600.0, burst, time.monotonic())
+        wait = bucket.wait_time()
+        if wait > 0:
+            admission_rejected.inc(reason='rate_limit', tier=tier)
+            raise AdmissionRejected('Upload limit reached for your plan', wait)
+        return bucket
+
+    def _bucket(self, user_key, tier, rate, capacity, now):
+        # Called with the lock held
+        key = (tier, user_key)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= 10000:
+                self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(rate, capacity)
+        bucket.refill(now)
+        return bucket
+
+    def _prune(self, now):
+        # Drop buckets that have refilled completely, they behave like new ones
+        for key in [key for key, bucket in self._buckets.items()
+                    if bucket.tokens + (now - bucket.updated_at) * bucket.rate >= bucket.capacity]:
+            del self._buckets[key]
+
+
+def parse_tier_limit(value):
+    """
+    Parse a RATE_LIMIT_<TIER> value of the form 'uploads_per_hour/burst'
+    """
+    per_hour, _, burst = value.partition('/')
+    return float(per_hour), float(burst or 1)
+
+
+def create_admission_controller():
+    """
+    Build the admission controller configured through environment variables
+
+    ADMISSION_MAX_CONCURRENT - uploads calling Groq at once (default: 4)
+    ADMISSION_MAX_WAITING    - uploads allowed to wait for a slot (default: 16)
+    ADMISSION_MAX_WAIT       - seconds an upload may wait for a slot (default: 300)
+    ADMIN_MAX_CONCURRENT     - separate slots for admins (default: 2)
+    ADMIN_MAX_WAITING        - admin uploads allowed to wait (default: 8)
+    ASYNC_MAX_CONCURRENT     - async uploads calling Groq at once (default: 100)
+    ASYNC_MAX_WAITING        - async uploads allowed to wait (default: 400)
+    RATE_LIMIT_<TIER>        - 'uploads_per_hour/burst' for the tiers
+                               ANONYMOUS, FREE, PRO and ADMIN
+    """
+    tier_limits = {}
+    for tier in DEFAULT_TIER_LIMITS:
+        value = os.getenv(f'RATE_LIMIT_{tier.upper()}')
+        if value:
+            tier_limits[tier] = parse_tier_limit(value)
+    return AdmissionController(
+        tier_limits=tier_limits,
+        max_concurrent=int(os.getenv('ADMISSION_MAX_CONCURRENT', '4')),
+        max_waiting=int(os.getenv('ADMISSION_MAX_WAITING', '16')),
+        admin_max_concurrent=int(os.getenv('ADMIN_MAX_CONCURRENT', '2')),
+        admin_max_waiting=int(os.getenv('ADMIN_MAX_WAITING', '8')),
+        max_wait=float(os.getenv('ADMISSION_MAX_WAIT', '300')),
+        async_max_concurrent=int(os.getenv('ASYNC_MAX_CONCURRENT', '100')),
+        async_max_waiting=int(os.getenv('ASYNC_MAX_WAITING', '400')),
+    )
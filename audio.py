@@ -0,0 +1,410 @@
+"""
+Audio helpers for Staky AI
+
+Long recordings are split into overlapping segments so they can be
+transcribed in parallel, and the segment transcripts are stitched back
+together in order with the repeated words from the overlap removed.
+
+Segmentation works on PCM WAV files and raw 16-bit PCM using only the
+standard library. Cut points are moved to the quietest moment near each
+target boundary so words are rarely split between two segments.
+
+Before transcription, WAV uploads are preprocessed to shrink what is sent
+to Whisper: downmixed to mono, resampled to 16kHz (the rate Whisper works
+at internally), trimmed of leading and trailing silence and, if ffmpeg is
+installed, optionally re-encoded to a compressed format. Preprocessing
+needs NumPy and is skipped when it is not installed.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import wave
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    # Preprocessing is skipped without NumPy, uploads are sent as received
+    np = None
+
+# Length of the analysis frame used to find silence, in seconds
+SILENCE_FRAME_SECONDS = 0.02
+
+# Sample rate Whisper resamples all audio to
+WHISPER_SAMPLE_RATE = 16000
+
+# Input frames processed per block during preprocessing (about 10s at 44.1kHz)
+PREPROCESS_BLOCK_FRAMES = 441000
+
+# Number of taps of the low-pass filter applied before downsampling
+LOWPASS_TAPS = 63
+
+# Codec arguments for ffmpeg, by file extension, for optional re-encoding
+REENCODE_CODECS = {
+    'flac': ['-c:a', 'flac'],
+    'mp3': ['-c:a', 'libmp3lame', '-b:a', '48k'],
+    'ogg': ['-c:a', 'libopus', '-b:a', '32k'],
+}
+
+
+def is_wav(path):
+    """
+    Return True if the file is a PCM WAV file the wave module can read
+    """
+    try:
+        with wave.open(path, 'rb'):
+            return True
+    except (wave.Error, EOFError, OSError):
+        return False
+
+
+def wav_duration(path):
+    """
+    Duration of a WAV file in seconds
+    """
+    with wave.open(path, 'rb') as wav:
+        return wav.getnframes() / float(wav.getframerate())
+
+
+def audio_duration(path):
+    """
+    Duration of an audio file in seconds, or None if it cannot be determined
+    WAV files are read directly; other formats need ffprobe (part of ffmpeg)
+    """
+    if is_wav(path):
+        return wav_duration(path)
+    if shutil.which('ffprobe') is None:
+        return None
+    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                             '-of', 'default=noprint_wrappers=1:nokey=1', path], capture_output=True)
+    try:
+        return float(result.stdout.decode().strip())
+    except ValueError:
+        return None
+
+
+def _frame_energy(data, sample_width):
+    # Sum of squares of the samples in a block of raw PCM data
+    # Only 16-bit audio is analysed; other widths report no energy so the
+    # caller falls back to cutting exactly at the target position
+    if sample_width != 2:
+        return 0
+    samples = array('h')
+    samples.frombytes(data[:len(data) - len(data) % 2])
+    return sum(s * s for s in samples)
+
+
+def quietest_offset(data, frame_bytes, sample_width=2):
+    """
+    Byte offset of the middle of the quietest frame in a block of raw PCM data
+    frame_bytes must be a multiple of the sample frame size
+    """
+    best_offset, best_energy = len(data), None
+    for offset in range(0, len(data) - frame_bytes + 1, frame_bytes):
+        energy = _frame_energy(data[offset:offset + frame_bytes], sample_width)
+        if best_energy is None or energy < best_energy:
+            best_offset, best_energy = offset + frame_bytes // 2, energy
+    return best_offset
+
+
+def write_wav(path, pcm, sample_rate, channels=1, sample_width=2):
+    """
+    Write raw PCM data to a WAV file
+    """
+    with wave.open(path, 'wb') as out:
+        out.setnchannels(channels)
+        out.setsampwidth(sample_width)
+        out.setframerate(sample_rate)
+        out.writeframes(pcm)
+
+
+def find_quiet_point(wav, start_frame, end_frame):
+    """
+    Return the frame index of the quietest analysis frame in [start_frame, end_frame)
+    The wav file position is moved as a side effect
+    """
+    rate = wav.getframerate()
+    width = wav.getsampwidth() * wav.getnchannels()
+    step = max(1, int(rate * SILENCE_FRAME_SECONDS))
+
+    wav.setpos(start_frame)
+    best_frame, best_energy = end_frame, None
+    position = start_frame
+    while position + step <= end_frame:
+        data = wav.readframes(step)
+        if len(data) < step * width:
+            break
+        energy = _frame_energy(data, wav.getsampwidth())
+        if best_energy is None or energy < best_energy:
+            best_frame, best_energy = position + step // 2, energy
+        position += step
+    return best_frame
+
+
+def split_wav(path, out_dir, segment_seconds, overlap_seconds=2.0, search_seconds=5.0):
+    """
+    Split a WAV file into overlapping segments written to out_dir
+
+    Each boundary is placed at the quietest point within search_seconds
+    before the nominal segment end, and the next segment starts
+    overlap_seconds before that boundary. Both are limited to a quarter of
+    the segment length, so every segment moves well past the previous one.
+
+    Returns the list of segment paths in playback order. A file shorter
+    than one segment is returned as-is (a single-item list with path).
+    """
+    with wave.open(path, 'rb') as wav:
+        rate = wav.getframerate()
+        total = wav.getnframes()
+        segment_frames = int(segment_seconds * rate)
+        overlap_frames = int(min(overlap_seconds, segment_seconds / 4) * rate)
+        search_frames = int(min(search_seconds, segment_seconds / 4) * rate)
+
+        if total <= segment_frames:
+            return [path]
+
+        # Work out the segment boundaries first
+        bounds = []
+        start = 0
+        while start < total:
+            target = start + segment_frames
+            if target >= total:
+                bounds.append((start, total))
+                break
+            search_start = max(start + overlap_frames + 1, target - search_frames)
+            cut = find_quiet_point(wav, search_start, target)
+            bounds.append((start, cut))
+            start = max(cut - overlap_frames, start + 1)
+
+        # Then copy each segment into its own WAV file
+        base = os.path.splitext(os.path.basename(path))[0]
+        segment_paths = []
+        for index, (start, end) in enumerate(bounds):
+            segment_path = os.path.join(out_dir, f"{base}_part{index:03d}.wav")
+            wav.setpos(start)
+            with wave.open(segment_path, 'wb') as out:
+                out.setparams(wav.getparams())
+                remaining = end - start
+                while remaining > 0:
+                    block = min(remaining, rate * 10)
+                    out.writeframes(wav.readframes(block))
+                    remaining -= block
+            segment_paths.append(segment_path)
+        return segment_paths
+
+
+def _normalize_word(word):
+    return re.sub(r'[^\w]', '', word.lower())
+
+
+def merge_segment_texts(texts, max_overlap_words=30, max_edge_words=2):
+    """
+    Join segment transcripts in order, removing words repeated in the overlap
+
+    For each pair of neighbouring segments the longest run of (at least two)
+    words that ends the previous text and starts the next one is found and
+    kept only once. Up to max_edge_words words at either edge may be skipped,
+    since words cut off at a segment boundary are often mis-transcribed.
+    """
+    merged = []
+    for text in texts:
+        words = text.split()
+        if not merged:
+            merged = words
+            continue
+
+        prev_norm = [_normalize_word(w) for w in merged[-(max_overlap_words + max_edge_words):]]
+        next_norm = [_normalize_word(w) for w in words[:max_overlap_words + max_edge_words]]
+        offset = len(merged) - len(prev_norm)
+
+        best = None
+        for k in range(min(max_overlap_words, len(prev_norm), len(next_norm)), 1, -1):
+            for skip_prev in range(max_edge_words + 1):
+                p = len(prev_norm) - skip_prev - k
+                if p < 0:
+                    break
+                for skip_next in range(max_edge_words + 1):
+                    if skip_next + k > len(next_norm):
+                        break
+                    if prev_norm[p:p + k] == next_norm[skip_next:skip_next + k]:
+                        best = (offset + p + k, skip_next + k)
+                        break
+                if best:
+                    break
+            if best:
+                break
+
+        if best:
+            keep_prev, drop_next = best
+            merged = merged[:keep_prev] + words[drop_next:]
+        else:
+            merged = merged + words
+    return ' '.join(merged)
+
+
+def _to_float(data, sample_width, channels):
+    # Convert raw PCM bytes to a (frames, channels) float32 array in [-1, 1]
+    if sample_width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif sample_width == 2:
+        samples = np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768.0
+    elif sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values = np.where(values & 0x800000, values - 0x1000000, values)
+        samples = values.astype(np.float32) / 8388608.0
+    else:
+        samples = np.frombuffer(data, dtype='<i4').astype(np.float32) / 2147483648.0
+    return samples.reshape(-1, channels)
+
+
+def _lowpass_filter(cutoff):
+    # Windowed-sinc FIR low-pass filter, cutoff as a fraction of the input sample rate
+    n = np.arange(LOWPASS_TAPS) - (LOWPASS_TAPS - 1) / 2.0
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(LOWPASS_TAPS)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+def _speech_bounds(wav, threshold, pad_frames):
+    # First pass: find the first and last analysis frame louder than threshold
+    # Returns (start_frame, end_frame) including padding, or None if all silent
+    rate = wav.getframerate()
+    channels = wav.getnchannels()
+    width = wav.getsampwidth()
+    step = max(1, int(rate * SILENCE_FRAME_SECONDS))
+    block_frames = PREPROCESS_BLOCK_FRAMES - PREPROCESS_BLOCK_FRAMES % step
+
+    wav.rewind()
+    first = last = None
+    position = 0
+    while True:
+        data = wav.readframes(block_frames)
+        if not data:
+            break
+        mono = _to_float(data, width, channels).mean(axis=1)
+        usable = len(mono) - len(mono) % step
+        if usable:
+            rms = np.sqrt((mono[:usable].reshape(-1, step) ** 2).mean(axis=1))
+            loud = np.nonzero(rms > threshold)[0]
+            if len(loud):
+                if first is None:
+                    first = position + loud[0] * step
+                last = position + (loud[-1] + 1) * step
+        position += len(mono)
+
+    if first is None:
+        return None
+    return max(0, first - pad_frames), min(wav.getnframes(), last + pad_frames)
+
+
+def preprocess_wav(path, out_dir, target_rate=WHISPER_SAMPLE_RATE, trim_db=-45.0, trim_pad_seconds=0.25):
+    """
+    Shrink a WAV file for transcription
+
+    The audio is downmixed to mono, low-pass filtered and resampled to
+    target_rate (never upsampled), and leading and trailing audio quieter
+    than trim_db dBFS is dropped. Processing runs block by block so memory
+    use does not grow with the length of the recording.
+
+    Returns the path of the new file in out_dir, or None when the file
+    cannot be preprocessed (not a PCM WAV, NumPy missing, or all silence).
+    """
+    if np is None or not is_wav(path):
+        return None
+
+    base = os.path.splitext(os.path.basename(path))[0]
+    out_path = os.path.join(out_dir, f"{base}_16k.wav")
+
+    with wave.open(path, 'rb') as wav:
+        rate = wav.getframerate()
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        out_rate = min(rate, target_rate)
+        ratio = rate / float(out_rate)
+
+        bounds = _speech_bounds(wav, 10 ** (trim_db / 20.0), int(trim_pad_seconds * rate))
+        if bounds is None:
+            return None
+        start, end = bounds
+
+        taps = _lowpass_filter(0.45 / ratio) if ratio > 1 else None
+        history = np.zeros(LOWPASS_TAPS - 1, dtype=np.float32) if taps is not None else None
+        # Position, in input frames since start, of the next output sample
+        next_position = 0.0
+        # Last filtered sample of the previous block, needed to interpolate across blocks
+        carry = None
+        consumed = 0
+
+        # Do not leave a partial output file behind if reading or writing fails
+        try:
+            wav.setpos(start)
+            with wave.open(out_path, 'wb') as out:
+                out.setnchannels(1)
+                out.setsampwidth(2)
+                out.setframerate(out_rate)
+
+                remaining = end - start
+                while remaining > 0:
+                    data = wav.readframes(min(remaining, PREPROCESS_BLOCK_FRAMES))
+                    if not data:
+                        break
+                    mono = _to_float(data, width, channels).mean(axis=1)
+                    remaining -= len(mono)
+
+                    if taps is not None:
+                        # Overlap-save filtering keeps the filter state across blocks
+                        extended = np.concatenate((history, mono))
+                        history = extended[-(LOWPASS_TAPS - 1):]
+                        mono = np.convolve(extended, taps, mode='valid').astype(np.float32)
+
+                    if ratio == 1:
+                        resampled = mono
+                    else:
+                        # Linear interpolation at the output sample positions in this block
+                        if carry is not None:
+                            block = np.concatenate(([carry], mono))
+                            block_start = consumed - 1
+                        else:
+                            block = mono
+                            block_start = consumed
+                        block_end = consumed + len(mono) - 1
+                        count = int(np.floor((block_end - next_position) / ratio)) + 1 if block_end >= next_position else 0
+                        positions = next_position + ratio * np.arange(count)
+                        resampled = np.interp(positions - block_start, np.arange(len(block)), block)
+                        next_position += ratio * count
+                        carry = mono[-1]
+                    consumed += len(mono)
+
+                    pcm = np.clip(resampled * 32768.0, -32768, 32767).astype('<i2')
+                    out.writeframes(pcm.tobytes())
+        except Exception:
+            try:
+                os.remove(out_path)
+            except OSError:
+                pass
+            raise
+
+    return out_path
+
+
+def reencode_audio(path, audio_format):
+    """
+    Re-encode an audio file with ffmpeg into audio_format ('flac', 'mp3' or 'ogg')
+    Returns the new path, or None if ffmpeg is unavailable or the encode failed
+    """
+    codec = REENCODE_CODECS.get(audio_format)
+    if codec is None or shutil.which('ffmpeg') is None:
+        return None
+    out_path = f"{os.path.splitext(path)[0]}.{audio_format}"
+    result = subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', path] + codec + [out_path],
+                            capture_output=True)
+    if result.returncode != 0:
+        print(f"Warning: Could not re-encode audio to {audio_format}: {result.stderr.decode(errors='replace')}")
+        try:
+            os.remove(out_path)
+        except OSError:
+            pass
+        return None
+    return out_path
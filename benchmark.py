@@ -0,0 +1,603 @@
+"""
+Offline load benchmark for Staky AI
+
+Runs the app against local stand-ins for Groq and Supabase so throughput
+can be measured without credentials or network access, and regressions
+caught before deploying:
+
+1. FakeGroq     - /openai/v1/audio/transcriptions and /openai/v1/chat/completions
+2. FakeSupabase - PostgREST table API (/rest/v1/<table>) over in-memory
+                  tables, plus the auth endpoints used for login
+Each endpoint has its own latency (with jitter) and error rate, so slow or
+failing dependencies can be simulated as well.
+
+The app runs in a child process (a threaded Werkzeug server) pointed at the
+stand-ins through GROQ_BASE_URL, SUPABASE_URL and SUPABASE_KEY. Every
+scenario is driven at each concurrency level by that many logged-in
+clients, and the report gives p50/p95/p99 latency, throughput and errors
+per scenario and level, and the peak RSS of the app process.
+
+Scenarios:
+    upload        - POST /file_upload with a unique WAV file (result cache misses)
+    job_upload    - POST /file_upload?mode=job, then poll the job until it is done
+    async_upload  - POST /async/file_upload, then poll the job until it is done
+    dashboard     - GET /dashboard
+    transcription - GET /transcription/<id> of a seeded transcription
+
+The latency of the job scenarios runs from the upload to the finished
+job, so job_upload (JOB_WORKERS threads) and async_upload (one event loop)
+can be compared at the same concurrency.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --scenarios upload --concurrency 1,8,32 --requests 200 \\
+        --transcribe-latency 1.5 --chat-latency 0.8 --chat-error-rate 0.02
+    python benchmark.py --scenarios job_upload,async_upload --concurrency 10 \\
+        --requests 20 --transcriptions 1 --transcribe-latency 1 --chat-latency 0
+    python benchmark.py --json bench_output.json
+
+Benchmark users are admins, so the free trial limit does not apply; the
+admin admission lane is sized to the highest concurrency level unless
+ADMIN_MAX_CONCURRENT / ADMIN_MAX_WAITING are set. Other settings of the
+app (HTTP_MAX_RETRIES, RESULT_CACHE_BACKEND, ...) are passed through from
+the environment.
+"""
+
+import argparse
+import base64
+import datetime
+import io
+import json
+import math
+import os
+import random
+import re
+import resource
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+
+BENCH_PASSWORD = 'benchmark-password'
+SCENARIOS = ('upload', 'job_upload', 'async_upload', 'dashboard', 'transcription')
+JOB_UPLOAD_PATHS = {'job_upload': '/file_upload?mode=job', 'async_upload': '/async/file_upload'}
+JOB_POLL_SECONDS = 0.25
+
+
+class Endpoint:
+    """
+    Latency and error settings of one fake endpoint
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def delay(self):
+        """
+        Sleep for the configured latency
+        Returns an error status to send instead of the real response, or None
+        """
+        seconds = self.latency + random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status
+        return None
+
+
+class FakeService:
+    """
+    Threaded HTTP server on a free local port, running in a daemon thread
+    Subclasses implement route(method, path, query, body) -> (status, headers, body)
+    """
+
+    def __init__(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_one(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                try:
+                    status, headers, payload = service.route(method, url.path, parse_qsl(url.query),
+                                                             self.headers, body)
+                except Exception as e:
+                    status, headers, payload = 500, {}, {"message": str(e)}
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', headers.pop('Content-Type', 'application/json'))
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.handle_one('GET')
+
+            def do_POST(self):
+                self.handle_one('POST')
+
+            def do_PATCH(self):
+                self.handle_one('PATCH')
+
+            def do_DELETE(self):
+                self.handle_one('DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def route(self, method, path, query, headers, body):
+        raise NotImplementedError
+
+
+class FakeGroq(FakeService):
+    """
+    Groq stand-in answering transcription and (non-streaming) chat requests
+    """
+
+    def __init__(self, transcribe, chat):
+        super().__init__()
+        self.endpoints = {'transcribe': transcribe, 'chat': chat}
+
+    def route(self, method, path, query, headers, body):
+        if path.endswith('/audio/transcriptions'):
+            endpoint = 'transcribe'
+        elif path.endswith('/chat/completions'):
+            endpoint = 'chat'
+        else:
+            return 404, {}, {"error": {"message": f"Unknown path {path}"}}
+
+        error_status = self.endpoints[endpoint].delay()
+        if error_status:
+            return error_status, {}, {"error": {"message": "Simulated error", "type": "server_error"}}
+
+        if endpoint == 'transcribe':
+            return 200, {}, {"text": "This is a benchmark transcription. " * 20}
+        return 200, {}, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "benchmark",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "## Summary\n\n- Benchmark point one\n- Benchmark point two"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        }
+
+
+class FakeSupabase(FakeService):
+    """
+    Supabase stand-in: PostgREST over in-memory tables plus password sign-in
+
+    Supports the query features the app uses: select with column lists,
+    eq/lt/gt/ilike filters, or=(...) keyset filters (ignored, so every
+    cursor page returns the first rows), order, limit/offset, Range and
+    Prefer: count=exact. Good enough to load the app, not a database.
+    """
+
+    def __init__(self, table_endpoint, auth_endpoint):
+        super().__init__()
+        self.table_endpoint = table_endpoint
+        self.auth_endpoint = auth_endpoint
+        self.tables = {'users': [], 'transcriptions': []}
+        self.auth_users = {}
+        self.lock = threading.Lock()
+
+    def seed(self, users, transcriptions_per_user):
+        """
+        Create admin users and their transcriptions
+        Returns a list of (email, [transcription ids]) per user
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        seeded = []
+        for index in range(users):
+            user_id = str(uuid.uuid4())
+            email = f'bench{index}@example.com'
+            self.auth_users[email] = user_id
+            self.tables['users'].append({
+                "id": user_id, "name": f"Bench {index}", "email": email,
+                "created_at": now.isoformat(), "usage_count": 0, "is_admin": True,
+            })
+            ids = []
+            for number in range(transcriptions_per_user):
+                summary = f"## Meeting {number}\n\n" + "- A summarized point\n" * 20
+                row_id = str(uuid.uuid4())
+                self.tables['transcriptions'].append({
+                    "id": row_id, "user_id": user_id, "filename": f"meeting-{number}.wav",
+                    "raw_transcription": "Words of the meeting. " * 400, "summary": summary,
+                    "preview": summary[:200],
+                    "created_at": (now - datetime.timedelta(minutes=number)).isoformat(),
+                })
+                ids.append(row_id)
+            seeded.append((email, ids))
+        return seeded
+
+    def route(self, method, path, query, headers, body):
+        if path.startswith('/auth/v1/'):
+            error_status = self.auth_endpoint.delay()
+            if error_status:
+                return error_status, {}, {"msg": "Simulated error"}
+            return self.auth(method, path[len('/auth/v1/'):], query, body)
+        if path.startswith('/rest/v1/'):
+            error_status = self.table_endpoint.delay()
+            if error_status:
+                return error_status, {}, {"message": "Simulated error", "code": "PGRST000"}
+            return self.table(method, path[len('/rest/v1/'):], query, headers, body)
+        return 404, {}, {"message": f"Unknown path {path}"}
+
+    def auth(self, method, action, query, body):
+        if action == 'token':
+            credentials = json.loads(body or b'{}')
+            user_id = self.auth_users.get(credentials.get('email'))
+            if user_id is None or credentials.get('password') != BENCH_PASSWORD:
+                return 400, {}, {"error": "invalid_grant", "error_description": "Invalid login credentials"}
+            return 200, {}, self.session(user_id, credentials['email'])
+        if action == 'signup':
+            credentials = json.loads(body or b'{}')
+            user_id = self.auth_users.setdefault(credentials.get('email'), str(uuid.uuid4()))
+            return 200, {}, self.session(user_id, credentials.get('email'))
+        if action == 'logout':
+            return 204, {}, b''
+        if action == 'user':
+            return 401, {}, {"msg": "No user"}
+        return 404, {}, {"msg": f"Unknown auth action {action}"}
+
+    def session(self, user_id, email):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return {
+            "access_token": fake_jwt(user_id), "token_type": "bearer", "expires_in": 3600,
+            "expires_at": int(time.time()) + 3600, "refresh_token": uuid.uuid4().hex,
+            "user": {"id": user_id, "aud": "authenticated", "role": "authenticated", "email": email,
+                     "app_metadata": {}, "user_metadata": {}, "created_at": now},
+        }
+
+    def table(self, method, name, query, headers, body):
+        with self.lock:
+            rows = self.tables.setdefault(name, [])
+            filters = [(key, value) for key, value in query
+                       if key not in ('select', 'order', 'limit', 'offset', 'or', 'columns', 'on_conflict')]
+            params = dict(query)
+
+            if method == 'POST':
+                new_rows = json.loads(body or b'[]')
+                if isinstance(new_rows, dict):
+                    new_rows = [new_rows]
+                for row in new_rows:
+                    row.setdefault('id', str(uuid.uuid4()))
+                    rows.append(row)
+                return 201, {}, new_rows
+
+            matched = [row for row in rows if all(match_filter(row, key, value) for key, value in filters)]
+
+            if method == 'PATCH':
+                changes = json.loads(body or b'{}')
+                for row in matched:
+                    row.update(changes)
+                return 200, {}, [dict(row) for row in matched]
+            if method == 'DELETE':
+                for row in matched:
+                    rows.remove(row)
+                return 200, {}, matched
+
+            for column in reversed(params.get('order', '').split(',')):
+                if column:
+                    field, _, direction = column.partition('.')
+                    matched.sort(key=lambda row: str(row.get(field, '')), reverse=direction.startswith('desc'))
+            total = len(matched)
+            offset, limit = int(params.get('offset', 0)), params.get('limit')
+            range_header = headers.get('Range')
+            if range_header and '-' in range_header:
+                first, last = range_header.split('-')
+                offset, limit = int(first), int(last) - int(first) + 1
+            page = matched[offset:offset + int(limit)] if limit is not None else matched[offset:]
+            page = [project(row, params.get('select', '*')) for row in page]
+
+            response_headers = {}
+            if 'count=' in headers.get('Prefer', ''):
+                end = offset + len(page) - 1 if page else offset
+                response_headers['Content-Range'] = f'{offset}-{end}/{total}'
+            return 200, response_headers, page
+
+
+def match_filter(row, key, value):
+    operator, _, operand = value.partition('.')
+    field = row.get(key)
+    if operator == 'eq':
+        return str(field).lower() == operand.lower() if isinstance(field, bool) else str(field) == operand
+    if operator == 'neq':
+        return str(field) != operand
+    if operator in ('lt', 'gt'):
+        return (str(field) < operand) if operator == 'lt' else (str(field) > operand)
+    if operator == 'ilike':
+        pattern = re.escape(operand.strip('"')).replace('\\*', '.*').replace('%', '.*')
+        return re.fullmatch(pattern, str(field or ''), re.IGNORECASE) is not None
+    return True
+
+
+def project(row, select):
+    columns = [column.strip() for column in select.split(',')]
+    if '*' in columns:
+        return dict(row)
+    return {column: row.get(column) for column in columns if column}
+
+
+def fake_jwt(subject):
+    """
+    Unsigned token shaped like a Supabase JWT (clients only check the shape)
+    """
+    def part(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii').rstrip('=')
+    return '.'.join([part({"alg": "HS256", "typ": "JWT"}),
+                     part({"sub": subject, "role": "service_role", "exp": int(time.time()) + 86400}),
+                     'benchmark'])
+
+
+def make_wav(seconds=2.0, sample_rate=16000):
+    """
+    Random-noise mono WAV file, different on every call so the result cache always misses
+    """
+    frames = int(seconds * sample_rate)
+    pcm = os.urandom(frames * 2)
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(pcm), b'WAVE', b'fmt ', 16, 1, 1,
+                         sample_rate, sample_rate * 2, 2, 16, b'data', len(pcm))
+    return header + pcm
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb(pid):
+    """
+    Peak resident set size of a running process in MB (Linux), or None
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def serve_app(port):
+    """
+    Child process: run the app on a threaded Werkzeug server
+    """
+    from werkzeug.serving import make_server
+    from main import app
+    app.secret_key = app.secret_key or 'benchmark'
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def start_app(env, port):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve-app', str(port)],
+                               env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'App exited during startup with code {process.returncode}')
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/', timeout=1.0)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('App did not start within 30 seconds')
+
+
+def free_port():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BaseHTTPRequestHandler)
+    port = server.server_port
+    server.server_close()
+    return port
+
+
+def login(base_url, email):
+    client = httpx.Client(base_url=base_url, timeout=600.0, follow_redirects=False)
+    response = client.post('/login', data={"email": email, "password": BENCH_PASSWORD})
+    if response.status_code != 302 or '/dashboard' not in response.headers.get('Location', ''):
+        raise RuntimeError(f'Benchmark login failed for {email} (HTTP {response.status_code})')
+    return client
+
+
+def send(client, scenario, transcription_ids):
+    """
+    Send one request of the scenario and return True if it succeeded
+    Job scenarios also wait for the job to finish
+    """
+    if scenario == 'upload':
+        audio = make_wav()
+        response = client.post('/file_upload', files={"file": ('benchmark.wav', io.BytesIO(audio), 'audio/wav')})
+    elif scenario in JOB_UPLOAD_PATHS:
+        audio = make_wav()
+        response = client.post(JOB_UPLOAD_PATHS[scenario],
+                               files={"file": ('benchmark.wav', io.BytesIO(audio), 'audio/wav')})
+        return response.status_code == 202 and wait_for_job(client, response.json()['status_url'])
+    elif scenario == 'dashboard':
+        response = client.get('/dashboard')
+    else:
+        response = client.get(f'/transcription/{random.choice(transcription_ids)}')
+    return response.status_code == 200
+
+
+def wait_for_job(client, status_url):
+    """
+    Poll a job until it is done (True) or failed (False)
+    """
+    while True:
+        response = client.get(status_url)
+        if response.status_code != 200:
+            return False
+        status = response.json()['status']
+        if status in ('done', 'failed'):
+            return status == 'done'
+        time.sleep(JOB_POLL_SECONDS)
+
+
+def run_level(base_url, users, scenario, concurrency, requests):
+    """
+    Send requests requests with concurrency clients (one logged-in user each)
+    Returns latencies in seconds, error count and wall time
+    """
+    clients = [(login(base_url, email), ids) for email, ids in users[:concurrency]]
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker(client, ids):
+        nonlocal errors
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                ok = send(client, scenario, ids)
+            except httpx.HTTPError:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for client, ids in clients:
+            executor.submit(worker, client, ids)
+    wall = time.perf_counter() - start
+    for client, _ in clients:
+        client.close()
+    return sorted(latencies), errors, wall
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Offline load benchmark for Staky AI')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma-separated scenarios: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--concurrency', default='1,4,16', help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario and level')
+    parser.add_argument('--transcriptions', type=int, default=50, help='seeded transcriptions per user')
+    parser.add_argument('--transcribe-latency', type=float, default=0.5)
+    parser.add_argument('--transcribe-error-rate', type=float, default=0.0)
+    parser.add_argument('--chat-latency', type=float, default=0.3)
+    parser.add_argument('--chat-error-rate', type=float, default=0.0)
+    parser.add_argument('--db-latency', type=float, default=0.01)
+    parser.add_argument('--db-error-rate', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help='random +/- latency as a fraction of each endpoint latency')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for latency jitter and errors')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--serve-app', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.serve_app:
+        serve_app(args.serve_app)
+        return 0
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            raise SystemExit(f'Unknown scenario: {name}')
+    levels = [int(level) for level in args.concurrency.split(',') if level]
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    def endpoint(latency, error_rate):
+        return Endpoint(latency, latency * args.jitter, error_rate)
+
+    groq = FakeGroq(endpoint(args.transcribe_latency, args.transcribe_error_rate),
+                    endpoint(args.chat_latency, args.chat_error_rate)).start()
+    supabase = FakeSupabase(endpoint(args.db_latency, args.db_error_rate), endpoint(args.db_latency, 0.0)).start()
+    users = supabase.seed(max(levels), args.transcriptions)
+
+    env = dict(os.environ)
+    env.update({
+        "API_KEY": "benchmark", "GROQ_BASE_URL": groq.url,
+        "SUPABASE_URL": supabase.url, "SUPABASE_KEY": fake_jwt('service'),
+    })
+    env.setdefault('RESULT_CACHE_BACKEND', 'none')
+    env.setdefault('RATE_LIMIT_ADMIN', '1000000/100000')
+    env.setdefault('ADMIN_MAX_CONCURRENT', str(max(levels)))
+    env.setdefault('ADMIN_MAX_WAITING', str(max(levels)))
+
+    port = free_port()
+    app = start_app(env, port)
+    base_url = f'http://127.0.0.1:{port}'
+    results = []
+    try:
+        print(f"{'scenario':<14}{'conc':>5}{'reqs':>6}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}"
+              f"{'p99 ms':>10}{'req/s':>9}")
+        for scenario in scenarios:
+            for level in levels:
+                latencies, errors, wall = run_level(base_url, users, scenario, level, args.requests)
+                result = {
+                    "scenario": scenario, "concurrency": level, "requests": len(latencies), "errors": errors,
+                    "p50_ms": percentile(latencies, 0.50) * 1000, "p95_ms": percentile(latencies, 0.95) * 1000,
+                    "p99_ms": percentile(latencies, 0.99) * 1000,
+                    "throughput": len(latencies) / wall if wall > 0 else 0.0,
+                }
+                results.append(result)
+                print(f"{scenario:<14}{level:>5}{result['requests']:>6}{errors:>8}{result['p50_ms']:>10.1f}"
+                      f"{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['throughput']:>9.1f}")
+        peak_rss = peak_rss_mb(app.pid)
+    finally:
+        app.terminate()
+        app.wait()
+        groq.stop()
+        supabase.stop()
+
+    if peak_rss is None:
+        # ru_maxrss is in KB on Linux and bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / (1024.0 * (1024 if sys.platform == 'darwin' else 1))
+    print(f"peak RSS of the app process: {peak_rss:.1f} MB")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"results": results, "peak_rss_mb": peak_rss, "settings": vars(args)}, f, indent=2)
+    return 1 if any(result['errors'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
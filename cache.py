@@ -0,0 +1,279 @@
+"""
+Content-addressed result cache for Staky AI
+
+Uploading the same recording twice should not pay for Whisper and the
+summary model twice. Results are cached under a key made from a SHA-256
+hash of the audio bytes plus the names of the models that produced them,
+so a cached entry is only reused for identical audio and identical models.
+
+Backends:
+1. memory - in-process LRU with a TTL and a total size limit
+2. disk   - JSON files in a directory, shared by all workers on the machine
+3. none   - caching disabled
+
+Every backend counts hits and misses so the savings can be reported.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Read size used when hashing audio files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def cache_key(audio_hash, *models):
+    """
+    Build the cache key for an audio hash and the models that processed it
+    """
+    return hashlib.sha256('|'.join((audio_hash,) + models).encode('utf-8')).hexdigest()
+
+
+def hash_file(path):
+    """
+    SHA-256 hex digest of a file, read in blocks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Interface implemented by every cache backend
+    Values are JSON-serialisable dicts
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None on a miss
+        """
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Hit and miss counters plus backend-specific size information
+        """
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class NullCache(ResultCache):
+    """
+    Cache backend that stores nothing (caching disabled)
+    """
+    name = 'none'
+
+    def _get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+
+class MemoryCache(ResultCache):
+    """
+    In-process LRU cache with a TTL and a limit on the total size of the values
+    """
+    name = 'memory'
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=86400):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                self.size -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size, time.time() + self.ttl)
+            self.size += size
+            # Evict least recently used entries until we are under the size limit
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats.update({"entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes})
+        return stats
+
+
+class DiskCache(ResultCache):
+    """
+    Cache stored as one JSON file per key in a directory
+
+    File modification times track recency: a hit touches the file, and when
+    the directory grows past max_bytes the least recently used files are
+    removed. Entries older than ttl seconds are misses and are deleted when
+    they are read; the rest are deleted by a sweep of the directory that
+    runs on a write at most every sweep_interval seconds.
+    """
+    name = 'disk'
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, ttl=7 * 86400, sweep_interval=3600):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._swept_at = time.time()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(directory)
+                        if entry.name.endswith('.json'))
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) < time.time() - self.ttl:
+                with self._lock:
+                    self._remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(path)
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        data = json.dumps(value).encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        # Write to a temp file first so readers never see a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        except OSError:
+            os.remove(temp_path)
+            raise
+        with self._lock:
+            try:
+                self.size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(temp_path, path)
+            self.size += len(data)
+            if time.time() - self._swept_at >= self.sweep_interval:
+                self._sweep()
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _sweep(self):
+        # Remove expired files, which would never be read again
+        # Called with the lock held
+        self._swept_at = time.time()
+        cutoff = self._swept_at - self.ttl
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith('.json') and entry.stat().st_mtime < cutoff:
+                    self._remove(entry.path)
+            except OSError:
+                pass
+
+    def _remove(self, path):
+        # Called with the lock held
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.size -= size
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Remove least recently used files until under the size limit
+        # Called with the lock held
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith('.json')),
+                         key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({"bytes": self.size, "max_bytes": self.max_bytes})
+        return stats
+
+
+def create_cache():
+    """
+    Build the result cache configured through environment variables
+
+    RESULT_CACHE_BACKEND - memory, disk or none (default: memory)
+    RESULT_CACHE_MAX_MB  - total size limit in megabytes (default: 64)
+    RESULT_CACHE_TTL     - seconds an entry stays valid (default: 86400)
+    RESULT_CACHE_DIR     - directory for the disk backend (default: cache)
+    """
+    backend = os.getenv('RESULT_CACHE_BACKEND', 'memory')
+    max_bytes = int(os.getenv('RESULT_CACHE_MAX_MB', '64')) * 1024 * 1024
+    ttl = int(os.getenv('RESULT_CACHE_TTL', '86400'))
+    if backend == 'memory':
+        return MemoryCache(max_bytes=max_bytes, ttl=ttl)
+    if backend == 'disk':
+        return DiskCache(os.getenv('RESULT_CACHE_DIR', 'cache'), max_bytes=max_bytes, ttl=ttl)
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f'Unknown result cache backend: {backend}')
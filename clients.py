@@ -0,0 +1,367 @@
+"""
+API clients for Staky AI
+
+The Groq and Supabase clients are created on first use instead of when
+main.py is imported, so a cold start does not pay for client setup (or a
+database connection) before the first request that actually needs them.
+
+Both clients talk HTTP through httpx. Every request goes through a
+RetryTransport (AsyncRetryTransport for the async clients used by the
+/async routes), which provides:
+1. a keep-alive connection pool shared by all threads of the process
+2. timeouts on connect, read, write and waiting for a pooled connection
+3. retries on 429 and 5xx responses and connection failures, with
+   jittered exponential backoff that honours Retry-After. Bodies are only
+   resent if they are in memory, small enough to buffer, or files that can
+   be read again; other streamed uploads are sent once
+4. request, new-connection and retry counters for /metrics, so
+   connection reuse can be checked (connections / requests)
+
+Settings (environment variables):
+HTTP_POOL_SIZE         - connections per client (default: 20)
+HTTP_KEEPALIVE_EXPIRY  - seconds an idle connection is kept (default: 60)
+HTTP_CONNECT_TIMEOUT   - seconds to connect (default: 5)
+HTTP_MAX_RETRIES       - retries after the first attempt (default: 3)
+HTTP_BACKOFF_BASE      - first backoff in seconds, doubled per retry (default: 0.5)
+HTTP_BACKOFF_MAX       - longest wait between attempts in seconds (default: 30)
+HTTP_RETRY_BUFFER_KB   - largest streamed body buffered for retries (default: 1024)
+GROQ_TIMEOUT           - read timeout for Groq requests (default: 120)
+SUPABASE_TIMEOUT       - read timeout for Supabase requests (default: 15)
+"""
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+
+import httpx
+
+from metrics import REGISTRY
+
+# Responses worth retrying: rate limits and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Statuses that mean the request was not processed, safe to retry for any method
+NOT_PROCESSED_STATUSES = (429, 503)
+
+# Methods that can be repeated without side effects
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+client_requests = REGISTRY.counter('staky_http_client_requests_total',
+                                   'Outgoing HTTP requests (attempts) by client', ['client'])
+client_connections = REGISTRY.counter('staky_http_client_connections_total',
+                                      'New connections opened by client; the rest of the requests reused one',
+                                      ['client'])
+client_retries = REGISTRY.counter('staky_http_client_retries_total',
+                                  'Outgoing HTTP requests retried, by client and reason', ['client', 'reason'])
+
+
+class LazyClient:
+    """
+    Proxy that builds the real client with factory() on first attribute access
+
+    If the factory raises, the error is passed to the caller and the next
+    access tries again, so a client whose service was down at startup is
+    created once the service is back.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the real client, creating it if needed
+        """
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+                client = self._client
+        return client
+
+    @property
+    def initialized(self):
+        return self._client is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def is_connection_error(error):
+    """
+    True for errors that mean the service could not be reached at all
+    (as opposed to an error response from a reachable service)
+    """
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+def retry_after_seconds(response):
+    """
+    Delay requested by the server in Retry-After (seconds or HTTP date) or retry-after-ms
+    Returns None when the response does not ask for a delay
+    """
+    value = response.headers.get('retry-after-ms')
+    if value:
+        try:
+            return max(0.0, float(value) / 1000.0)
+        except ValueError:
+            pass
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _rereadable(file):
+    """
+    True if a multipart file value can be read again from the start
+    """
+    if isinstance(file, (str, bytes)):
+        return True
+    try:
+        return file.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+class RetryPolicy:
+    """
+    Retry decisions shared by the sync and async transports
+
+    Requests that may have been processed (5xx other than 503, read errors)
+    are only retried for idempotent methods, unless retry_non_idempotent is
+    set for APIs where repeating a POST is harmless (model inference). A
+    read timeout is never retried for other methods: the request may still
+    be running (and be billed) on the server.
+    """
+
+    def __init__(self, name, max_retries=3, backoff_base=0.5, backoff_max=30.0,
+                 retry_non_idempotent=False, max_buffer_bytes=1024 * 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_non_idempotent = retry_non_idempotent
+        self.max_buffer_bytes = max_buffer_bytes
+
+    def body_mode(self, request):
+        """
+        How the request body can be sent again on a retry:
+        'replay' - it is in memory, or a multipart body of files that can be read again
+        'buffer' - a small streamed body, read into memory first
+        'stream' - a large or one-shot stream, sent once without retries
+        """
+        stream = request.stream
+        if isinstance(stream, httpx.ByteStream):
+            return 'replay'
+        fields = getattr(stream, 'fields', None)
+        if fields is not None and all(_rereadable(getattr(field, 'file', b'')) for field in fields):
+            # httpx multipart bodies seek their files back to the start when iterated again
+            return 'replay'
+        length = request.headers.get('content-length')
+        if length is not None and int(length) <= self.max_buffer_bytes:
+            return 'buffer'
+        return 'stream'
+
+    def prepare(self, request, asynchronous=False):
+        """
+        Count new connections made for request
+        Returns True if the request may be repeated after it could have been processed
+        """
+        trace = request.extensions.get('trace')
+
+        def count_connections(event_name, info):
+            if event_name == 'connection.connect_tcp.complete':
+                client_connections.inc(client=self.name)
+            if trace:
+                trace(event_name, info)
+
+        async def count_connections_async(event_name, info):
+            # Async transports require a coroutine trace callback
+            if event_name == 'connection.connect_tcp.complete':
+                client_connections.inc(client=self.name)
+            if trace:
+                await trace(event_name, info)
+        request.extensions['trace'] = count_connections_async if asynchronous else count_connections
+        return self.retry_non_idempotent or request.method in IDEMPOTENT_METHODS
+
+    def retry_reason(self, attempt, repeatable, response=None, error=None, idempotent=False):
+        """
+        Decide whether to retry after an attempt
+        repeatable - the body can be sent again and the method may be repeated
+        idempotent - the method itself is idempotent
+        Returns (reason, retry_after) to retry, or None to return the response (or raise the error)
+        """
+        if attempt >= self.max_retries:
+            return None
+        if error is not None:
+            if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+                # Nothing was sent, always safe to retry
+                return 'connect', None
+            if isinstance(error, httpx.ReadTimeout):
+                return ('read', None) if repeatable and idempotent else None
+            if isinstance(error, (httpx.RemoteProtocolError, httpx.ReadError)) and repeatable:
+                return 'read', None
+            return None
+        status = response.status_code
+        if status not in RETRY_STATUSES or not (repeatable or status in NOT_PROCESSED_STATUSES):
+            return None
+        return str(status), retry_after_seconds(response)
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the next attempt
+        Full jitter over an exponentially growing window, or the server's Retry-After
+        """
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+class RetryTransport(RetryPolicy, httpx.HTTPTransport):
+    """
+    Pooled httpx transport that retries failed requests with backoff
+    """
+
+    def handle_request(self, request):
+        # Only small bodies are buffered so they can be sent again on a retry
+        body_mode = self.body_mode(request)
+        if body_mode == 'buffer':
+            request.read()
+        repeatable = self.prepare(request) and body_mode != 'stream'
+        idempotent = request.method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            client_requests.inc(client=self.name)
+            try:
+                response = super().handle_request(request)
+            except httpx.TransportError as e:
+                retry = self.retry_reason(attempt, repeatable, error=e, idempotent=idempotent)
+                if retry is None:
+                    raise
+            else:
+                retry = self.retry_reason(attempt, repeatable, response=response, idempotent=idempotent)
+                if retry is None:
+                    return response
+                # Drain the (small) error body so the connection goes back to the pool
+                response.read()
+
+            reason, delay = retry
+            client_retries.inc(client=self.name, reason=reason)
+            time.sleep(self.backoff(attempt, delay))
+            attempt += 1
+
+
+class AsyncRetryTransport(RetryPolicy, httpx.AsyncHTTPTransport):
+    """
+    Async version of RetryTransport, for clients used on an event loop
+    """
+
+    async def handle_async_request(self, request):
+        body_mode = self.body_mode(request)
+        if body_mode == 'buffer':
+            await request.aread()
+        repeatable = self.prepare(request, asynchronous=True) and body_mode != 'stream'
+        idempotent = request.method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            client_requests.inc(client=self.name)
+            try:
+                response = await super().handle_async_request(request)
+            except httpx.TransportError as e:
+                retry = self.retry_reason(attempt, repeatable, error=e, idempotent=idempotent)
+                if retry is None:
+                    raise
+            else:
+                retry = self.retry_reason(attempt, repeatable, response=response, idempotent=idempotent)
+                if retry is None:
+                    return response
+                await response.aread()
+
+            reason, delay = retry
+            client_retries.inc(client=self.name, reason=reason)
+            await asyncio.sleep(self.backoff(attempt, delay))
+            attempt += 1
+
+
+def http_settings():
+    """
+    Connection pool and retry settings shared by all clients
+    """
+    pool_size = int(os.getenv('HTTP_POOL_SIZE', '20'))
+    return {
+        "limits": httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                               keepalive_expiry=float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '60'))),
+        "max_retries": int(os.getenv('HTTP_MAX_RETRIES', '3')),
+        "backoff_base": float(os.getenv('HTTP_BACKOFF_BASE', '0.5')),
+        "backoff_max": float(os.getenv('HTTP_BACKOFF_MAX', '30')),
+        "max_buffer_bytes": int(os.getenv('HTTP_RETRY_BUFFER_KB', '1024')) * 1024,
+    }
+
+
+def http_timeout(read_timeout):
+    connect_timeout = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+    return httpx.Timeout(read_timeout, connect=connect_timeout, pool=connect_timeout)
+
+
+def create_groq_client():
+    """
+    Groq client on a pooled, retrying HTTP client
+    The SDK's own retries are turned off so every retry is counted in one place
+    """
+    from groq import Groq
+    timeout = http_timeout(float(os.getenv('GROQ_TIMEOUT', '120')))
+    http_client = httpx.Client(transport=RetryTransport('groq', retry_non_idempotent=True, **http_settings()),
+                               timeout=timeout)
+    return Groq(api_key=os.getenv('API_KEY'), http_client=http_client, timeout=timeout, max_retries=0)
+
+
+def create_async_groq_client():
+    """
+    AsyncGroq client on a pooled, retrying async HTTP client
+    Must only be used from one event loop (the async job queue's)
+    """
+    from groq import AsyncGroq
+    timeout = http_timeout(float(os.getenv('GROQ_TIMEOUT', '120')))
+    http_client = httpx.AsyncClient(transport=AsyncRetryTransport('groq_async', retry_non_idempotent=True,
+                                                                  **http_settings()),
+                                    timeout=timeout)
+    return AsyncGroq(api_key=os.getenv('API_KEY'), http_client=http_client, timeout=timeout, max_retries=0)
+
+
+def create_supabase_client():
+    """
+    Supabase client whose PostgREST, auth and storage requests go through RetryTransport
+    The httpx client is passed with ClientOptions, so it is also used by the
+    PostgREST clients supabase-py builds again after sign-in events
+    """
+    from supabase import create_client, ClientOptions
+    http_client = httpx.Client(transport=RetryTransport('supabase', **http_settings()),
+                               timeout=http_timeout(float(os.getenv('SUPABASE_TIMEOUT', '15'))))
+    return create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'),
+                         options=ClientOptions(httpx_client=http_client))
+
+
+async def create_async_supabase_client():
+    """
+    Async Supabase client on AsyncRetryTransport
+    Must only be used from one event loop (the async job queue's)
+    """
+    from supabase import acreate_client, AsyncClientOptions
+    http_client = httpx.AsyncClient(transport=AsyncRetryTransport('supabase_async', **http_settings()),
+                                    timeout=http_timeout(float(os.getenv('SUPABASE_TIMEOUT', '15'))))
+    return await acreate_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'),
+                                options=AsyncClientOptions(httpx_client=http_client))
@@ -0,0 +1,138 @@
+"""
+Database health monitoring for Staky AI
+
+The application runs without the database (local-only mode) when Supabase
+is not reachable. Instead of deciding this once at import time, a circuit
+breaker tracks database health while the app runs:
+1. closed - the database is used normally
+2. open   - after repeated connection failures the database is treated as
+            unavailable and calls fail fast instead of waiting on timeouts
+
+A background health probe checks the database periodically (more often
+while the breaker is open) and closes the breaker again once it answers,
+so a short outage does not require a restart.
+"""
+
+import threading
+import time
+
+
+class CircuitBreaker:
+    """
+    Open/closed state of a dependency based on consecutive failures
+
+    on_change(available) is called whenever the breaker opens or closes
+    """
+
+    def __init__(self, failure_threshold=3, on_change=None, is_open=False):
+        self.failure_threshold = failure_threshold
+        self.on_change = on_change
+        self.failures = 0
+        self.is_open = is_open
+        self.opened_at = time.time() if is_open else None
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return not self.is_open
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            changed = self.is_open
+            self.is_open = False
+            self.opened_at = None
+        if changed:
+            self._notify(True)
+
+    def record_failure(self, trip=False):
+        """
+        Count a failure; the breaker opens at failure_threshold, or at once with trip=True
+        """
+        with self._lock:
+            self.failures += 1
+            changed = not self.is_open and (trip or self.failures >= self.failure_threshold)
+            if changed:
+                self.is_open = True
+                self.opened_at = time.time()
+        if changed:
+            self._notify(False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": "open" if self.is_open else "closed",
+                "failures": self.failures,
+                "opened_at": self.opened_at,
+            }
+
+    def _notify(self, available):
+        if self.on_change:
+            self.on_change(available)
+
+
+class HealthMonitor:
+    """
+    Background thread that probes a dependency and reports to a circuit breaker
+
+    setup()  - optional, run once in the thread before the first probe
+    probe()  - raises if the dependency is unhealthy
+    The first probe decides the initial state on its own; after that the
+    breaker's failure threshold applies.
+    """
+
+    def __init__(self, probe, breaker, interval=30.0, open_interval=5.0, setup=None, name='health-monitor'):
+        self.probe = probe
+        self.breaker = breaker
+        self.interval = interval
+        self.open_interval = open_interval
+        self.setup = setup
+        self.name = name
+        self.last_check = None
+        self.last_error = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Start the probe thread if it is not running yet
+        Cheap to call on every request
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self, first=False):
+        """
+        Run the probe once and record the result
+        Returns True if the dependency is healthy
+        """
+        self.last_check = time.time()
+        try:
+            self.probe()
+        except Exception as e:
+            self.last_error = str(e)
+            self.breaker.record_failure(trip=first)
+            return False
+        self.last_error = None
+        self.breaker.record_success()
+        return True
+
+    def _run(self):
+        if self.setup:
+            try:
+                self.setup()
+            except Exception as e:
+                print(f"Warning: {self.name} setup failed: {e}")
+        first = True
+        while not self._stop.is_set():
+            self.check(first)
+            first = False
+            self._stop.wait(self.open_interval if self.breaker.is_open else self.interval)
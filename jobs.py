@@ -0,0 +1,245 @@
+"""
+Background job queue for Staky AI
+
+Transcription and summarization can take a long time for big recordings.
+Instead of holding a web worker for the whole Groq round-trip, the upload
+route hands the work to a bounded worker pool and returns a job ID right
+away. The browser then polls /jobs/<id> until the job is finished.
+
+Backends:
+1. local - in-process thread pool with job state kept in memory
+   (no Redis or other service needed, suitable for a single worker and tests)
+2. AsyncJobQueue - coroutine jobs on an event loop in a background thread,
+   used by the /async routes; a waiting job costs a coroutine, not a thread
+
+Other backends (e.g. Redis) can be added by implementing the JobQueue
+interface and registering them in create_job_queue().
+"""
+
+import asyncio
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Job states reported by the /jobs/<id> endpoint
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the queue is at capacity
+    """
+
+
+class Job:
+    """
+    A single unit of background work and its current state
+
+    The job function receives the Job object so it can report which
+    pipeline stage it is in (e.g. 'transcribing', 'summarizing').
+    """
+
+    def __init__(self, job_id, owner=None):
+        self.id = job_id
+        self.owner = owner
+        self.status = JOB_QUEUED
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def to_dict(self):
+        """
+        Public view of the job used for status responses
+        The result itself is only returned by the result endpoint
+        """
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Interface implemented by every queue backend
+    """
+
+    def submit(self, func, *args, owner=None, **kwargs):
+        """
+        Queue func(job, *args, **kwargs) and return the new Job
+        """
+        raise NotImplementedError
+
+    def get(self, job_id):
+        """
+        Return the Job with the given ID, or None if it is unknown or expired
+        """
+        raise NotImplementedError
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class LocalJobQueue(JobQueue):
+    """
+    In-process job queue backed by a ThreadPoolExecutor
+
+    max_workers bounds how many jobs run at the same time, max_pending
+    bounds how many jobs may be queued or running before submit() refuses
+    new work, and finished jobs are forgotten after result_ttl seconds.
+    """
+
+    def __init__(self, max_workers=4, max_pending=32, result_ttl=3600):
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='staky-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, owner=None, **kwargs):
+        with self._lock:
+            self._prune()
+            pending = sum(1 for job in self._jobs.values() if not job.finished)
+            if pending >= self.max_pending:
+                raise QueueFullError(f'Job queue is full ({pending} jobs pending)')
+            job = Job(uuid.uuid4().hex, owner=owner)
+            self._jobs[job.id] = job
+
+        self._start(job, func, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _start(self, job, func, args, kwargs):
+        self._executor.submit(self._run, job, func, args, kwargs)
+
+    def _run(self, job, func, args, kwargs):
+        job.status = JOB_RUNNING
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.status = JOB_DONE
+        except Exception as e:
+            job.error = str(e)
+            job.status = JOB_FAILED
+            print(f"Error in job {job.id}: {e}")
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self):
+        # Drop finished jobs whose results have not been collected in time
+        # Called with the lock held
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+class AsyncJobQueue(LocalJobQueue):
+    """
+    Job queue for coroutine functions, run on one event loop thread
+
+    submit(func, ...) takes an async function; every job runs as a task on
+    the queue's event loop, which is started with the first job. There is
+    no worker limit, only max_pending; callers bound the expensive part
+    (Groq calls) themselves through admission control.
+    """
+
+    def __init__(self, max_pending=1000, result_ttl=3600):
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+
+    @property
+    def loop(self):
+        """
+        The queue's event loop, started on first use
+        """
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=loop.run_forever, name='staky-async', daemon=True)
+                    self._thread.start()
+                    self._loop = loop
+        return self._loop
+
+    def run(self, coroutine, timeout=None):
+        """
+        Run a coroutine on the queue's event loop and wait for its result
+        For code outside the loop that needs a client bound to it
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def shutdown(self, wait=True):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            if wait:
+                self._thread.join()
+
+    def _start(self, job, func, args, kwargs):
+        asyncio.run_coroutine_threadsafe(self._run_async(job, func, args, kwargs), self.loop)
+
+    async def _run_async(self, job, func, args, kwargs):
+        job.status = JOB_RUNNING
+        try:
+            job.result = await func(job, *args, **kwargs)
+            job.status = JOB_DONE
+        except Exception as e:
+            job.error = str(e)
+            job.status = JOB_FAILED
+            print(f"Error in job {job.id}: {e}")
+        finally:
+            job.finished_at = time.time()
+
+
+def create_job_queue():
+    """
+    Build the job queue configured through environment variables
+
+    JOB_QUEUE_BACKEND   - backend name (default: local)
+    JOB_WORKERS         - number of jobs processed concurrently (default: 4)
+    JOB_MAX_PENDING     - queued + running jobs allowed (default: 32)
+    JOB_RESULT_TTL      - seconds a finished job is kept (default: 3600)
+    """
+    backend = os.getenv('JOB_QUEUE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalJobQueue(
+            max_workers=int(os.getenv('JOB_WORKERS', '4')),
+            max_pending=int(os.getenv('JOB_MAX_PENDING', '32')),
+            result_ttl=int(os.getenv('JOB_RESULT_TTL', '3600')),
+        )
+    raise ValueError(f'Unknown job queue backend: {backend}')
+
+
+def create_async_job_queue():
+    """
+    Build the job queue for the /async routes
+
+    ASYNC_MAX_PENDING   - queued + running async jobs allowed (default: 1000)
+    JOB_RESULT_TTL      - seconds a finished job is kept (default: 3600)
+    """
+    return AsyncJobQueue(
+        max_pending=int(os.getenv('ASYNC_MAX_PENDING', '1000')),
+        result_ttl=int(os.getenv('JOB_RESULT_TTL', '3600')),
+    )
@@ -18,53 +18,402 @@ Dependencies:
 - Python-dotenv for environment variable management
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from groq import Groq
+from flask import Flask, Request, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, g
+from werkzeug.exceptions import RequestEntityTooLarge
 import markdown
 from dotenv import load_dotenv
 import os
+import asyncio
+import base64
 import datetime
-from functools import wraps
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial, wraps
+from audio import is_wav, wav_duration, audio_duration, split_wav, merge_segment_texts, preprocess_wav, reencode_audio
+import summarizer
+from jobs import create_job_queue, create_async_job_queue, QueueFullError, JOB_DONE, JOB_FAILED
+from cache import create_cache, cache_key, hash_file, MemoryCache
+from search import create_search_index
+from usage import create_usage_accounting
+from storage import SupabaseStorage, create_local_storage
+from routing import create_model_router
+from recordings import RecordingStore, RecordingError
+from admission import create_admission_controller, AdmissionRejected
+from clients import (LazyClient, is_connection_error, create_groq_client, create_async_groq_client,
+                     create_supabase_client, create_async_supabase_client)
+from health import CircuitBreaker, HealthMonitor
+from metrics import (REGISTRY, timed, record_stage, server_timing_header,
+                     requests_in_flight, request_duration, requests_total)
 
 # Load environment variables from .env file
 # This includes API keys and configuration settings
 load_dotenv()
 
-# Initialize the Groq client
+# Groq client, created on first use on a pooled HTTP client with timeouts and retries
 # Groq API is used for both transcription and summarization
-client = Groq(api_key=os.getenv('API_KEY'))
+client = LazyClient(create_groq_client)
+
+# AsyncGroq client for the /async routes, only used on the async job queue's event loop
+async_client = LazyClient(create_async_groq_client)
+
+# Per-call timeout for transcription requests, which take longer than chat completions
+GROQ_TRANSCRIBE_TIMEOUT = float(os.getenv('GROQ_TRANSCRIBE_TIMEOUT', '300'))
+
+# Folder used for temporary storage of audio files, created when the first upload is staged
+UPLOAD_FOLDER = 'uploads'
+
+# Read size used when copying audio data to disk
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Largest file the Groq API accepts in one transcription request
+# Only WAV files are split into segments, other formats must fit in one request
+GROQ_MAX_FILE_BYTES = int(os.getenv('GROQ_MAX_FILE_MB', '25')) * 1024 * 1024
+
+class UploadFile:
+    """
+    Temp file an uploaded file part is streamed to, refusing non-WAV audio too large for Groq
+    
+    The first bytes tell whether the part is a WAV file (RIFF....WAVE). Other
+    formats cannot be segmented, so the upload is stopped with 413 as soon as
+    it passes GROQ_MAX_FILE_BYTES instead of after the whole body has arrived.
+    """
+    def __init__(self, file, max_bytes):
+        self.file = file
+        self.max_bytes = max_bytes
+        self.head = b''
+        self.size = 0
+    
+    def write(self, data):
+        self.size += len(data)
+        if len(self.head) < 12:
+            self.head += bytes(data[:12 - len(self.head)])
+        if self.size > self.max_bytes and not (self.head[:4] == b'RIFF' and self.head[8:12] == b'WAVE'):
+            raise RequestEntityTooLarge(f'Audio files other than WAV can be at most '
+                                        f'{self.max_bytes // (1024 * 1024)}MB')
+        return self.file.write(data)
+    
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class UploadRequest(Request):
+    """
+    Request class that streams uploaded files straight into the uploads folder
+    
+    Werkzeug writes each file part of a multipart body to the file returned
+    here as it parses the request, so an upload is written to disk once, in
+    bounded chunks, and never held in memory as a whole. Files that are not
+    claimed by stage_upload() are removed when the request ends.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload_file = tempfile.NamedTemporaryFile(dir=upload_folder(), prefix='temp_', delete=False)
+        if not hasattr(self, 'upload_temp_paths'):
+            self.upload_temp_paths = []
+        self.upload_temp_paths.append(upload_file.name)
+        return UploadFile(upload_file, GROQ_MAX_FILE_BYTES)
+
+def upload_folder():
+    """
+    Return the uploads folder, creating it if it does not exist yet
+    Used where an upload is first written to disk; later temp files of the
+    same upload (segments, preprocessed audio) go next to it
+    """
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    return UPLOAD_FOLDER
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = UploadRequest
 # Secret key for session management and CSRF protection
 
-# 50MB limit for file uploads - adjust as needed for larger audio files
-app.config['MAX_CONTENT_LENGTH'] = 30 * 1024 * 1024  
+# Upload size limit - long WAV recordings are transcribed in segments,
+# so uploads may be larger than the per-request limit of the Groq API
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', '100')) * 1024 * 1024
+
+# Base64 recordings are posted as a form field, allow them up to the upload limit
+app.config['MAX_FORM_MEMORY_SIZE'] = app.config['MAX_CONTENT_LENGTH']
+
+# Chunked transcription settings for long recordings
+# Segments are transcribed in parallel and overlap slightly so no words are lost at the cuts
+SEGMENT_SECONDS = float(os.getenv('TRANSCRIBE_SEGMENT_SECONDS', '300'))
+SEGMENT_OVERLAP_SECONDS = float(os.getenv('TRANSCRIBE_OVERLAP_SECONDS', '2'))
+SEGMENT_MAX_BYTES = int(os.getenv('TRANSCRIBE_SEGMENT_MAX_MB', '20')) * 1024 * 1024
+TRANSCRIBE_WORKERS = int(os.getenv('TRANSCRIBE_WORKERS', '4'))
+
+# Audio preprocessing before transcription (WAV uploads only, needs NumPy)
+# Audio is downmixed to mono, resampled and trimmed of leading and trailing silence
+AUDIO_PREPROCESS = os.getenv('AUDIO_PREPROCESS', '1') == '1'
+AUDIO_TARGET_RATE = int(os.getenv('AUDIO_TARGET_RATE', '16000'))
+AUDIO_TRIM_DB = float(os.getenv('AUDIO_TRIM_DB', '-45'))
+# Optional compressed format for short recordings (flac, mp3 or ogg), requires ffmpeg
+AUDIO_REENCODE = os.getenv('AUDIO_REENCODE', '')
+
+# Supabase client, created on first use
+supabase_client = LazyClient(create_supabase_client)
+
+# Async Supabase client for the /async routes, created on the async job queue's event loop
+async_supabase_client = None
+
+async def get_async_supabase_client():
+    """
+    Return the async Supabase client, creating it on first use
+    """
+    global async_supabase_client
+    if async_supabase_client is None:
+        async_supabase_client = await create_async_supabase_client()
+    return async_supabase_client
+
+class DatabaseUnavailableError(Exception):
+    """
+    Raised instead of calling Supabase while the database circuit breaker is open
+    """
+
+def db_execute(stage, query):
+    """
+    Execute a Supabase query as a timed stage named db_<stage>
+    Queries are only sent on execute(), so the timing covers the round trip
+    Connection failures are reported to the database circuit breaker
+    """
+    if database_breaker.is_open:
+        raise DatabaseUnavailableError('Database is temporarily unavailable')
+    with timed(f'db_{stage}'):
+        try:
+            result = query.execute()
+        except Exception as e:
+            if is_connection_error(e):
+                database_breaker.record_failure()
+            raise
+    database_breaker.record_success()
+    return result
+
+async def db_execute_async(stage, query):
+    """
+    Async version of db_execute() for queries built on the async Supabase client
+    """
+    if database_breaker.is_open:
+        raise DatabaseUnavailableError('Database is temporarily unavailable')
+    with timed(f'db_{stage}'):
+        try:
+            result = await query.execute()
+        except Exception as e:
+            if is_connection_error(e):
+                database_breaker.record_failure()
+            raise
+    database_breaker.record_success()
+    return result
+
+# Indexes for the queries issued by the routes, printed with the setup instructions
+# The preview column is optional; the dashboard shows previews once it exists
+INDEX_RECOMMENDATIONS = """
+-- Dashboard keyset pagination (newest transcriptions of one user first)
+CREATE INDEX IF NOT EXISTS transcriptions_user_created_idx
+    ON transcriptions (user_id, created_at DESC, id DESC);
 
-# Create uploads folder if it doesn't exist
-# This folder is used for temporary storage of audio files
-if not os.path.exists('uploads'):
-    os.makedirs('uploads')
+-- Short summary preview for the dashboard list, so it never reads the full text
+ALTER TABLE transcriptions ADD COLUMN IF NOT EXISTS preview text
+    GENERATED ALWAYS AS (left(summary, 200)) STORED;
 
-# Import database connection after app initialization
-# This prevents circular import issues
-from database import supabase_client , create_tables
+-- Summary HTML rendered once when the transcription is saved
+ALTER TABLE transcriptions ADD COLUMN IF NOT EXISTS summary_html text;
 
-# Print table creation instructions and verify database setup
-create_tables()
+-- Admin user listing: default sort and prefix search on email and name
+CREATE INDEX IF NOT EXISTS users_created_idx ON users (created_at DESC, id DESC);
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS users_email_trgm_idx ON users USING gin (email gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS users_name_trgm_idx ON users USING gin (name gin_trgm_ops);
+
+-- Atomic usage count increments, called with the buffered increments of many users at once
+CREATE OR REPLACE FUNCTION increment_usage_counts(deltas jsonb)
+RETURNS TABLE (id text, usage_count integer) LANGUAGE sql AS $$
+    UPDATE users SET usage_count = coalesce(users.usage_count, 0) + d.amount
+    FROM jsonb_to_recordset(deltas) AS d(user_id text, amount integer)
+    WHERE users.id::text = d.user_id
+    RETURNING users.id::text, users.usage_count;
+$$;
+"""
 
 # Set database_available flag - we'll use this to conditionally enable/disable features
 # The application can work in local-only mode without authentication if the database
 # is not configured, providing a fallback for users who don't have Supabase set up
-database_available = True
-try:
-    # Try to access a table to see if the database is configured
-    supabase_client.table('users').select('count', count='exact').limit(1).execute()
-except Exception as e:
-    database_available = False
-    print(f"WARNING: Database not available: {e}")
-    print("Running in local-only mode (no authentication or history saving)")
-    print("Follow the instructions above to set up Supabase tables")
+# Without SUPABASE_URL and SUPABASE_KEY the app starts in local-only mode; otherwise it
+# starts in authenticated mode and the circuit breaker switches the flag at runtime,
+# as soon as the first health probe finds the database missing
+DATABASE_CONFIGURED = bool(os.getenv('SUPABASE_URL') and os.getenv('SUPABASE_KEY'))
+database_available = DATABASE_CONFIGURED
+
+# Users and transcriptions are read and written through a storage interface
+# Logged-in users are stored in Supabase; the optional preview and summary_html
+# columns are detected once the database is reachable. A single-user install
+# without Supabase keeps its history in an embedded SQLite file under
+# LOCAL_USER_ID instead. It is never used during an outage of a configured
+# database, where visitors would share one history
+supabase_storage = SupabaseStorage(supabase_client, db_execute)
+local_storage = None if DATABASE_CONFIGURED else create_local_storage()
+LOCAL_USER_ID = 'local'
+
+def setup_database():
+    """
+    Print table creation instructions and index recommendations
+    Runs once on the health monitor thread, before the first probe
+    """
+    from database import create_tables
+    create_tables()
+    print("Recommended indexes (run in the Supabase SQL editor):" + INDEX_RECOMMENDATIONS)
+
+def probe_database():
+    """
+    Health probe: a cheap query against the users table
+    Bypasses the circuit breaker so it can close it again after an outage
+    """
+    with timed('db_health_probe'):
+        supabase_client.table('users').select('count', count='exact').limit(1).execute()
+    if not supabase_storage.columns_checked:
+        supabase_storage.detect_columns()
+
+def set_database_available(available):
+    """
+    Circuit breaker callback: switch between authenticated and local-only mode
+    """
+    global database_available
+    database_available = available
+    database_up.set(1 if available else 0)
+    if available:
+        print("Database available again, authentication and history saving enabled")
+    else:
+        print(f"WARNING: Database not available: {database_monitor.last_error or 'repeated connection failures'}")
+        print("Running in local-only mode (no authentication or history saving)")
+        print("Follow the table setup instructions to set up Supabase tables")
+
+database_up = REGISTRY.gauge('staky_database_available', 'Whether the database circuit breaker is closed')
+database_up.set(1 if database_available else 0)
+
+# Circuit breaker and background health probe for the database
+# The probe starts with the first request so importing main.py stays free of network calls
+database_breaker = CircuitBreaker(failure_threshold=int(os.getenv('DB_FAILURE_THRESHOLD', '3')),
+                                  on_change=set_database_available, is_open=not DATABASE_CONFIGURED)
+database_monitor = HealthMonitor(probe_database, database_breaker,
+                                 interval=float(os.getenv('DB_HEALTH_INTERVAL', '30')),
+                                 open_interval=float(os.getenv('DB_HEALTH_OPEN_INTERVAL', '5')),
+                                 setup=setup_database, name='staky-db-health')
+if not DATABASE_CONFIGURED:
+    print("SUPABASE_URL and SUPABASE_KEY are not set, running in local-only mode")
+
+# Usage accounting: increments are buffered and flushed atomically in batches,
+# and the free trial check reads the stored counts through a short-TTL cache
+usage_accounting = create_usage_accounting(supabase_storage.increment_usage, supabase_storage.usage_count)
+
+# Dashboard list settings
+# Pages are fetched with keyset pagination on (created_at, id) and only the list columns
+DASHBOARD_PAGE_SIZE = int(os.getenv('DASHBOARD_PAGE_SIZE', '20'))
+DASHBOARD_COLUMNS = 'id, filename, created_at'
+
+# Admin user listing settings
+# Users are paged, sorted and searched in the database; totals are cached per search
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', '50'))
+ADMIN_COLUMNS = 'id, name, email, created_at, usage_count, is_admin'
+ADMIN_SORT_COLUMNS = ('created_at', 'email', 'name', 'usage_count')
+ADMIN_SEARCH_RESERVED = ',()"*%\\'
+ADMIN_COUNT_TTL = int(os.getenv('ADMIN_COUNT_TTL', '60'))
+user_counts = {}
+user_counts_lock = threading.Lock()
+
+# Admission control in front of the Groq calls
+# Per-user token buckets per tier plus a concurrency cap with a bounded wait queue
+admission = create_admission_controller()
+
+# Background worker pool for job-mode uploads
+# Transcription jobs run here so the upload request can return immediately
+job_queue = create_job_queue()
+
+# Event loop for the /async routes, started with the first async upload
+async_job_queue = create_async_job_queue()
+
+# Recordings being uploaded from the browser in binary chunks
+# Live PCM recordings are transcribed window by window on live_executor while recording,
+# preprocessed and routed like uploaded audio
+live_executor = ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS, thread_name_prefix='staky-live')
+recording_store = RecordingStore(UPLOAD_FOLDER, app.config['MAX_CONTENT_LENGTH'],
+                                 idle_ttl=int(os.getenv('RECORDING_IDLE_TTL', '1800')),
+                                 transcribe=lambda filename, path: transcribe_audio(filename, path),
+                                 executor=live_executor,
+                                 window_seconds=float(os.getenv('LIVE_WINDOW_SECONDS', '30')),
+                                 overlap_seconds=SEGMENT_OVERLAP_SECONDS,
+                                 max_open=int(os.getenv('RECORDING_MAX_OPEN', '2')),
+                                 max_file_bytes=GROQ_MAX_FILE_BYTES)
+
+# Batch uploads: files of one batch are processed concurrently on batch_executor
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '4'))
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '20'))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='staky-batch')
+
+# Uploads waiting for their result page to open the /stream/<id> event stream
+# Entries are consumed by the first stream request and expire after STREAM_TTL seconds;
+# expired entries are swept at the start of a request, at most once a minute
+pending_streams = {}
+pending_streams_lock = threading.Lock()
+pending_streams_pruned_at = 0.0
+STREAM_TTL = 600
+
+# Map-reduce summarization settings
+# Transcripts longer than SUMMARY_CHUNK_TOKENS are split and the chunks summarized in parallel
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', '5000'))
+SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', '4'))
+
+# Groq models used for transcription and summarization when a call is not routed
+TRANSCRIPTION_MODEL = "whisper-large-v3-turbo"
+SUMMARY_MODEL = "llama3-70b-8192"
+
+# Latency-tiered model routing: models are picked per upload by audio duration and transcript size
+# Short transcripts go to a small fast model, long ones to the 70B model with map-reduce
+model_router = create_model_router()
+
+# Cache of transcription and summary results keyed by audio content and models
+# Re-uploads of the same recording are answered without calling Groq again
+result_cache = create_cache()
+
+# Full-text index of saved transcriptions, updated whenever transcriptions are saved
+# and synced from the database before a search, for transcriptions saved on other servers
+search_index = create_search_index()
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '20'))
+SEARCH_BACKFILL_PAGE_SIZE = int(os.getenv('SEARCH_BACKFILL_PAGE_SIZE', '500'))
+SEARCH_SYNC_INTERVAL = float(os.getenv('SEARCH_SYNC_INTERVAL', '30'))
+# Transcriptions saved late with an earlier created_at (clock skew, slow inserts) are
+# picked up by re-reading this many seconds before the sync cursor
+SEARCH_SYNC_OVERLAP = float(os.getenv('SEARCH_SYNC_OVERLAP', '60'))
+
+# Transcription export: rows read per database request while the export streams
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '200'))
+EXPORT_COLUMNS = 'id, filename, created_at, summary, raw_transcription'
+
+# Rendered HTML of summaries saved before summary_html was stored, keyed by summary hash
+summary_html_cache = MemoryCache(max_bytes=int(os.getenv('SUMMARY_HTML_CACHE_MB', '16')) * 1024 * 1024,
+                                 ttl=int(os.getenv('SUMMARY_HTML_CACHE_TTL', '86400')))
+
+# System prompt used for every summary request
+SUMMARY_PROMPT = "summarize the given data in in a well arranged manner. use headings and subheadings without overdoing it and make sure they are the best posible way to summarize the given data. do not use hr elements. do not include any message from your side. you are dealing with important data so make sure that you dont miss any inportant details in it.give your answer in markdown format "
+
+# Summary styles offered when re-summarizing a saved transcript
+# Each is the system prompt for a transcript that fits in one request
+SUMMARY_STYLES = {
+    "default": SUMMARY_PROMPT,
+    "brief": "summarize the given data in at most five short bullet points in markdown. keep only the most important points, decisions and numbers. do not include any message from your side.",
+    "detailed": "write a detailed summary of the given data in markdown, following the order of the discussion. use a heading for each topic and keep every detail, name and number. do not use hr elements. do not include any message from your side.",
+    "action_items": "extract every action item, decision and open question from the given data as markdown lists under the headings Action Items, Decisions and Open Questions. include owners and deadlines when they are mentioned. do not include any message from your side.",
+    "executive": "write an executive summary of the given data in markdown: one short paragraph with the outcome, followed by the key points and the next steps as bullet lists. do not use hr elements. do not include any message from your side.",
+}
+
+# Final merge prompt per style for transcripts summarized with map-reduce
+SUMMARY_STYLE_REDUCE_PROMPTS = {
+    style: (summarizer.REDUCE_PROMPT if style == "default" else
+            "you are given partial summaries of consecutive parts of one transcript. treat them together as the given data. " + prompt)
+    for style, prompt in SUMMARY_STYLES.items()
+}
 
 # Login required decorator for protected routes
 # This decorator ensures users are authenticated before accessing protected pages
@@ -77,6 +426,32 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# History routes work for logged-in users and, in local-only mode, for the local history
+def history_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if history_user_id() is None:
+            flash('Please log in to access this page', 'warning')
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def history_user_id():
+    """
+    User whose transcriptions the current request reads and saves
+    Without Supabase configured this is LOCAL_USER_ID, the history in local
+    storage; otherwise the logged-in user, or None
+    """
+    if local_storage is not None:
+        return LOCAL_USER_ID
+    return session.get('user_id')
+
+def storage_for(user_id):
+    """
+    Storage holding a user's transcriptions
+    """
+    return local_storage if user_id == LOCAL_USER_ID else supabase_storage
+
 @app.route("/")
 def index():
     """
@@ -108,22 +483,25 @@ def register():
         try:
             # Register user with Supabase Auth
             # This creates the authentication record
-            auth_response = supabase_client.auth.sign_up({
-                "email": email,
-                "password": password,
-            })
+            with timed('db_auth_sign_up'):
+                auth_response = supabase_client.auth.sign_up({
+                    "email": email,
+                    "password": password,
+                })
             
             # Create a user record in our custom table
             # This stores additional user information like name
             user_id = auth_response.user.id
-            supabase_client.table('users').insert({
+            supabase_storage.insert_user({
                 "id": user_id,
                 "name": name,
                 "email": email,
                 "created_at": datetime.datetime.now().isoformat(),
                 "usage_count": 0,
                 "is_admin": False
-            }).execute()
+            })
+            with user_counts_lock:
+                user_counts.clear()
             
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('login'))
@@ -146,10 +524,11 @@ def login():
         try:
             # Sign in user with Supabase Auth
             # Handles authentication and password validation
-            auth_response = supabase_client.auth.sign_in_with_password({
-                "email": email,
-                "password": password
-            })
+            with timed('db_auth_sign_in'):
+                auth_response = supabase_client.auth.sign_in_with_password({
+                    "email": email,
+                    "password": password
+                })
             
             # Set session data for the authenticated user
             # This maintains the user's logged-in state
@@ -159,11 +538,11 @@ def login():
             
             # Get user details from our database
             # Retrieve additional user information from the users table
-            user_data = supabase_client.table('users').select('name, usage_count, is_admin').eq('id', user_id).execute()
-            if user_data.data:
-                session['name'] = user_data.data[0].get('name', '')
-                session['usage_count'] = user_data.data[0].get('usage_count', 0)
-                session['is_admin'] = user_data.data[0].get('is_admin', False)
+            user = supabase_storage.get_user(user_id, 'name, usage_count, is_admin')
+            if user:
+                session['name'] = user.get('name', '')
+                usage_accounting.prime(user_id, user.get('usage_count') or 0)
+                session['is_admin'] = user.get('is_admin', False)
             
             flash('Login successful!', 'success')
             return redirect(url_for('dashboard'))
@@ -181,7 +560,8 @@ def logout():
     try:
         # Sign out from Supabase Auth
         # This invalidates the authentication token
-        supabase_client.auth.sign_out()
+        with timed('db_auth_sign_out'):
+            supabase_client.auth.sign_out()
     except:
         # If Supabase signout fails, we'll still clear the session
         pass
@@ -192,24 +572,57 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route("/dashboard")
-@login_required
+@history_required
 def dashboard():
     """
     User dashboard route
     Shows user's previously saved transcriptions
-    Protected by login_required decorator
+    Protected by history_required, so the local history is shown in local-only mode
     """
-    # Get user's previous transcriptions from the database
+    # Get one page of the user's previous transcriptions from storage
     try:
-        user_id = session['user_id']
-        # Query the transcriptions table for this user's records
-        # Order by creation date (newest first)
-        transcriptions = supabase_client.table('transcriptions').select('*').eq('user_id', user_id).order('created_at', desc=True).execute()
-        return render_template('dashboard.html', transcriptions=transcriptions.data)
+        user_id = history_user_id()
+        storage = storage_for(user_id)
+        columns = DASHBOARD_COLUMNS + (', preview' if storage.preview_available else '')
+        
+        # Continue after the last row of the previous page
+        cursor = decode_dashboard_cursor(request.args.get('cursor', ''))
+        
+        # Newest first, fetching one extra row to see if there is a next page
+        rows = storage.list_transcriptions(user_id, columns, DASHBOARD_PAGE_SIZE + 1, before=cursor)
+        next_url = None
+        if len(rows) > DASHBOARD_PAGE_SIZE:
+            rows = rows[:DASHBOARD_PAGE_SIZE]
+            next_url = url_for('dashboard', cursor=encode_dashboard_cursor(rows[-1]))
+        return render_template('dashboard.html', transcriptions=rows, next_url=next_url,
+                               first_url=url_for('dashboard') if cursor else None)
     except Exception as e:
         flash(f'Error retrieving your transcriptions: {str(e)}', 'danger')
         # If database query fails, render an empty dashboard
-        return render_template('dashboard.html', transcriptions=[])
+        return render_template('dashboard.html', transcriptions=[], next_url=None, first_url=None)
+
+def encode_dashboard_cursor(row):
+    """
+    Opaque cursor pointing after a dashboard row
+    """
+    data = json.dumps([row['created_at'], str(row['id'])]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+def decode_dashboard_cursor(cursor):
+    """
+    Return (created_at, id) from a dashboard cursor, or None if it is missing or invalid
+    Both values are validated because they are placed in the PostgREST filter
+    """
+    if not cursor:
+        return None
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        datetime.datetime.fromisoformat(created_at)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(row_id, str) or not row_id.replace('-', '').isalnum():
+        return None
+    return created_at, row_id
 
 @app.route("/workshop")
 def workshop():
@@ -224,253 +637,1794 @@ def workshop():
         return redirect(url_for('login'))
     return render_template('workshop.html')
 
-@app.route("/file_upload", methods=['POST'])
-def file_upload():
+def transcribe_file(filename, audio_path, model=TRANSCRIPTION_MODEL):
     """
-    File upload and processing route
-    Handles audio file uploads or browser recordings
-    Processes audio files through Groq API for transcription and summarization
-    Saves results to database if available and user is logged in
+    Transcribe a single audio file with Groq/Whisper in one request
+    Returns the transcription text
+    """
+    with open(audio_path, 'rb') as audio_file, timed('whisper'):
+        transcription = client.audio.transcriptions.create(
+            file=(filename, audio_file),
+            model=model,
+            timeout=GROQ_TRANSCRIBE_TIMEOUT
+        )
+    return transcription.text
+
+def transcribe_audio(filename, audio_path):
+    """
+    Preprocess and transcribe an audio file
     
-    Free trial users are limited to 1 transcription before being prompted to upgrade
-    Admin users have unlimited transcriptions
+    WAV files are shrunk first (mono, 16kHz, silence trimmed and optionally
+    re-encoded) so less audio is uploaded to Whisper. Other formats, or WAV
+    files that cannot be preprocessed, are transcribed as received.
+    The Whisper model is picked by model_router from the prepared audio's duration.
     """
-    # Only require login if database is available
-    if database_available and 'user_id' not in session:
-        flash('Please log in to access this page', 'warning')
-        return redirect(url_for('login'))
+    prepared_name, prepared_path = prepare_audio(filename, audio_path)
+    try:
+        with model_router.transcription(audio_duration(prepared_path)) as decision:
+            return transcribe_segmented(prepared_name, prepared_path, decision.model)
+    finally:
+        if prepared_path != audio_path:
+            remove_temp_file(prepared_path)
+
+def prepare_audio(filename, audio_path):
+    """
+    Preprocess a WAV file for transcription
+    Returns (filename, path) of the audio to send; if path is not audio_path
+    it is a new temp file that the caller must remove
+    """
+    if not AUDIO_PREPROCESS:
+        return filename, audio_path
     
-    # Check usage limits if database is available and user is logged in
-    if database_available and 'user_id' in session:
-        # Skip usage check for admin users
-        is_admin = session.get('is_admin', False)
-        if not is_admin:
-            # Get current usage count from session
-            usage_count = session.get('usage_count', 0)
-            
-            # If user has already used their free trial, redirect to pricing
-            if usage_count >= 1:
-                flash('You have used your free trial. Please upgrade to continue using Staky AI.', 'warning')
-                return redirect(url_for('pricing'))
+    with timed('preprocess'):
+        prepared_path = preprocess_wav(audio_path, UPLOAD_FOLDER, target_rate=AUDIO_TARGET_RATE, trim_db=AUDIO_TRIM_DB)
+    if prepared_path is None:
+        return filename, audio_path
     
     try:
-        # Handle both file uploads and browser recordings
-        # Two input methods are supported: traditional file upload and in-browser recording
-        if 'file' in request.files:
-            # Regular file upload from device
-            file = request.files['file']
-            
-            if not file:
-                flash('No file selected', 'danger')
-                return redirect(url_for('workshop'))
-            
-            filename = file.filename
-            file_content = file.read()
-            
-        elif 'recorded_audio' in request.form:
-            # Browser recording (base64 encoded)
-            # This allows users to record audio directly in the browser
-            import base64
-            
-            # Get base64 data and convert to bytes for processing
-            base64_audio = request.form['recorded_audio']
-            file_content = base64.b64decode(base64_audio)
-            filename = request.form.get('recorded_filename', 'browser-recording.wav')
-            
-        else:
-            flash('No audio data provided', 'danger')
-            return redirect(url_for('workshop'))
+        # Compressed files cannot be segmented, so only re-encode audio short enough for one request
+        if AUDIO_REENCODE and wav_duration(prepared_path) <= SEGMENT_SECONDS:
+            with timed('reencode'):
+                encoded_path = reencode_audio(prepared_path, AUDIO_REENCODE)
+            if encoded_path:
+                remove_temp_file(prepared_path)
+                prepared_path = encoded_path
         
-        # Save the file temporarily for processing
-        # Using a timestamped filename to avoid collisions
-        temp_path = os.path.join('uploads', f"temp_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}")
-        with open(temp_path, 'wb') as f:
-            f.write(file_content)
-        
-        # Create a transcription of the audio file using Groq/Whisper
-        with open(temp_path, 'rb') as audio_file:
-            transcription = client.audio.transcriptions.create(
-                file=(filename, audio_file),
-                model="whisper-large-v3-turbo"
-            )
+        original_size = os.path.getsize(audio_path)
+        prepared_size = os.path.getsize(prepared_path)
+        saved = original_size - prepared_size
+        print(f"Audio preprocessing: {original_size} -> {prepared_size} bytes "
+              f"({saved} bytes saved, {100.0 * saved / max(original_size, 1):.1f}%)")
+    except Exception:
+        remove_temp_file(prepared_path)
+        raise
+    
+    base, _ = os.path.splitext(filename)
+    _, extension = os.path.splitext(prepared_path)
+    return base + extension, prepared_path
+
+def segment_length(audio_path):
+    """
+    Length in seconds of the segments a recording is split into for transcription
+    Returns None if the file is sent in a single request
+    """
+    if not is_wav(audio_path):
+        return None
+    
+    # Keep each segment comfortably under the Groq per-request file size limit
+    file_size = os.path.getsize(audio_path)
+    duration = wav_duration(audio_path)
+    if duration <= 0:
+        return None
+    max_seconds = SEGMENT_MAX_BYTES / (file_size / duration)
+    segment_seconds = min(SEGMENT_SECONDS, max_seconds)
+    if duration <= segment_seconds:
+        return None
+    return segment_seconds
+
+def transcribe_segmented(filename, audio_path, model=TRANSCRIPTION_MODEL):
+    """
+    Transcribe an audio file, splitting long WAV recordings into segments
+    
+    Long WAV files are cut into overlapping segments at quiet points, the
+    segments are transcribed concurrently and the texts are joined back in
+    order. Other formats and short recordings are sent in a single request.
+    """
+    segment_seconds = segment_length(audio_path)
+    if segment_seconds is None:
+        return transcribe_file(filename, audio_path, model)
+    
+    segment_dir = tempfile.mkdtemp(dir=UPLOAD_FOLDER)
+    try:
+        segment_paths = split_wav(audio_path, segment_dir, segment_seconds,
+                                  overlap_seconds=SEGMENT_OVERLAP_SECONDS)
+        base, _ = os.path.splitext(filename)
+        segment_names = [f"{base}_part{index:03d}.wav" for index in range(len(segment_paths))]
         
-        # Clean up the temp file after processing
-        try:
-            os.remove(temp_path)
-        except:
-            # Non-critical failure, we can continue even if cleanup fails
-            pass
-            
-        # Generate summary with Groq LLM
-        # Using llama3-70b model to analyze and summarize the transcription
+        # executor.map keeps the results in segment order
+        with ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS) as executor:
+            texts = list(executor.map(transcribe_file, segment_names, segment_paths,
+                                      [model] * len(segment_paths)))
+        return merge_segment_texts(texts)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+def complete_chat(system_prompt, text, model=SUMMARY_MODEL, decision=None):
+    """
+    Run one chat completion with the summary model and return the reply
+    The token usage is added to decision, if given, for its cost
+    """
+    with timed('llama'):
         chat_completion = client.chat.completions.create(
             messages=[
                 {
                     "role": "system",
-                    "content": "summarize the given data in in a well arranged manner. use headings and subheadings without overdoing it and make sure they are the best posible way to summarize the given data. do not use hr elements. do not include any message from your side. you are dealing with important data so make sure that you dont miss any inportant details in it.give your answer in markdown format ",
+                    "content": system_prompt,
                 },
                 {
                     "role": "user",
-                    "content": transcription.text,
+                    "content": text,
                 }
             ],
-            model="llama3-70b-8192",
+            model=model,
         )
-        
-        result = chat_completion.choices[0].message.content
-        
-        # Save transcription to database and update usage count if available and user is logged in
-        if database_available and 'user_id' in session:
-            try:
-                user_id = session['user_id']
-                is_admin = session.get('is_admin', False)
-                
-                # Save the transcription to the database
-                transcription_data = {
-                    "user_id": user_id,
-                    "filename": filename,
-                    "raw_transcription": transcription.text,
-                    "summary": result,
-                    "created_at": datetime.datetime.now().isoformat()
-                }
-                supabase_client.table('transcriptions').insert(transcription_data).execute()
-                
-                # Update usage count for non-admin users
-                if not is_admin:
-                    # Get current usage count
-                    current_usage = session.get('usage_count', 0)
-                    new_usage = current_usage + 1
-                    
-                    # Update in database
-                    supabase_client.table('users').update({"usage_count": new_usage}).eq('id', user_id).execute()
-                    
-                    # Update in session
-                    session['usage_count'] = new_usage
-                    
-            except Exception as db_error:
-                print(f"Warning: Could not save to database or update usage: {db_error}")
-                # Continue anyway - we'll still show the result to the user
-                # This ensures core functionality even if database saving fails
-        
-        # Render result page with both the summary and raw transcription
-        # The summary is rendered as markdown for better formatting
-        return render_template('result.html', result=markdown.markdown(result), raw_text=transcription.text)
-    
-    except Exception as e:
-        # Comprehensive error handling to improve user experience
-        error_message = str(e)
-        flash(f'Error processing file: {error_message}', 'danger')
-        print(f"Error in file_upload: {error_message}")
-        return redirect(url_for('workshop'))
+    add_chat_usage(decision, chat_completion.usage)
+    return chat_completion.choices[0].message.content
 
-@app.route("/transcription/<id>")
-@login_required
-def view_transcription(id):
+def add_chat_usage(decision, usage):
     """
-    View a single saved transcription
-    Retrieves a specific transcription from the database
-    Ensures users can only view their own transcriptions
+    Add the token usage reported by Groq to a routing decision
+    """
+    if decision is not None and usage is not None:
+        decision.add_usage(usage.prompt_tokens, usage.completion_tokens)
+
+def summarize_transcript(text, style='default'):
     """
+    Generate a markdown summary of a transcription with Groq LLM
+    The model and chunk size are picked by model_router from the transcript size
+    Transcripts larger than the model context are summarized with map-reduce
+    style selects one of SUMMARY_STYLES
+    """
+    timings = {}
+    with timed('summarize'), model_router.summary(summarizer.estimate_tokens(text)) as decision:
+        complete = partial(complete_chat, model=decision.model, decision=decision)
+        summary = summarizer.summarize(complete, text, SUMMARY_STYLES[style],
+                                       chunk_tokens=decision.chunk_tokens or SUMMARY_CHUNK_TOKENS,
+                                       workers=SUMMARY_WORKERS, timings=timings,
+                                       reduce_prompt=SUMMARY_STYLE_REDUCE_PROMPTS[style])
+    log_summary_timings(timings)
+    return summary
+
+def complete_chat_stream(system_prompt, text, model=SUMMARY_MODEL, decision=None):
+    """
+    Run one streaming chat completion and yield the reply tokens as they arrive
+    The llama_stream stage covers the whole request, from sending it to the last token
+    Groq reports the token usage with the last chunk (x_groq.usage), added to decision
+    """
+    start = time.perf_counter()
+    error = True
     try:
-        user_id = session['user_id']
-        
-        # Get transcription from database with security check
-        # The user_id filter ensures users can only access their own data
-        transcription = supabase_client.table('transcriptions').select('*').eq('id', id).eq('user_id', user_id).execute()
-        
-        if not transcription.data:
-            flash('Transcription not found or access denied', 'danger')
-            return redirect(url_for('dashboard'))
-        
-        # Render the same result template used for new transcriptions
-        # This provides a consistent user experience
-        return render_template('result.html', 
-                             result=markdown.markdown(transcription.data[0]['summary']), 
-                             raw_text=transcription.data[0]['raw_transcription'])
-    
-    except Exception as e:
-        flash(f'Error retrieving transcription: {str(e)}', 'danger')
-        return redirect(url_for('dashboard'))
+        stream = client.chat.completions.create(
+            messages=[
+                {
+                    "role": "system",
+                    "content": system_prompt,
+                },
+                {
+                    "role": "user",
+                    "content": text,
+                }
+            ],
+            model=model,
+            stream=True,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            x_groq = getattr(chunk, 'x_groq', None)
+            add_chat_usage(decision, getattr(x_groq, 'usage', None))
+        error = False
+    finally:
+        record_stage('llama_stream', time.perf_counter() - start, error)
 
-@app.route("/profile")
-@login_required
-def profile():
+def stream_summary(text):
     """
-    User profile page
-    Shows user information and allows editing name
-    Protected by login_required decorator
+    Generate a markdown summary of a transcription, yielding tokens as they arrive
     """
-    return render_template('profile.html')
+    timings = {}
+    with model_router.summary(summarizer.estimate_tokens(text)) as decision:
+        yield from summarizer.summarize_stream(
+            partial(complete_chat, model=decision.model, decision=decision),
+            partial(complete_chat_stream, model=decision.model, decision=decision),
+            text, SUMMARY_PROMPT, chunk_tokens=decision.chunk_tokens or SUMMARY_CHUNK_TOKENS,
+            workers=SUMMARY_WORKERS, timings=timings)
+    log_summary_timings(timings)
 
-@app.route("/update_profile", methods=['POST'])
-@login_required
-def update_profile():
+def log_summary_timings(timings):
     """
-    Update user profile information
-    Currently supports updating the user's name
-    Updates both the database record and the session data
+    Log per-stage summary latency and add the map and reduce passes to the metrics
+    """
+    for stage in ('map', 'reduce'):
+        if stage in timings:
+            record_stage(f'summary_{stage}', timings[stage])
+    print("Summary timings: " + ", ".join(
+        f"{stage}={value:.3f}s" if isinstance(value, float) else f"{stage}={value}"
+        for stage, value in timings.items()))
+
+def render_markdown(text):
+    """
+    Render a markdown summary to HTML for the result page
+    """
+    with timed('markdown'):
+        return markdown.markdown(text)
+
+def cached_summary_html(summary):
+    """
+    Rendered HTML for a stored summary that has no summary_html
+    Renders each distinct summary once and keeps it in an in-process LRU cache
+    """
+    key = hashlib.sha256(summary.encode('utf-8')).hexdigest()
+    cached = summary_html_cache.get(key)
+    if cached:
+        return cached['html']
+    html = render_markdown(summary)
+    summary_html_cache.set(key, {"html": html})
+    return html
+
+def save_transcription(user_id, is_admin, filename, raw_text, summary, summary_html=None, reservation=None):
+    """
+    Save a transcription to the database and count it towards the user's usage
+    summary_html is the rendered summary, stored so it is never rendered again
+    Returns the new usage count, or None if it did not change or is not known
+    Database errors are logged and swallowed so the result is still shown
     """
+    return save_transcriptions(user_id, is_admin,
+                               [transcription_row(user_id, filename, raw_text, summary, summary_html)],
+                               reservation)
+
+def transcription_row(user_id, filename, raw_text, summary, summary_html=None):
+    """
+    Build the transcriptions table row for one result
+    """
+    transcription_data = {
+        "user_id": user_id,
+        "filename": filename,
+        "raw_transcription": raw_text,
+        "summary": summary,
+        "created_at": datetime.datetime.now().isoformat()
+    }
+    if summary_html is not None:
+        transcription_data["summary_html"] = summary_html
+    return transcription_data
+
+def save_transcriptions(user_id, is_admin, rows, reservation=None):
+    """
+    Save transcription rows with one insert and count them towards the user's usage
+    The usage increment is buffered and written to the database by usage_accounting;
+    the reservation made by check_usage_limit() is committed with it, or released
+    if nothing was saved
+    Returns the new usage count, or None if it did not change or is not known
+    Database errors are logged and swallowed so the results are still shown
+    """
+    if not rows:
+        if reservation is not None:
+            reservation.release()
+        return None
     try:
-        user_id = session['user_id']
-        name = request.form.get('name')
+        # Save the transcriptions to the user's storage
+        inserted = storage_for(user_id).insert_transcriptions(rows)
+        index_transcriptions(inserted)
         
-        # Update user record in database
-        supabase_client.table('users').update({"name": name}).eq('id', user_id).execute()
-        
-        # Update session data to reflect the changes immediately
-        session['name'] = name
-        
-        flash('Profile updated successfully', 'success')
-    except Exception as e:
-        flash(f'Error updating profile: {str(e)}', 'danger')
+        # Count the transcriptions for non-admin users
+        if not is_admin and user_id != LOCAL_USER_ID:
+            if reservation is not None:
+                return reservation.commit(len(rows))
+            return usage_accounting.add(user_id, len(rows))
     
-    return redirect(url_for('profile'))
+    except Exception as db_error:
+        print(f"Warning: Could not save to database or update usage: {db_error}")
+        # Continue anyway - we'll still show the result to the user
+        # This ensures core functionality even if database saving fails
+    if reservation is not None:
+        reservation.release()
+    return None
 
-@app.route("/admin")
-@login_required
-def admin_panel():
+def index_transcriptions(rows):
     """
-    Admin panel for managing users
-    Only accessible to admin users
+    Add saved transcription rows (as returned by the insert) to the search index
+    Indexing errors are logged; the transcription is already saved
     """
-    # Check if user is an admin
-    if not session.get('is_admin', False):
-        flash('Access denied. Admin privileges required.', 'danger')
-        return redirect(url_for('dashboard'))
-    
+    if not rows:
+        return
     try:
-        # Get all users from the database
-        users = supabase_client.table('users').select('*').execute()
-        return render_template('admin.html', users=users.data)
+        with timed('search_index'):
+            search_index.add(rows)
     except Exception as e:
-        flash(f'Error retrieving user data: {str(e)}', 'danger')
-        return render_template('admin.html', users=[])
+        print(f"Warning: Could not index transcriptions for search: {e}")
 
-@app.route("/admin/toggle_admin/<user_id>", methods=['POST'])
-@login_required
-def toggle_admin_status(user_id):
+def stage_upload():
     """
-    Toggle admin status for a user
+    Move the uploaded audio from the current request into a temp file
+    Two input methods are supported: traditional file upload and in-browser recording
+    Returns (filename, temp_path), or None if the request carries no audio
+    
+    The caller owns the returned temp file and must remove it when done
+    """
+    if 'file' in request.files:
+        # Regular file upload from device
+        # UploadRequest has already streamed the file into the uploads folder
+        file = request.files['file']
+        
+        if not file:
+            return None
+        
+        return claim_upload(file)
+        
+    elif 'recorded_audio' in request.form:
+        # Browser recording (base64 encoded)
+        # This allows users to record audio directly in the browser
+        
+        # Decode the base64 data to disk in slices so no second full copy is made
+        # The slice length is a multiple of 4 so every slice decodes on its own
+        base64_audio = request.form['recorded_audio']
+        filename = request.form.get('recorded_filename', 'browser-recording.wav')
+        fd, temp_path = tempfile.mkstemp(dir=upload_folder(), prefix='temp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for start in range(0, len(base64_audio), UPLOAD_CHUNK_SIZE):
+                    f.write(base64.b64decode(base64_audio[start:start + UPLOAD_CHUNK_SIZE]))
+            if os.path.getsize(temp_path) > GROQ_MAX_FILE_BYTES and not is_wav(temp_path):
+                raise RequestEntityTooLarge(f'Audio files other than WAV can be at most '
+                                            f'{GROQ_MAX_FILE_BYTES // (1024 * 1024)}MB')
+        except Exception:
+            remove_temp_file(temp_path)
+            raise
+        return filename, temp_path
+        
+    else:
+        return None
+
+def claim_upload(file):
+    """
+    Take ownership of the temp file an uploaded file was streamed to
+    Returns (filename, temp_path); the caller must remove the temp file when done
+    """
+    filename = file.filename
+    temp_path = getattr(file.stream, 'name', None)
+    if temp_path in getattr(request, 'upload_temp_paths', []):
+        # Claim the file so it is not removed at the end of the request
+        file.close()
+        request.upload_temp_paths.remove(temp_path)
+        return filename, temp_path
+    
+    # Fall back to copying the upload stream to disk in chunks
+    file.stream.seek(0)
+    fd, temp_path = tempfile.mkstemp(dir=upload_folder(), prefix='temp_')
+    with os.fdopen(fd, 'wb') as f:
+        shutil.copyfileobj(file.stream, f, UPLOAD_CHUNK_SIZE)
+    file.close()
+    return filename, temp_path
+
+def remove_temp_file(temp_path):
+    """
+    Clean up a temp upload after processing
+    """
+    try:
+        os.remove(temp_path)
+    except OSError:
+        # Non-critical failure, we can continue even if cleanup fails
+        pass
+
+@app.teardown_request
+def remove_unclaimed_uploads(exception=None):
+    """
+    Remove uploaded files that were streamed to disk but never claimed
+    This covers every early return and error raised while handling the request
+    """
+    for temp_path in getattr(request, 'upload_temp_paths', []):
+        remove_temp_file(temp_path)
+
+@app.teardown_request
+def release_usage_reservation(exception=None):
+    """
+    Give up the usage reservation of an upload that was refused or failed in the request
+    Uploads processed in the background take the reservation with current_user_snapshot()
+    """
+    reservation = g.pop('usage_reservation', None)
+    if reservation is not None:
+        reservation.release()
+
+@app.before_request
+def start_background_services():
+    """
+    Start the database health probe and the usage flush thread with the first request
+    Requests are served right away in the configured mode; the first probe opens
+    the circuit breaker at once if the database turns out to be missing
+    """
+    if DATABASE_CONFIGURED:
+        database_monitor.start()
+    usage_accounting.start()
+
+@app.before_request
+def start_request_timing():
+    """
+    Count the request as in flight and start timing it
+    """
+    g.request_start = time.perf_counter()
+    g.in_flight = True
+    requests_in_flight.inc()
+
+@app.after_request
+def add_server_timing(response):
+    """
+    Record the request duration and report the stage timings to the browser
+    For streamed responses only the stages that ran before the body started are included
+    """
+    if 'request_start' in g:
+        timings = dict(g.get('server_timings', {}))
+        timings['total'] = time.perf_counter() - g.request_start
+        response.headers['Server-Timing'] = server_timing_header(timings)
+        endpoint = request.endpoint or 'unknown'
+        request_duration.observe(timings['total'], endpoint=endpoint)
+        requests_total.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_timing(exception=None):
+    """
+    Stop counting the request as in flight
+    Runs after streamed responses have sent their last event
+    """
+    if g.pop('in_flight', False):
+        requests_in_flight.dec()
+
+# Number of transcriptions included in the free trial
+FREE_TRIAL_TRANSCRIPTIONS = 1
+
+def check_usage_limit():
+    """
+    Return a redirect response if the current user may not transcribe, else None
+    Free trial users are limited to 1 transcription, admin users are unlimited
+    
+    The upload's usage is reserved here, so concurrent uploads cannot all pass
+    the check; the reservation is kept in g until current_user_snapshot() hands
+    it to the code that saves the result, and released if the request fails first
+    """
+    # Only require login if database is available
+    if database_available and 'user_id' not in session:
+        flash('Please log in to access this page', 'warning')
+        return redirect(url_for('login'))
+    
+    # Check usage limits if database is available and user is logged in
+    if database_available and 'user_id' in session:
+        # Skip usage check for admin users
+        is_admin = session.get('is_admin', False)
+        if not is_admin:
+            # Reserve against the usage cache, not the count in the session cookie
+            # If the count cannot be read the check is skipped, like when the database is unavailable
+            try:
+                reservation = usage_accounting.reserve(session['user_id'], FREE_TRIAL_TRANSCRIPTIONS)
+            except Exception as e:
+                print(f"Warning: Could not read usage count: {e}")
+                return None
+            
+            # If user has already used their free trial, redirect to pricing
+            if reservation is None:
+                flash('You have used your free trial. Please upgrade to continue using Staky AI.', 'warning')
+                return redirect(url_for('pricing'))
+            g.usage_reservation = reservation
+    return None
+
+def current_user_snapshot():
+    """
+    Copy the session fields needed to save a result outside the request
+    Returns None when results are not saved (not logged in, or local-only
+    mode without local storage)
+    Results of logged-in users are never saved to local storage, even during an outage
+    The snapshot takes over the request's usage reservation, which the caller
+    must commit by saving the result or give up with release_reservation()
+    """
+    if database_available and 'user_id' in session:
+        return {
+            "user_id": session['user_id'],
+            "is_admin": session.get('is_admin', False),
+            "reservation": g.pop('usage_reservation', None),
+        }
+    if local_storage is not None:
+        return {"user_id": LOCAL_USER_ID, "is_admin": False, "reservation": None}
+    return None
+
+def release_reservation(user):
+    """
+    Give up the usage reservation of a user snapshot whose result will not be saved
+    """
+    if user and user['reservation'] is not None:
+        user['reservation'].release()
+
+def result_cache_key(audio_path):
+    """
+    Cache key for an audio file processed with the current model routing policy
+    """
+    return cache_key(hash_file(audio_path), model_router.fingerprint)
+
+def transcribe_upload(filename, temp_path, job=None, transcript=None):
+    """
+    Transcribe a staged upload, or look it up in the result cache
+    The temp file is always removed; job (if given) is updated with the current stage
+    For live recordings transcript is a function returning the text that was
+    transcribed during the recording, and temp_path is None
+    Returns (raw_text, summary, key): summary is the cached summary or None, and key
+    is the result cache key for a new summary (None for live recordings)
+    """
+    if transcript is not None:
+        if job:
+            job.stage = 'transcribing'
+        with timed('transcribe_live'):
+            return transcript(), None, None
+    
+    try:
+        with timed('cache_lookup'):
+            key = result_cache_key(temp_path)
+            cached = result_cache.get(key)
+        if cached:
+            return cached['raw_text'], cached['summary'], key
+        
+        if job:
+            job.stage = 'transcribing'
+        with timed('transcribe'):
+            raw_text = transcribe_audio(filename, temp_path)
+    finally:
+        remove_temp_file(temp_path)
+    return raw_text, None, key
+
+def process_audio(filename, temp_path, job=None, transcript=None):
+    """
+    Transcribe and summarize a staged upload, using the result cache
+    Returns (raw_text, summary)
+    """
+    raw_text, summary, key = transcribe_upload(filename, temp_path, job, transcript)
+    if summary is None:
+        if job:
+            job.stage = 'summarizing'
+        summary = summarize_transcript(raw_text)
+        if key:
+            result_cache.set(key, {"raw_text": raw_text, "summary": summary})
+    return raw_text, summary
+
+def process_admitted(ticket, filename, temp_path, job=None, transcript=None):
+    """
+    Wait for an admission slot, then transcribe and summarize the upload
+    The temp file is removed even if no slot became free in time
+    """
+    if job:
+        job.stage = 'waiting'
+    try:
+        ticket.acquire()
+    except AdmissionRejected:
+        if temp_path:
+            remove_temp_file(temp_path)
+        raise
+    try:
+        return process_audio(filename, temp_path, job, transcript)
+    finally:
+        ticket.release()
+
+def run_transcription_job(job, filename, temp_path, user, transcript=None, ticket=None):
+    """
+    Background job: transcribe, summarize and save one upload
+    user is a snapshot of the uploader's session (or None in local-only mode)
+    because the worker thread has no access to the request session
+    """
+    try:
+        raw_text, summary = process_admitted(ticket, filename, temp_path, job, transcript)
+    except Exception:
+        release_reservation(user)
+        raise
+    summary_html = render_markdown(summary)
+    
+    new_usage = None
+    if user:
+        job.stage = 'saving'
+        new_usage = save_transcription(user['user_id'], user['is_admin'],
+                                       filename, raw_text, summary, summary_html, user['reservation'])
+    
+    return {"summary": summary, "summary_html": summary_html, "raw_text": raw_text, "usage_count": new_usage}
+
+@app.route("/file_upload", methods=['POST'])
+def file_upload():
+    """
+    File upload and processing route
+    Handles audio file uploads or browser recordings
+    Processes audio files through Groq API for transcription and summarization
+    Saves results to database if available and user is logged in
+    
+    mode is read from the query string (see upload_mode())
+    With mode=job the upload is queued for the background worker pool and
+    a JSON response with the job ID is returned immediately (HTTP 202)
+    With mode=stream the result page is returned immediately and the result
+    is delivered to it as Server-Sent Events from /stream/<id>
+    
+    Free trial users are limited to 1 transcription before being prompted to upgrade
+    Admin users have unlimited transcriptions
+    """
+    limit_response = check_usage_limit()
+    if limit_response:
+        return limit_response
+    
+    # The mode comes from the query string so the body is not parsed before admission
+    mode = upload_mode()
+    
+    # Refuse the upload right away if the user is over their limit or the queue is full
+    try:
+        ticket = reserve_admission()
+    except AdmissionRejected as e:
+        return admission_rejected_response(e, mode)
+    
+    job_mode = mode == 'job'
+    try:
+        if mode is None:
+            mode = request.form.get('mode')
+            job_mode = mode == 'job'
+        
+        # Covers parsing the multipart body and writing the audio to its temp file
+        # An upload refused here was never processed, so its token is given back
+        try:
+            with timed('upload'):
+                staged = stage_upload()
+        except Exception:
+            ticket.refund()
+            raise
+        if not staged:
+            ticket.refund()
+            flash('No audio data provided', 'danger')
+            return redirect(url_for('workshop'))
+        filename, temp_path = staged
+        return process_staged_upload(filename, temp_path, mode, ticket)
+    
+    except RequestEntityTooLarge:
+        # Answered with 413 like an upload over MAX_CONTENT_LENGTH
+        ticket.release()
+        raise
+    
+    except Exception as e:
+        # Comprehensive error handling to improve user experience
+        ticket.release()
+        error_message = str(e)
+        print(f"Error in file_upload: {error_message}")
+        if job_mode:
+            return jsonify({"error": error_message}), 500
+        flash(f'Error processing file: {error_message}', 'danger')
+        return redirect(url_for('workshop'))
+
+def upload_mode():
+    """
+    Processing mode of an upload (stream, job or None) from the query string or
+    the X-Upload-Mode header, which are available before the body is read
+    Older clients send mode as a form field, read only after admission
+    """
+    return request.args.get('mode') or request.headers.get('X-Upload-Mode')
+
+def process_staged_upload(filename, temp_path, mode, ticket, transcript=None):
+    """
+    Process audio that has been staged to a temp file, in the requested mode
+    
+    mode=stream - render the result page and stream the result to it
+    mode=job    - queue a background job and return its ID as JSON
+    otherwise   - process the audio now and render the result page
+    
+    Takes ownership of temp_path, which is removed once the audio is processed,
+    and of the admission ticket, which is released once Groq is done
+    Live recordings pass a transcript function instead of a temp file
+    """
+    if mode == 'stream':
+        stream_id = add_pending_stream(filename, temp_path, current_user_snapshot(), ticket, transcript)
+        return render_template('result.html', result='', raw_text='',
+                               stream_url=url_for('stream_result', stream_id=stream_id))
+    
+    if mode == 'job':
+        user = current_user_snapshot()
+        try:
+            job = job_queue.submit(run_transcription_job, filename, temp_path, user, transcript, ticket,
+                                   owner=session.get('user_id'))
+        except QueueFullError as e:
+            ticket.release()
+            release_reservation(user)
+            if temp_path:
+                remove_temp_file(temp_path)
+            return jsonify({"error": str(e)}), 503
+        return jsonify({
+            "job_id": job.id,
+            "status_url": url_for('job_status', job_id=job.id),
+            "result_url": url_for('job_result', job_id=job.id),
+        }), 202
+    
+    # Create a transcription and summary of the audio file using Groq
+    # Identical audio processed before is answered from the result cache
+    try:
+        raw_text, result = process_admitted(ticket, filename, temp_path, transcript=transcript)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e, mode)
+    
+    # The summary is rendered as markdown once, for the result page and for the database
+    result_html = render_markdown(result)
+    
+    # Save transcription to storage and update usage count if the user is logged in (or in local-only mode)
+    user = current_user_snapshot()
+    if user:
+        save_transcription(user['user_id'], user['is_admin'], filename, raw_text, result, result_html,
+                           user['reservation'])
+    
+    # Render result page with both the summary and raw transcription
+    return render_template('result.html', result=result_html, raw_text=raw_text)
+
+@app.route("/batch_upload", methods=['POST'])
+def batch_upload():
+    """
+    Batch upload route
+    Accepts many audio files (form field 'files'), transcribes and summarizes
+    them concurrently and streams one JSON line per file as each finishes
+    (application/x-ndjson). All results are saved with one bulk insert and
+    one usage count update when the batch is complete.
+    
+    Each line has index, filename and status ('done' with raw_text and
+    summary_html, or 'failed' with error); the last line has status 'complete'
+    """
+    limit_response = check_usage_limit()
+    if limit_response:
+        return limit_response
+    
+    files = [file for file in request.files.getlist('files') if file and file.filename]
+    if not files:
+        return jsonify({"error": "No audio files provided"}), 400
+    if len(files) > BATCH_MAX_FILES:
+        return jsonify({"error": f"At most {BATCH_MAX_FILES} files can be uploaded at once"}), 400
+    
+    # check_usage_limit() reserved one transcription, the rest of the batch is reserved here
+    reservation = g.get('usage_reservation')
+    if reservation is not None and not reservation.extend(len(files) - 1, FREE_TRIAL_TRANSCRIPTIONS):
+        return jsonify({"error": "This batch is larger than the transcriptions left on your plan"}), 403
+    
+    # Every file needs its own admission, refuse the whole batch if one is not admitted
+    tickets = []
+    try:
+        for _ in files:
+            tickets.append(reserve_admission())
+    except AdmissionRejected as e:
+        for ticket in tickets:
+            ticket.release()
+        return admission_rejected_response(e, 'job')
+    
+    staged = []
+    try:
+        with timed('upload'):
+            for file in files:
+                staged.append(claim_upload(file))
+    except Exception as e:
+        for ticket in tickets:
+            ticket.release()
+        for _, temp_path in staged:
+            remove_temp_file(temp_path)
+        return jsonify({"error": f"Error processing files: {e}"}), 500
+    
+    user = current_user_snapshot()
+    futures = {batch_executor.submit(process_batch_file, ticket, filename, temp_path): index
+               for index, (ticket, (filename, temp_path)) in enumerate(zip(tickets, staged))}
+    
+    def generate():
+        rows = []
+        pending = set(futures)
+        try:
+            for future in as_completed(futures):
+                pending.discard(future)
+                index = futures[future]
+                filename = staged[index][0]
+                try:
+                    raw_text, summary, summary_html = future.result()
+                except Exception as e:
+                    print(f"Error in batch_upload ({filename}): {e}")
+                    yield json.dumps({"index": index, "filename": filename, "status": "failed",
+                                      "error": str(e)}) + "\n"
+                    continue
+                if user:
+                    rows.append(transcription_row(user['user_id'], filename, raw_text, summary, summary_html))
+                yield json.dumps({"index": index, "filename": filename, "status": "done",
+                                  "raw_text": raw_text, "summary_html": summary_html}) + "\n"
+        finally:
+            # Results are saved even if the client went away before the batch finished
+            for future in pending:
+                try:
+                    raw_text, summary, summary_html = future.result()
+                except Exception:
+                    continue
+                if user:
+                    rows.append(transcription_row(user['user_id'], staged[futures[future]][0],
+                                                  raw_text, summary, summary_html))
+            if user:
+                save_transcriptions(user['user_id'], user['is_admin'], rows, user['reservation'])
+        yield json.dumps({"status": "complete", "saved": len(rows) if user else 0}) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def process_batch_file(ticket, filename, temp_path):
+    """
+    Process one file of a batch upload
+    Returns (raw_text, summary, summary_html)
+    """
+    raw_text, summary = process_admitted(ticket, filename, temp_path)
+    return raw_text, summary, render_markdown(summary)
+
+@app.route("/async/file_upload", methods=['POST'])
+def async_file_upload():
+    """
+    Async upload route
+    Stages the upload like /file_upload with mode=job, then transcribes,
+    summarizes and saves it on the async job queue's event loop with the
+    AsyncGroq client and async Supabase access. The request only holds a
+    worker while the upload is parsed; an upload waiting on Groq costs a
+    coroutine instead of a thread, so one process can keep hundreds in flight.
+    
+    Returns the job ID as JSON (HTTP 202), served by /jobs/<id> and /jobs/<id>/result
+    """
+    limit_response = check_usage_limit()
+    if limit_response:
+        return limit_response
+    
+    try:
+        ticket = reserve_admission(lane='async')
+    except AdmissionRejected as e:
+        return admission_rejected_response(e, 'job')
+    
+    try:
+        try:
+            with timed('upload'):
+                staged = stage_upload()
+        except Exception:
+            ticket.refund()
+            raise
+        if not staged:
+            ticket.refund()
+            return jsonify({"error": "No audio data provided"}), 400
+        filename, temp_path = staged
+        user = current_user_snapshot()
+        try:
+            job = async_job_queue.submit(run_transcription_job_async, filename, temp_path,
+                                         user, ticket, owner=session.get('user_id'))
+        except QueueFullError as e:
+            ticket.release()
+            release_reservation(user)
+            remove_temp_file(temp_path)
+            return jsonify({"error": str(e)}), 503
+        return jsonify({
+            "job_id": job.id,
+            "status_url": url_for('job_status', job_id=job.id),
+            "result_url": url_for('job_result', job_id=job.id),
+        }), 202
+    
+    except Exception as e:
+        ticket.release()
+        print(f"Error in async_file_upload: {e}")
+        return jsonify({"error": str(e)}), 500
+
+async def run_transcription_job_async(job, filename, temp_path, user, ticket):
+    """
+    Async version of run_transcription_job(), run on the async job queue's event loop
+    Blocking work (hashing, preprocessing, splitting) runs in the loop's thread pool
+    """
+    job.stage = 'waiting'
+    try:
+        await ticket.acquire_async()
+    except AdmissionRejected:
+        release_reservation(user)
+        remove_temp_file(temp_path)
+        raise
+    try:
+        raw_text, summary = await process_audio_async(filename, temp_path, job)
+    except Exception:
+        release_reservation(user)
+        raise
+    finally:
+        ticket.release()
+    summary_html = render_markdown(summary)
+    
+    new_usage = None
+    if user:
+        job.stage = 'saving'
+        new_usage = await save_transcriptions_async(
+            user['user_id'], user['is_admin'],
+            [transcription_row(user['user_id'], filename, raw_text, summary, summary_html)],
+            user['reservation'])
+    
+    return {"summary": summary, "summary_html": summary_html, "raw_text": raw_text, "usage_count": new_usage}
+
+async def process_audio_async(filename, temp_path, job):
+    """
+    Async version of process_audio() for uploaded files
+    """
+    try:
+        with timed('cache_lookup'):
+            key = await asyncio.to_thread(result_cache_key, temp_path)
+            cached = await asyncio.to_thread(result_cache.get, key)
+        if cached:
+            return cached['raw_text'], cached['summary']
+        
+        job.stage = 'transcribing'
+        with timed('transcribe'):
+            raw_text = await transcribe_audio_async(filename, temp_path)
+    finally:
+        remove_temp_file(temp_path)
+    
+    job.stage = 'summarizing'
+    summary = await summarize_transcript_async(raw_text)
+    await asyncio.to_thread(result_cache.set, key, {"raw_text": raw_text, "summary": summary})
+    return raw_text, summary
+
+async def transcribe_audio_async(filename, audio_path):
+    """
+    Async version of transcribe_audio()
+    At most TRANSCRIBE_WORKERS segments of one recording are sent at once
+    """
+    prepared_name, prepared_path = await asyncio.to_thread(prepare_audio, filename, audio_path)
+    try:
+        duration = await asyncio.to_thread(audio_duration, prepared_path)
+        with model_router.transcription(duration) as decision:
+            return await transcribe_segmented_async(prepared_name, prepared_path, decision.model)
+    finally:
+        if prepared_path != audio_path:
+            remove_temp_file(prepared_path)
+
+async def transcribe_segmented_async(filename, audio_path, model=TRANSCRIPTION_MODEL):
+    """
+    Async version of transcribe_segmented()
+    """
+    segment_seconds = await asyncio.to_thread(segment_length, audio_path)
+    if segment_seconds is None:
+        return await transcribe_file_async(filename, audio_path, model)
+    
+    segment_dir = tempfile.mkdtemp(dir=UPLOAD_FOLDER)
+    try:
+        segment_paths = await asyncio.to_thread(split_wav, audio_path, segment_dir, segment_seconds,
+                                                overlap_seconds=SEGMENT_OVERLAP_SECONDS)
+        base, _ = os.path.splitext(filename)
+        slots = asyncio.Semaphore(TRANSCRIBE_WORKERS)
+        
+        async def transcribe_segment(index, segment_path):
+            async with slots:
+                return await transcribe_file_async(f"{base}_part{index:03d}.wav", segment_path, model)
+        
+        # gather keeps the results in segment order
+        texts = await asyncio.gather(*(transcribe_segment(index, segment_path)
+                                       for index, segment_path in enumerate(segment_paths)))
+        return merge_segment_texts(texts)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+async def transcribe_file_async(filename, audio_path, model=TRANSCRIPTION_MODEL):
+    """
+    Transcribe a single audio file with the AsyncGroq client in one request
+    """
+    with open(audio_path, 'rb') as audio_file, timed('whisper'):
+        transcription = await async_client.audio.transcriptions.create(
+            file=(filename, audio_file),
+            model=model,
+            timeout=GROQ_TRANSCRIBE_TIMEOUT
+        )
+    return transcription.text
+
+async def complete_chat_async(system_prompt, text, model=SUMMARY_MODEL, decision=None):
+    """
+    Run one chat completion with the AsyncGroq client and return the reply
+    """
+    with timed('llama'):
+        chat_completion = await async_client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": text},
+            ],
+            model=model,
+        )
+    add_chat_usage(decision, chat_completion.usage)
+    return chat_completion.choices[0].message.content
+
+async def summarize_transcript_async(text):
+    """
+    Async version of summarize_transcript()
+    """
+    timings = {}
+    with timed('summarize'), model_router.summary(summarizer.estimate_tokens(text)) as decision:
+        complete = partial(complete_chat_async, model=decision.model, decision=decision)
+        summary = await summarizer.summarize_async(complete, text, SUMMARY_PROMPT,
+                                                   chunk_tokens=decision.chunk_tokens or SUMMARY_CHUNK_TOKENS,
+                                                   workers=SUMMARY_WORKERS, timings=timings)
+    log_summary_timings(timings)
+    return summary
+
+async def save_transcriptions_async(user_id, is_admin, rows, reservation=None):
+    """
+    Async version of save_transcriptions() using the async Supabase client
+    The local history is saved on a worker thread
+    """
+    if user_id == LOCAL_USER_ID:
+        return await asyncio.to_thread(save_transcriptions, user_id, is_admin, rows, reservation)
+    try:
+        supabase = await get_async_supabase_client()
+        inserted = await db_execute_async('transcriptions_insert', supabase.table('transcriptions').insert(
+            supabase_storage.transcription_rows(rows)))
+        await asyncio.to_thread(index_transcriptions, inserted.data)
+        
+        if not is_admin:
+            if reservation is not None:
+                return reservation.commit(len(rows))
+            return usage_accounting.add(user_id, len(rows))
+    
+    except Exception as db_error:
+        print(f"Warning: Could not save to database or update usage: {db_error}")
+    if reservation is not None:
+        reservation.release()
+    return None
+
+def admission_tier():
+    """
+    Admission tier and rate limit key of the current user
+    Admins have their own budget; without a login the client address is limited
+    """
+    if 'user_id' in session:
+        if session.get('is_admin', False):
+            return 'admin', session['user_id']
+        return session.get('tier') or 'free', session['user_id']
+    return 'anonymous', request.remote_addr
+
+def reserve_admission(lane='default'):
+    """
+    Reserve a place for one upload, raising AdmissionRejected if there is none
+    """
+    tier, key = admission_tier()
+    return admission.reserve(key, tier, lane)
+
+def admission_rejected_response(error, mode):
+    """
+    HTTP 429 response for an upload refused by admission control
+    Retry-After carries the estimated wait in seconds
+    """
+    headers = {"Retry-After": str(error.retry_after)}
+    if mode == 'job':
+        return jsonify({"error": str(error), "retry_after": error.retry_after}), 429, headers
+    flash(f'{error}. Please try again in about {error.retry_after} seconds.', 'warning')
+    return render_template('workshop.html'), 429, headers
+
+@app.route("/recordings", methods=['POST'])
+def create_recording():
+    """
+    Start a chunked recording upload
+    The browser recorder calls this when recording starts and then sends
+    the audio in binary chunks while the user is still recording
+    
+    The recording's rate limit token is taken here. Live windows wait for an
+    admission slot for each Groq call, and finishing takes a place in the lane
+    """
+    limit_response = check_usage_limit()
+    if limit_response:
+        return limit_response
+    
+    tier, key = admission_tier()
+    try:
+        sample_rate = int(request.form.get('sample_rate') or 0)
+        recording = recording_store.create(session.get('user_id'), request.form.get('mime_type', ''),
+                                           sample_rate=sample_rate, client=key,
+                                           admit=lambda: admission.admit(tier))
+    except ValueError:
+        return jsonify({"error": "Invalid sample rate"}), 400
+    except RecordingError as e:
+        return jsonify({"error": str(e)}), e.status
+    
+    try:
+        admission.take_token(key, tier)
+    except AdmissionRejected as e:
+        recording_store.discard(recording.id, recording.owner)
+        return admission_rejected_response(e, 'job')
+    return jsonify({
+        "recording_id": recording.id,
+        "recording_url": url_for('discard_recording', recording_id=recording.id),
+        "chunk_url": url_for('upload_recording_chunk', recording_id=recording.id),
+        "finish_url": url_for('finish_recording', recording_id=recording.id),
+        "transcript_url": url_for('recording_transcript', recording_id=recording.id),
+        "live": recording.live,
+    }), 201
+
+@app.route("/recordings/<recording_id>/chunks", methods=['POST'])
+def upload_recording_chunk(recording_id):
+    """
+    Append one binary chunk (the raw request body) to a recording
+    The seq query parameter orders the chunks, starting at 0
+    """
+    try:
+        seq = int(request.args.get('seq', ''))
+        with timed('recording_chunk'):
+            size = recording_store.append(recording_id, session.get('user_id'), seq, request.stream)
+    except ValueError:
+        return jsonify({"error": "Invalid chunk sequence number"}), 400
+    except RecordingError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify({"received": size})
+
+@app.route("/recordings/<recording_id>/finish", methods=['POST'])
+def finish_recording(recording_id):
+    """
+    Finish a chunked recording and process it
+    Accepts the same mode parameter as /file_upload (stream or job)
+    """
+    limit_response = check_usage_limit()
+    if limit_response:
+        return limit_response
+    
+    mode = upload_mode()
+    
+    # The rate limit token was taken when the recording was started; the lane place is
+    # checked before finishing, so a refused recording can be submitted again later
+    tier, key = admission_tier()
+    try:
+        ticket = admission.reserve(key, tier, charge=False)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e, mode)
+    
+    try:
+        mode = mode or request.form.get('mode')
+        filename, temp_path, transcript = recording_store.finish(recording_id, session.get('user_id'))
+    except Exception as e:
+        ticket.release()
+        return recording_error_response(e, mode)
+    try:
+        return process_staged_upload(filename, temp_path, mode, ticket, transcript)
+    except Exception as e:
+        ticket.release()
+        return recording_error_response(e, mode)
+
+def recording_error_response(e, mode):
+    """
+    Error response for a recording that could not be finished or processed
+    """
+    error_message = str(e)
+    print(f"Error in finish_recording: {error_message}")
+    if mode == 'job':
+        return jsonify({"error": error_message}), getattr(e, 'status', 500)
+    flash(f'Error processing recording: {error_message}', 'danger')
+    return redirect(url_for('workshop'))
+
+@app.route("/recordings/<recording_id>/transcript")
+def recording_transcript(recording_id):
+    """
+    Rolling transcript of a live recording that is still in progress
+    """
+    try:
+        text, done, total = recording_store.transcript(recording_id, session.get('user_id'))
+    except RecordingError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify({"text": text, "windows_done": done, "windows_total": total})
+
+@app.route("/recordings/<recording_id>", methods=['DELETE'])
+def discard_recording(recording_id):
+    """
+    Discard a chunked recording and delete its audio
+    """
+    try:
+        recording_store.discard(recording_id, session.get('user_id'))
+    except RecordingError as e:
+        return jsonify({"error": str(e)}), e.status
+    return '', 204
+
+def add_pending_stream(filename, temp_path, user, ticket, transcript=None):
+    """
+    Register a staged upload for streaming and return its stream ID
+    """
+    stream_id = uuid.uuid4().hex
+    with pending_streams_lock:
+        pending_streams[stream_id] = {
+            "filename": filename,
+            "temp_path": temp_path,
+            "transcript": transcript,
+            "ticket": ticket,
+            "user": user,
+            "owner": session.get('user_id'),
+            "created": time.time(),
+        }
+    return stream_id
+
+@app.before_request
+def prune_pending_streams(force=False):
+    """
+    Drop streams that were never opened within STREAM_TTL seconds
+    Their temp files are removed and admission tickets and usage reservations released
+    """
+    global pending_streams_pruned_at
+    now = time.time()
+    with pending_streams_lock:
+        if not force and now - pending_streams_pruned_at < 60:
+            return
+        pending_streams_pruned_at = now
+        expired = [pending_streams.pop(key) for key, entry in list(pending_streams.items())
+                   if now - entry['created'] > STREAM_TTL]
+    for entry in expired:
+        entry['ticket'].release()
+        release_reservation(entry['user'])
+        if entry['temp_path']:
+            remove_temp_file(entry['temp_path'])
+
+def sse_event(event, data):
+    """
+    Format one Server-Sent Event with a JSON encoded payload
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route("/stream/<stream_id>")
+def stream_result(stream_id):
+    """
+    Streaming result route
+    Sends the raw transcription, then the summary tokens as they are generated,
+    as Server-Sent Events. The result is saved to the database once the summary
+    is complete. Each stream can only be opened once.
+    """
+    with pending_streams_lock:
+        entry = pending_streams.get(stream_id)
+        if entry is not None and entry['owner'] == session.get('user_id'):
+            del pending_streams[stream_id]
+        else:
+            entry = None
+    if entry is None:
+        return Response(sse_event('failed', 'Result not found or already delivered'),
+                        mimetype='text/event-stream')
+    
+    filename, temp_path, user = entry['filename'], entry['temp_path'], entry['user']
+    transcript, ticket = entry['transcript'], entry['ticket']
+    
+    def generate():
+        try:
+            # Hold an admission slot while Groq is transcribing and summarizing
+            try:
+                ticket.acquire()
+            except AdmissionRejected:
+                if temp_path:
+                    remove_temp_file(temp_path)
+                raise
+            
+            raw_text, summary, key = transcribe_upload(filename, temp_path, transcript=transcript)
+            yield sse_event('transcription', raw_text)
+            if summary is not None:
+                yield sse_event('token', summary)
+            else:
+                parts = []
+                for token in stream_summary(raw_text):
+                    parts.append(token)
+                    yield sse_event('token', token)
+                summary = ''.join(parts)
+                if key:
+                    result_cache.set(key, {"raw_text": raw_text, "summary": summary})
+            
+            summary_html = render_markdown(summary)
+            if user:
+                save_transcription(user['user_id'], user['is_admin'],
+                                   filename, raw_text, summary, summary_html, user['reservation'])
+            yield sse_event('done', summary_html)
+        except Exception as e:
+            print(f"Error in stream_result: {e}")
+            yield sse_event('failed', f'Error processing file: {e}')
+        finally:
+            ticket.release()
+            release_reservation(user)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def get_own_job(job_id):
+    """
+    Look up a job, returning None unless it belongs to the current session
+    """
+    job = job_queue.get(job_id) or async_job_queue.get(job_id)
+    if job is None or job.owner != session.get('user_id'):
+        return None
+    return job
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    """
+    Job status route
+    Returns the state of a queued transcription job as JSON for polling
+    """
+    job = get_own_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    """
+    Job result route
+    Renders the result page once a queued transcription job has finished
+    """
+    job = get_own_job(job_id)
+    if job is None:
+        flash('Job not found or access denied', 'danger')
+        return redirect(url_for('workshop'))
+    
+    if job.status == JOB_FAILED:
+        flash(f'Error processing file: {job.error}', 'danger')
+        return redirect(url_for('workshop'))
+    
+    if job.status != JOB_DONE:
+        # Still running - tell the client to keep polling
+        return jsonify(job.to_dict()), 202
+    
+    return render_template('result.html', result=job.result['summary_html'],
+                           raw_text=job.result['raw_text'])
+
+@app.route("/cache/stats")
+@login_required
+def cache_stats():
+    """
+    Result cache statistics
+    Returns hit and miss counters as JSON, only accessible to admin users
+    """
+    if not session.get('is_admin', False):
+        return jsonify({"error": "Admin privileges required"}), 403
+    return jsonify(result_cache.stats())
+
+@app.route("/routing/stats")
+@login_required
+def routing_stats():
+    """
+    Model routing statistics
+    Returns the policy, per-rule counts, latency and cost and the latest decisions as JSON,
+    only accessible to admin users
+    """
+    if not session.get('is_admin', False):
+        return jsonify({"error": "Admin privileges required"}), 403
+    return jsonify(model_router.stats())
+
+def result_cache_metrics():
+    """
+    Result cache counters in the Prometheus text format
+    """
+    stats = result_cache.stats()
+    return [
+        "# HELP staky_result_cache_hits_total Result cache lookups answered from the cache",
+        "# TYPE staky_result_cache_hits_total counter",
+        f"staky_result_cache_hits_total {stats['hits']}",
+        "# HELP staky_result_cache_misses_total Result cache lookups that had to call Groq",
+        "# TYPE staky_result_cache_misses_total counter",
+        f"staky_result_cache_misses_total {stats['misses']}",
+    ]
+
+REGISTRY.add_collector(result_cache_metrics)
+
+# Optional bearer token required to scrape /metrics
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+@app.route("/metrics")
+def metrics():
+    """
+    Prometheus metrics route
+    Exposes stage latency histograms, per-stage error counts, requests in
+    flight and result cache counters in the Prometheus text format
+    Requires 'Authorization: Bearer <METRICS_TOKEN>' when METRICS_TOKEN is set
+    """
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route("/transcription/<id>")
+@history_required
+def view_transcription(id):
+    """
+    View a single saved transcription
+    Retrieves a specific transcription from the database
+    Ensures users can only view their own transcriptions
+    
+    The page carries an ETag, so a browser revisiting an unchanged
+    transcription gets a 304 without the page being rendered again
+    """
+    try:
+        user_id = history_user_id()
+        storage = storage_for(user_id)
+        
+        # Get transcription from storage with security check
+        # The user_id filter ensures users can only access their own data
+        columns = 'summary, raw_transcription' + (', summary_html' if storage.summary_html_available else '')
+        row = storage.get_transcription(user_id, id, columns)
+        
+        if row is None:
+            flash('Transcription not found or access denied', 'danger')
+            return redirect(url_for('dashboard'))
+        
+        # The page also shows the user's name, so it is part of the tag
+        etag = hashlib.sha256('|'.join((str(id), session.get('name') or '', row['summary'] or '',
+                                        row['raw_transcription'] or '')).encode('utf-8')).hexdigest()
+        headers = {"Cache-Control": "private, no-cache"}
+        if etag in request.if_none_match and not session.get('_flashes'):
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+        
+        # Rows saved before summary_html was stored are rendered once and cached
+        summary_html = row.get('summary_html') or cached_summary_html(row['summary'])
+        
+        # Render the same result template used for new transcriptions
+        # This provides a consistent user experience
+        response = Response(render_template('result.html', result=summary_html,
+                                            raw_text=row['raw_transcription']), headers=headers)
+        response.set_etag(etag)
+        return response
+    
+    except Exception as e:
+        flash(f'Error retrieving transcription: {str(e)}', 'danger')
+        return redirect(url_for('dashboard'))
+
+@app.route("/transcription/<id>/summary", methods=['POST'])
+@history_required
+def resummarize_transcription(id):
+    """
+    Re-summarize route
+    Summarizes the saved transcript of a transcription again in the requested
+    style (form or JSON field 'style', one of SUMMARY_STYLES) without running
+    Whisper again. Variants are cached per transcription, style and model, so
+    asking for the same variant again does not call Groq.
+    
+    With save=1 the variant replaces the stored summary
+    Returns JSON with summary, summary_html and whether it came from the cache
+    """
+    values = request.get_json(silent=True) or request.form
+    style = values.get('style', 'default')
+    if style not in SUMMARY_STYLES:
+        return jsonify({"error": f"Unknown style, choose one of: {', '.join(SUMMARY_STYLES)}"}), 400
+    save = str(values.get('save', '')).lower() in ('1', 'true', 'yes')
+    
+    user_id = history_user_id()
+    storage = storage_for(user_id)
+    try:
+        row = storage.get_transcription(user_id, id, 'id, user_id, filename, created_at, raw_transcription',
+                                        stage='transcriptions_select_raw')
+    except Exception as e:
+        return jsonify({"error": f"Error retrieving transcription: {e}"}), 500
+    if row is None:
+        return jsonify({"error": "Transcription not found or access denied"}), 404
+    raw_text = row['raw_transcription'] or ''
+    
+    # The transcript hash is part of the key, so an edited transcript is summarized again
+    key = cache_key(hashlib.sha256(raw_text.encode('utf-8')).hexdigest(), 'summary', str(id), style, model_router.fingerprint)
+    variant = result_cache.get(key)
+    cached = variant is not None
+    if not cached:
+        try:
+            with reserve_admission():
+                summary = summarize_transcript(raw_text, style)
+        except AdmissionRejected as e:
+            return admission_rejected_response(e, 'job')
+        except Exception as e:
+            print(f"Error in resummarize_transcription: {e}")
+            return jsonify({"error": f"Error summarizing transcription: {e}"}), 500
+        variant = {"summary": summary, "summary_html": render_markdown(summary)}
+        result_cache.set(key, variant)
+    
+    if save:
+        changes = {"summary": variant['summary'], "summary_html": variant['summary_html']}
+        try:
+            storage.update_transcription(user_id, id, changes, stage='transcriptions_update_summary')
+        except Exception as e:
+            return jsonify({"error": f"Error saving summary: {e}"}), 500
+        index_transcriptions([dict(row, summary=variant['summary'])])
+    
+    return jsonify({"id": id, "style": style, "summary": variant['summary'],
+                    "summary_html": variant['summary_html'], "cached": cached, "saved": save})
+
+@app.route("/search")
+@history_required
+def search():
+    """
+    Full-text search route
+    Returns the user's transcriptions matching q, best match first, as JSON
+    with a highlighted snippet of each; page (from 1) selects further results
+    """
+    if not search_index.available:
+        return jsonify({"error": "Search is not available"}), 503
+    
+    text = request.args.get('q', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    user_id = history_user_id()
+    try:
+        sync_search_index(user_id)
+        with timed('search'):
+            # One extra result shows whether there is a next page
+            matches = search_index.search(user_id, text, limit=SEARCH_PAGE_SIZE + 1,
+                                          offset=(page - 1) * SEARCH_PAGE_SIZE)
+    except Exception as e:
+        print(f"Error in search: {e}")
+        return jsonify({"error": f"Search failed: {e}"}), 500
+    
+    next_url = None
+    if len(matches) > SEARCH_PAGE_SIZE:
+        matches = matches[:SEARCH_PAGE_SIZE]
+        next_url = url_for('search', q=text, page=page + 1)
+    for match in matches:
+        match['url'] = url_for('view_transcription', id=match['id'])
+    return jsonify({"query": text, "page": page, "results": matches, "next_url": next_url})
+
+def sync_search_index(user_id):
+    """
+    Index a user's transcriptions saved since the last sync of this server's index
+    On the first search every transcription is indexed; after that only the ones
+    created after the sync cursor (less SEARCH_SYNC_OVERLAP), at most once every
+    SEARCH_SYNC_INTERVAL seconds. Rows are read in keyset pages so memory stays flat
+    and the cursor is saved after each page
+    """
+    state = search_index.sync_state(user_id)
+    now = time.time()
+    if state is not None and now - state[1] < SEARCH_SYNC_INTERVAL:
+        return
+    cursor = state[0] if state else None
+    since = None
+    if cursor:
+        since = (datetime.datetime.fromisoformat(cursor[0])
+                 - datetime.timedelta(seconds=SEARCH_SYNC_OVERLAP)).isoformat()
+    with timed('search_sync'):
+        for rows in iter_transcription_pages(user_id, 'id, user_id, filename, summary, raw_transcription, created_at',
+                                             SEARCH_BACKFILL_PAGE_SIZE, since=since, stage='transcriptions_sync'):
+            search_index.add(rows)
+            cursor = max(cursor or ('', ''), (rows[-1]['created_at'], str(rows[-1]['id'])))
+            search_index.set_sync_state(user_id, cursor, now)
+    search_index.set_sync_state(user_id, cursor, now)
+
+def iter_transcription_pages(user_id, columns, page_size, since=None, stage='transcriptions_page'):
+    """
+    Yield a user's transcriptions oldest first, one page (list of rows) at a time
+    Pages continue after the (created_at, id) of the previous page's last row,
+    so every page is an index range scan however far into the history it is
+    since (ISO timestamp) skips transcriptions created at or before it
+    """
+    storage = storage_for(user_id)
+    cursor = None
+    while True:
+        rows = storage.list_transcriptions_ascending(user_id, columns, page_size, after=cursor, since=since,
+                                                     stage=stage)
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        cursor = rows[-1]['created_at'], str(rows[-1]['id'])
+
+@app.route("/export")
+@history_required
+def export_transcriptions():
+    """
+    Export route
+    Streams all of the user's transcriptions, oldest first, as NDJSON
+    (format=ndjson, one JSON object per line) or as a ZIP of markdown files
+    (format=zip). Transcriptions are read EXPORT_PAGE_SIZE at a time while
+    the response is sent, so memory use does not grow with the history.
+    
+    since (ISO timestamp) limits the export to transcriptions created after
+    it; pass the created_at of the last exported transcription to export
+    only what is new
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'zip'):
+        return jsonify({"error": "format must be ndjson or zip"}), 400
+    
+    since = request.args.get('since') or None
+    if since:
+        try:
+            datetime.datetime.fromisoformat(since)
+        except ValueError:
+            return jsonify({"error": "since must be an ISO 8601 timestamp"}), 400
+    
+    pages = iter_transcription_pages(history_user_id(), EXPORT_COLUMNS, EXPORT_PAGE_SIZE,
+                                     since=since, stage='transcriptions_export')
+    name = f"staky-transcriptions-{datetime.date.today().isoformat()}.{export_format}"
+    headers = {"Content-Disposition": f'attachment; filename="{name}"', "X-Accel-Buffering": "no"}
+    if export_format == 'zip':
+        return Response(stream_with_context(export_zip(pages)), mimetype='application/zip', headers=headers)
+    return Response(stream_with_context(export_ndjson(pages)), mimetype='application/x-ndjson', headers=headers)
+
+def export_ndjson(pages):
+    """
+    Yield transcriptions as NDJSON lines, one page at a time
+    A database error ends the export with an error line
+    """
+    try:
+        for rows in pages:
+            yield ''.join(json.dumps(row) + '\n' for row in rows)
+    except Exception as e:
+        print(f"Error in export: {e}")
+        yield json.dumps({"error": f"Export incomplete: {e}"}) + '\n'
+
+class ZipStream:
+    """
+    Write-only file object collecting the bytes written by ZipFile
+    ZipFile writes a streamable archive (data descriptors) because it cannot seek
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+    
+    def write(self, data):
+        self.buffer.extend(data)
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def export_zip(pages):
+    """
+    Yield a ZIP archive with one markdown file per transcription
+    Each file is sent as soon as it is compressed
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        try:
+            for rows in pages:
+                for row in rows:
+                    archive.writestr(export_file_name(row), export_markdown(row))
+                    yield stream.drain()
+        except Exception as e:
+            # The archive is closed normally so everything exported so far can be opened
+            print(f"Error in export: {e}")
+            archive.writestr('EXPORT_INCOMPLETE.txt', f"Export incomplete: {e}\n")
+    yield stream.drain()
+
+def export_file_name(row):
+    """
+    Unique, file-system safe name of a transcription in the ZIP export
+    """
+    base, _ = os.path.splitext(row.get('filename') or 'transcription')
+    base = ''.join(c if c.isalnum() or c in '-_' else '_' for c in base)[:60] or 'transcription'
+    return f"{str(row.get('created_at') or '')[:10]}_{base}_{str(row['id'])[:8]}.md"
+
+def export_markdown(row):
+    """
+    Markdown document of one transcription for the ZIP export
+    """
+    return (f"# {row.get('filename') or 'Transcription'}\n\n"
+            f"Created: {row.get('created_at')}\n\n"
+            f"## Summary\n\n{row.get('summary') or ''}\n\n"
+            f"## Transcript\n\n{row.get('raw_transcription') or ''}\n")
+
+@app.route("/profile")
+@login_required
+def profile():
+    """
+    User profile page
+    Shows user information and allows editing name
+    Protected by login_required decorator
+    """
+    return render_template('profile.html')
+
+@app.route("/update_profile", methods=['POST'])
+@login_required
+def update_profile():
+    """
+    Update user profile information
+    Currently supports updating the user's name
+    Updates both the database record and the session data
+    """
+    try:
+        user_id = session['user_id']
+        name = request.form.get('name')
+        
+        # Update user record in database
+        supabase_storage.update_user(user_id, {"name": name}, stage='users_update_name')
+        
+        # Update session data to reflect the changes immediately
+        session['name'] = name
+        
+        flash('Profile updated successfully', 'success')
+    except Exception as e:
+        flash(f'Error updating profile: {str(e)}', 'danger')
+    
+    return redirect(url_for('profile'))
+
+@app.route("/admin")
+@login_required
+def admin_panel():
+    """
+    Admin panel for managing users
+    Only accessible to admin users
+    
+    Users are listed one page at a time, sorted and filtered on the server:
+    page - page number, starting at 1
+    sort - created_at, email, name or usage_count, with order asc or desc
+    q    - prefix matched against email and name (case-insensitive)
+    """
+    # Check if user is an admin
+    if not session.get('is_admin', False):
+        flash('Access denied. Admin privileges required.', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    list_args = admin_list_args(request.args)
+    try:
+        # Get one page of users; the total is only counted when it is not cached
+        total = cached_user_count(list_args['q'])
+        users, count = supabase_storage.list_users(ADMIN_COLUMNS, list_args['sort'], list_args['order'] == 'desc',
+                                                   list_args['q'], (list_args['page'] - 1) * ADMIN_PAGE_SIZE,
+                                                   ADMIN_PAGE_SIZE, count=total is None)
+        if total is None:
+            total = count
+            store_user_count(list_args['q'], total)
+        
+        pages = max(1, -(-total // ADMIN_PAGE_SIZE))
+        page_url = lambda page: url_for('admin_panel', **dict(list_args, page=page))
+        return render_template('admin.html', users=users, total=total, pages=pages, list_args=list_args,
+                               prev_url=page_url(list_args['page'] - 1) if list_args['page'] > 1 else None,
+                               next_url=page_url(list_args['page'] + 1) if list_args['page'] < pages else None)
+    except Exception as e:
+        flash(f'Error retrieving user data: {str(e)}', 'danger')
+        return render_template('admin.html', users=[], total=0, pages=1, list_args=list_args,
+                               prev_url=None, next_url=None)
+
+def admin_list_args(values):
+    """
+    Validated admin listing parameters (page, sort, order, q) from request args or form data
+    Search text is stripped of characters that have a meaning in PostgREST filters
+    """
+    try:
+        page = max(1, int(values.get('page', 1)))
+    except ValueError:
+        page = 1
+    sort = values.get('sort', 'created_at')
+    if sort not in ADMIN_SORT_COLUMNS:
+        sort = 'created_at'
+    order = 'asc' if values.get('order') == 'asc' else 'desc'
+    q = ''.join(c for c in values.get('q', '').strip() if c not in ADMIN_SEARCH_RESERVED)[:100]
+    return {"page": page, "sort": sort, "order": order, "q": q}
+
+def cached_user_count(q):
+    """
+    Cached number of users matching a search prefix, or None when it must be counted again
+    """
+    with user_counts_lock:
+        entry = user_counts.get(q)
+        if entry and entry[1] > time.time():
+            return entry[0]
+    return None
+
+def store_user_count(q, total):
+    """
+    Cache the number of users matching a search prefix for ADMIN_COUNT_TTL seconds
+    """
+    with user_counts_lock:
+        if len(user_counts) >= 256:
+            user_counts.clear()
+        user_counts[q] = (total, time.time() + ADMIN_COUNT_TTL)
+
+@app.route("/admin/toggle_admin/<user_id>", methods=['POST'])
+@login_required
+def toggle_admin_status(user_id):
+    """
+    Toggle admin status for a user
     Only accessible to admin users
+    The listing parameters (page, sort, order, q) may be sent as form fields
+    or in the query string so the admin returns to the same page
     """
     # Check if user is an admin
     if not session.get('is_admin', False):
         flash('Access denied. Admin privileges required.', 'danger')
         return redirect(url_for('dashboard'))
     
+    list_args = admin_list_args(request.form if 'page' in request.form else request.args)
+    
     try:
         # Get current admin status
-        user_data = supabase_client.table('users').select('is_admin').eq('id', user_id).execute()
+        user = supabase_storage.get_user(user_id, 'is_admin', stage='users_select_admin')
         
-        if not user_data.data:
+        if user is None:
             flash('User not found', 'danger')
-            return redirect(url_for('admin_panel'))
+            return redirect(url_for('admin_panel', **list_args))
         
-        current_status = user_data.data[0].get('is_admin', False)
+        current_status = user.get('is_admin', False)
         new_status = not current_status
         
         # Update admin status
-        supabase_client.table('users').update({"is_admin": new_status}).eq('id', user_id).execute()
+        supabase_storage.update_user(user_id, {"is_admin": new_status}, stage='users_update_admin')
         
         # Update session if the user is updating their own status
         if user_id == session.get('user_id'):
@@ -480,7 +2434,8 @@ def toggle_admin_status(user_id):
     except Exception as e:
         flash(f'Error updating admin status: {str(e)}', 'danger')
     
-    return redirect(url_for('admin_panel'))
+    # Return to the page, sort and search the admin was looking at
+    return redirect(url_for('admin_panel', **list_args))
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
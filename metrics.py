@@ -0,0 +1,225 @@
+"""
+Timing instrumentation and Prometheus metrics for Staky AI
+
+Every stage of the upload pipeline (upload parsing, preprocessing,
+Whisper, the summary model, Supabase calls, markdown rendering) is wrapped
+in timed(stage). Each timed block:
+1. adds its duration to an in-process latency histogram
+2. counts an error for the stage if it raises
+3. is reported to the browser in the Server-Timing response header
+   when it runs inside a request
+
+The /metrics route renders everything in the Prometheus text format.
+Metrics are kept per process, so with several gunicorn workers each
+worker is scraped (or aggregated) separately.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+# Default histogram buckets in seconds, from fast database calls to long transcriptions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class for a metric family with optional labels
+    """
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down, such as the number of requests in flight
+    """
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][index] += 1
+                    break
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted((key, dict(entry, counts=list(entry["counts"]))) for key, entry in self._values.items())
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry["counts"]):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(entry['sum'])}")
+            lines.append(f"{self.name}_count{labels} {entry['count']}")
+        return lines
+
+
+class Registry:
+    """
+    Collection of metrics rendered together at /metrics
+
+    Collectors are functions returning extra exposition lines, used for
+    values that live elsewhere (e.g. result cache counters).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+REGISTRY = Registry()
+
+stage_duration = REGISTRY.histogram('staky_stage_duration_seconds',
+                                    'Time spent in each pipeline stage', ['stage'])
+stage_errors = REGISTRY.counter('staky_stage_errors_total',
+                                'Errors raised in each pipeline stage', ['stage'])
+requests_in_flight = REGISTRY.gauge('staky_http_requests_in_flight',
+                                    'HTTP requests currently being handled')
+request_duration = REGISTRY.histogram('staky_http_request_duration_seconds',
+                                      'Time to produce each HTTP response', ['endpoint'])
+requests_total = REGISTRY.counter('staky_http_requests_total',
+                                  'HTTP responses by endpoint and status', ['endpoint', 'status'])
+
+
+def record_stage(stage, seconds, error=False):
+    """
+    Record the duration of a stage that was timed elsewhere
+    """
+    stage_duration.observe(seconds, stage=stage)
+    if error:
+        stage_errors.inc(stage=stage)
+    if has_request_context():
+        timings = g.setdefault('server_timings', {})
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time a block of code as one pipeline stage
+    """
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start, error)
+
+
+def server_timing_header(timings):
+    """
+    Format stage durations (in seconds) as a Server-Timing header value
+    """
+    return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
@@ -0,0 +1,389 @@
+"""
+Chunked recording uploads for Staky AI
+
+The in-browser recorder sends its audio to the server in small binary
+chunks while the user is still recording (MediaRecorder timeslices).
+Each chunk is appended to a file in the uploads folder, so when the user
+presses stop the audio is already on the server and processing can start
+right away, without a base64 form field or a second upload.
+
+Live recordings are sent as raw 16-bit mono PCM instead. Every time a
+full window of audio has arrived it is cut at a quiet point, written out
+as a WAV file and transcribed in the background, so a rolling transcript
+is built up during the recording. When the user stops, only the last
+window is left to transcribe, no matter how long the recording was.
+Audio that has been cut into windows is dropped from the PCM file, so
+the size limit applies to the audio not transcribed yet rather than to
+the length of the recording.
+
+Recording sessions are kept in memory, like the local job queue, and are
+removed if they stay idle for longer than the configured TTL. A client may
+only have max_open recordings in progress at once. Each window of a live
+recording is transcribed inside the recording's admit() context, so its
+Groq call waits for an admission slot like any upload.
+"""
+
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from audio import quietest_offset, write_wav, merge_segment_texts, SILENCE_FRAME_SECONDS
+
+# File extensions for the container formats produced by MediaRecorder
+MIME_EXTENSIONS = {
+    'audio/webm': '.webm',
+    'audio/ogg': '.ogg',
+    'audio/mp4': '.m4a',
+    'audio/mpeg': '.mp3',
+    'audio/wav': '.wav',
+    'audio/x-wav': '.wav',
+}
+
+# MIME type used by the recorder for live raw PCM (16-bit little-endian, mono)
+PCM_MIME_TYPE = 'audio/pcm'
+
+# Bytes per sample of live PCM audio
+PCM_SAMPLE_WIDTH = 2
+
+# Read size used when appending request bodies to the recording file
+CHUNK_COPY_SIZE = 64 * 1024
+
+
+class RecordingError(Exception):
+    """
+    Raised for invalid recording requests
+    status is the HTTP status code the route should answer with
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def extension_for(mime_type):
+    """
+    File extension for a MediaRecorder MIME type such as 'audio/webm;codecs=opus'
+    """
+    base_type = (mime_type or '').split(';')[0].strip().lower()
+    return MIME_EXTENSIONS.get(base_type, '.webm')
+
+
+class Recording:
+    """
+    One recording being uploaded chunk by chunk
+    """
+
+    def __init__(self, recording_id, owner, path, mime_type, sample_rate=None, client=None, admit=None):
+        self.id = recording_id
+        self.owner = owner
+        self.client = client
+        self.admit = admit or contextlib.nullcontext
+        self.path = path
+        self.mime_type = mime_type
+        self.next_seq = 0
+        self.size = 0
+        self.wav = None
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+        # Live PCM recordings only: sample rate, byte offset where the next
+        # window starts, offset of the first byte still in the file, and the
+        # transcription futures of the windows so far
+        self.sample_rate = sample_rate
+        self.window_start = 0
+        self.file_start = 0
+        self.windows = []
+
+    @property
+    def live(self):
+        return self.sample_rate is not None
+
+    @property
+    def filename(self):
+        if self.live:
+            return 'browser-recording.wav'
+        return 'browser-recording' + extension_for(self.mime_type)
+
+    def transcript(self):
+        """
+        Rolling transcript of the windows transcribed so far, in order
+        Stops at the first window that is still being transcribed
+        """
+        texts = []
+        for future in list(self.windows):
+            if not future.done() or future.exception() is not None:
+                break
+            texts.append(future.result())
+        return merge_segment_texts(texts)
+
+    def close(self):
+        """
+        Stop the recording: cancel queued windows and delete the audio
+        """
+        for future in self.windows:
+            future.cancel()
+        _remove(self.path)
+
+
+class RecordingStore:
+    """
+    In-memory registry of recordings that are still being uploaded
+
+    max_file_bytes limits file recordings in formats other than WAV, which
+    cannot be split into segments (e.g. the Groq per-request limit)
+    """
+
+    def __init__(self, upload_folder, max_bytes, idle_ttl=1800, transcribe=None, executor=None,
+                 window_seconds=30.0, overlap_seconds=1.0, search_seconds=3.0, min_tail_seconds=0.5,
+                 max_open=2, max_file_bytes=None):
+        self.upload_folder = upload_folder
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.idle_ttl = idle_ttl
+        self.max_open = max_open
+        self._recordings = {}
+        self._lock = threading.Lock()
+        self._pruned_at = time.time()
+
+        # Live transcription: transcribe(filename, wav_path) -> text runs on executor
+        self.transcribe = transcribe
+        self.executor = executor
+        self.window_seconds = window_seconds
+        self.overlap_seconds = overlap_seconds
+        self.search_seconds = search_seconds
+        self.min_tail_seconds = min_tail_seconds
+
+    def create(self, owner, mime_type, sample_rate=None, client=None, admit=None):
+        """
+        Start a new recording and return it
+        Live transcription is used for raw PCM recordings (mime_type audio/pcm)
+        when the store was given a transcribe function
+
+        client identifies who the max_open limit applies to (default: owner).
+        admit() returns a context manager held around the transcription of
+        each live window, e.g. an admission ticket.
+        """
+        live = mime_type == PCM_MIME_TYPE
+        if live and (self.transcribe is None or not sample_rate or sample_rate <= 0):
+            raise RecordingError('Live PCM recording needs a positive sample_rate')
+        client = owner if client is None else client
+        with self._lock:
+            self._prune(force=True)
+            if sum(1 for recording in self._recordings.values() if recording.client == client) >= self.max_open:
+                raise RecordingError('Too many recordings in progress', 429)
+            os.makedirs(self.upload_folder, exist_ok=True)
+            fd, path = tempfile.mkstemp(dir=self.upload_folder, prefix='rec_',
+                                        suffix='.pcm' if live else extension_for(mime_type))
+            os.close(fd)
+            recording = Recording(uuid.uuid4().hex, owner, path, mime_type,
+                                  sample_rate=sample_rate if live else None, client=client, admit=admit)
+            self._recordings[recording.id] = recording
+        return recording
+
+    def get(self, recording_id, owner):
+        """
+        Return the recording if it exists and belongs to owner
+        """
+        with self._lock:
+            self._prune()
+            recording = self._recordings.get(recording_id)
+        if recording is None or recording.owner != owner:
+            raise RecordingError('Recording not found', 404)
+        return recording
+
+    def append(self, recording_id, owner, seq, stream):
+        """
+        Append one chunk read from stream to the recording
+
+        Chunks must arrive in order. A chunk that was already stored (a retry
+        after a lost response) is ignored; a gap in the sequence is refused so
+        the client can resend the missing chunk.
+        Returns the number of bytes received so far.
+        """
+        recording = self.get(recording_id, owner)
+        with recording.lock:
+            if seq < recording.next_seq:
+                return recording.size
+            if seq > recording.next_seq:
+                raise RecordingError(f'Expected chunk {recording.next_seq}, got {seq}', 409)
+
+            with open(recording.path, 'ab') as f:
+                start = f.tell()
+                try:
+                    while True:
+                        block = stream.read(CHUNK_COPY_SIZE)
+                        if not block:
+                            break
+                        # Live files only hold the audio not cut into windows yet
+                        if f.tell() + len(block) > self.max_bytes:
+                            raise RecordingError('Recording is too large', 413)
+                        if (not recording.live and self.max_file_bytes is not None
+                                and f.tell() + len(block) > self.max_file_bytes):
+                            f.flush()
+                            if not self._is_wav(recording, block):
+                                raise RecordingError(f'Audio files other than WAV can be at most '
+                                                     f'{self.max_file_bytes // (1024 * 1024)}MB', 413)
+                        f.write(block)
+                except Exception:
+                    # Drop the partial chunk so a retry starts from a clean file
+                    f.truncate(start)
+                    raise
+
+                recording.size = recording.file_start + f.tell()
+            recording.next_seq += 1
+            recording.updated_at = time.time()
+            if recording.live:
+                self._schedule_windows(recording)
+            return recording.size
+
+    def finish(self, recording_id, owner):
+        """
+        Close the recording and hand it over to the caller
+
+        Returns (filename, path, transcript). For file recordings transcript
+        is None and the caller must remove the file at path when done. For
+        live recordings the last window is queued, the PCM file is removed,
+        path is None and transcript is a function that waits for the
+        remaining windows and returns the full transcription text.
+        """
+        recording = self.get(recording_id, owner)
+        with self._lock:
+            self._recordings.pop(recording_id, None)
+        with recording.lock:
+            if recording.size == 0:
+                recording.close()
+                raise RecordingError('Recording is empty')
+            if not recording.live:
+                return recording.filename, recording.path, None
+
+            try:
+                self._schedule_windows(recording, final=True)
+            except Exception:
+                recording.close()
+                raise
+            _remove(recording.path)
+            windows = list(recording.windows)
+
+        def transcript():
+            return merge_segment_texts([future.result() for future in windows])
+        return recording.filename, None, transcript
+
+    def transcript(self, recording_id, owner):
+        """
+        Rolling transcript of a live recording that is still in progress
+        Returns (text, windows_done, windows_total)
+        """
+        recording = self.get(recording_id, owner)
+        windows = list(recording.windows)
+        done = sum(1 for future in windows if future.done())
+        return recording.transcript(), done, len(windows)
+
+    def discard(self, recording_id, owner):
+        """
+        Drop a recording and delete its audio
+        """
+        recording = self.get(recording_id, owner)
+        with self._lock:
+            self._recordings.pop(recording_id, None)
+        recording.close()
+
+    def _schedule_windows(self, recording, final=False):
+        # Cut every complete window of a live recording and queue it for transcription
+        # With final=True the remaining audio is queued as the last window
+        # Called with the recording lock held
+        frame = PCM_SAMPLE_WIDTH
+        rate = recording.sample_rate
+        window_bytes = int(self.window_seconds * rate) * frame
+        overlap_bytes = int(self.overlap_seconds * rate) * frame
+        search_bytes = int(self.search_seconds * rate) * frame
+        silence_frame_bytes = max(1, int(SILENCE_FRAME_SECONDS * rate)) * frame
+        min_tail_bytes = int(self.min_tail_seconds * rate) * frame
+
+        with open(recording.path, 'rb') as f:
+            while True:
+                available = recording.size - recording.window_start
+                if available < window_bytes and not final:
+                    break
+                if available <= 0 or (final and available < min_tail_bytes and recording.windows):
+                    # Nothing left, or only a sliver already covered by the overlap
+                    break
+
+                end = recording.window_start + min(available, window_bytes)
+                if end < recording.size:
+                    # Move the cut to the quietest moment near the end of the window
+                    search_start = max(recording.window_start + overlap_bytes, end - search_bytes)
+                    search_start -= (search_start - recording.window_start) % frame
+                    f.seek(search_start - recording.file_start)
+                    cut = search_start + quietest_offset(f.read(end - search_start), silence_frame_bytes)
+                    cut -= (cut - recording.window_start) % frame
+                else:
+                    cut = end
+
+                start = max(recording.file_start, recording.window_start - overlap_bytes)
+                f.seek(start - recording.file_start)
+                pcm = f.read(cut - start)
+
+                fd, window_path = tempfile.mkstemp(dir=self.upload_folder, prefix='win_', suffix='.wav')
+                os.close(fd)
+                write_wav(window_path, pcm, rate, sample_width=PCM_SAMPLE_WIDTH)
+                window_name = f"{os.path.splitext(recording.filename)[0]}_part{len(recording.windows):03d}.wav"
+                recording.windows.append(self.executor.submit(self._transcribe_window, recording, window_name,
+                                                              window_path))
+                recording.window_start = cut
+
+        if not final:
+            self._compact(recording, recording.window_start - overlap_bytes)
+
+    def _compact(self, recording, keep_from):
+        # Drop the audio before keep_from (an offset in the recording) from a live PCM file
+        # Only the uncut audio and the overlap are copied; called with the recording lock held
+        if keep_from <= recording.file_start:
+            return
+        fd, path = tempfile.mkstemp(dir=self.upload_folder, prefix='rec_', suffix='.pcm')
+        try:
+            with open(recording.path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                src.seek(keep_from - recording.file_start)
+                shutil.copyfileobj(src, dst, CHUNK_COPY_SIZE)
+            os.replace(path, recording.path)
+        except Exception:
+            _remove(path)
+            raise
+        recording.file_start = keep_from
+
+    def _transcribe_window(self, recording, filename, path):
+        try:
+            with recording.admit():
+                return self.transcribe(filename, path)
+        finally:
+            _remove(path)
+
+    def _is_wav(self, recording, block):
+        # Whether a file recording is WAV (RIFF....WAVE), decided once from its first bytes
+        if recording.wav is None:
+            with open(recording.path, 'rb') as f:
+                head = (f.read(12) + bytes(block))[:12]
+            recording.wav = head[:4] == b'RIFF' and head[8:12] == b'WAVE'
+        return recording.wav
+
+    def _prune(self, force=False):
+        # Remove recordings that have been idle for too long, at most once a minute unless forced
+        # Called with the lock held
+        now = time.time()
+        if not force and now - self._pruned_at < 60:
+            return
+        self._pruned_at = now
+        cutoff = now - self.idle_ttl
+        for recording_id in [key for key, recording in self._recordings.items()
+                             if recording.updated_at < cutoff]:
+            self._recordings.pop(recording_id).close()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
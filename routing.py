@@ -0,0 +1,230 @@
+"""
+Model routing for Staky AI
+
+A ten-second voice memo does not need the same models as a two-hour
+meeting. Before each transcription and each summary the router picks the
+models from a policy table:
+
+1. transcription - by audio duration in seconds (after preprocessing)
+2. summary       - by estimated token count of the transcript, including
+                   the chunk size used for map-reduce on long transcripts
+
+Rules are tried in order and the first one whose limits all hold is used,
+so the last rule of each list should have no limits. A rule with a
+max_seconds limit is skipped when the duration is unknown.
+
+Every decision is recorded with its latency and cost (from the price table
+and, for chat models, the token usage reported by Groq) in /metrics and in
+the per-rule statistics at /routing/stats, so the policy can be tuned.
+
+The policy is set with MODEL_POLICY, either a JSON document or the path of
+a JSON file, in the format of DEFAULT_POLICY. Prices are in USD.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY
+
+DEFAULT_POLICY = {
+    "transcription": [
+        {"name": "default", "model": "whisper-large-v3-turbo"},
+    ],
+    "summary": [
+        {"name": "short", "max_tokens": 2000, "model": "llama-3.1-8b-instant"},
+        {"name": "long", "model": "llama3-70b-8192", "chunk_tokens": 5000},
+    ],
+    # USD per hour of audio, or per million input and output tokens
+    "prices": {
+        "whisper-large-v3-turbo": {"per_hour": 0.04},
+        "whisper-large-v3": {"per_hour": 0.111},
+        "distil-whisper-large-v3-en": {"per_hour": 0.02},
+        "llama-3.1-8b-instant": {"input": 0.05, "output": 0.08},
+        "llama3-8b-8192": {"input": 0.05, "output": 0.08},
+        "llama3-70b-8192": {"input": 0.59, "output": 0.79},
+        "llama-3.3-70b-versatile": {"input": 0.59, "output": 0.79},
+    },
+}
+
+# Limits a rule may set, and the input measure each one applies to
+RULE_LIMITS = {"max_seconds": "seconds", "min_seconds": "seconds", "max_tokens": "tokens", "min_tokens": "tokens"}
+
+model_decisions = REGISTRY.counter('staky_model_decisions_total',
+                                   'Model routing decisions by kind, rule and model', ['kind', 'rule', 'model'])
+model_latency = REGISTRY.histogram('staky_model_latency_seconds',
+                                   'Latency of routed transcriptions and summaries by model', ['kind', 'model'])
+model_cost = REGISTRY.counter('staky_model_cost_usd_total',
+                              'Estimated Groq cost in USD by kind and model', ['kind', 'model'])
+
+
+class Decision:
+    """
+    One routing decision: the rule and model picked for a transcription or summary
+
+    Use as a context manager around the work; leaving it records the latency
+    and cost. Chat calls report their token usage with add_usage().
+    """
+
+    def __init__(self, router, kind, rule, seconds=None, tokens=None):
+        self.router = router
+        self.kind = kind
+        self.rule = rule.get('name', 'unnamed')
+        self.model = rule['model']
+        self.chunk_tokens = rule.get('chunk_tokens')
+        self.seconds = seconds
+        self.tokens = tokens
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = None
+        self.cost = None
+        self.error = False
+        self._lock = threading.Lock()
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A generator closed early (GeneratorExit) is not an error
+        self.finish(error=exc_type is not None and issubclass(exc_type, Exception))
+        return False
+
+    def add_usage(self, prompt_tokens, completion_tokens):
+        """
+        Add the token usage of one chat completion (may be called from several threads)
+        """
+        with self._lock:
+            self.prompt_tokens += prompt_tokens or 0
+            self.completion_tokens += completion_tokens or 0
+
+    def finish(self, error=False):
+        self.latency = time.perf_counter() - self._start
+        self.error = error
+        self.cost = self.router.cost(self)
+        self.router.record(self)
+
+    def to_dict(self):
+        return {
+            "kind": self.kind, "rule": self.rule, "model": self.model, "seconds": self.seconds,
+            "tokens": self.tokens, "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens, "latency": self.latency, "cost": self.cost,
+            "error": self.error,
+        }
+
+
+class ModelRouter:
+    """
+    Picks models from a policy table and keeps statistics per rule
+    """
+
+    def __init__(self, policy=None, history=200):
+        self.policy = policy or DEFAULT_POLICY
+        self.prices = dict(DEFAULT_POLICY['prices'], **self.policy.get('prices', {}))
+        for kind in ('transcription', 'summary'):
+            if not self.policy.get(kind):
+                raise ValueError(f'Model policy has no {kind} rules')
+            for rule in self.policy[kind]:
+                if 'model' not in rule:
+                    raise ValueError(f'Model policy rule without a model: {rule}')
+        # Identifies the policy in cache keys, so changing it does not reuse old results
+        self.fingerprint = hashlib.sha256(json.dumps(
+            {kind: self.policy[kind] for kind in ('transcription', 'summary')}, sort_keys=True
+        ).encode('utf-8')).hexdigest()[:16]
+        self.recent = deque(maxlen=history)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def transcription(self, seconds):
+        """
+        Decision for transcribing audio of the given duration (None if unknown)
+        """
+        return Decision(self, 'transcription', self._match('transcription', seconds=seconds), seconds=seconds)
+
+    def summary(self, tokens):
+        """
+        Decision for summarizing a transcript of the given estimated token count
+        """
+        return Decision(self, 'summary', self._match('summary', tokens=tokens), tokens=tokens)
+
+    def cost(self, decision):
+        """
+        Estimated cost in USD of a finished decision, or None without a price
+        """
+        price = self.prices.get(decision.model)
+        if not price:
+            return None
+        if decision.kind == 'transcription':
+            if decision.seconds is None or 'per_hour' not in price:
+                return None
+            return decision.seconds / 3600.0 * price['per_hour']
+        return (decision.prompt_tokens * price.get('input', 0.0)
+                + decision.completion_tokens * price.get('output', 0.0)) / 1000000.0
+
+    def record(self, decision):
+        model_decisions.inc(kind=decision.kind, rule=decision.rule, model=decision.model)
+        model_latency.observe(decision.latency, kind=decision.kind, model=decision.model)
+        if decision.cost:
+            model_cost.inc(decision.cost, kind=decision.kind, model=decision.model)
+        with self._lock:
+            self.recent.append(decision.to_dict())
+            entry = self._stats.setdefault((decision.kind, decision.rule, decision.model), {
+                "count": 0, "errors": 0, "latency": 0.0, "cost": 0.0})
+            entry["count"] += 1
+            entry["errors"] += decision.error
+            entry["latency"] += decision.latency
+            entry["cost"] += decision.cost or 0.0
+        print(f"Model routing: {decision.kind} rule={decision.rule} model={decision.model} "
+              f"latency={decision.latency:.3f}s cost=${decision.cost or 0.0:.6f}")
+
+    def stats(self):
+        """
+        Per-rule decision counts, average latency and cost, and the latest decisions
+        """
+        with self._lock:
+            rules = [{"kind": kind, "rule": rule, "model": model, "count": entry["count"],
+                      "errors": entry["errors"], "average_latency": entry["latency"] / entry["count"],
+                      "average_cost": entry["cost"] / entry["count"], "total_cost": entry["cost"]}
+                     for (kind, rule, model), entry in sorted(self._stats.items())]
+            recent = list(self.recent)
+        return {"policy": self.policy, "fingerprint": self.fingerprint, "rules": rules, "recent": recent}
+
+    def _match(self, kind, **measures):
+        for rule in self.policy[kind]:
+            if all(self._within(limit, rule[limit], measures.get(measure))
+                   for limit, measure in RULE_LIMITS.items() if limit in rule):
+                return rule
+        # No rule matched (a policy without a catch-all rule), use the last one
+        return self.policy[kind][-1]
+
+    @staticmethod
+    def _within(limit, bound, value):
+        if value is None:
+            return False
+        return value <= bound if limit.startswith('max') else value >= bound
+
+
+def load_policy(value):
+    """
+    Parse MODEL_POLICY: a JSON document or the path of a JSON file
+    """
+    if value.lstrip().startswith('{'):
+        return json.loads(value)
+    with open(value) as f:
+        return json.load(f)
+
+
+def create_model_router():
+    """
+    Build the model router configured through environment variables
+
+    MODEL_POLICY         - JSON policy or path to a JSON file (default: DEFAULT_POLICY)
+    MODEL_ROUTING_HISTORY - number of recent decisions kept for /routing/stats (default: 200)
+    """
+    value = os.getenv('MODEL_POLICY')
+    policy = load_policy(value) if value else None
+    return ModelRouter(policy, history=int(os.getenv('MODEL_ROUTING_HISTORY', '200')))
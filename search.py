@@ -0,0 +1,230 @@
+"""
+Full-text search over saved transcriptions for Staky AI
+
+Transcriptions are indexed in an embedded SQLite FTS5 store (an inverted
+index) when they are saved, so searching never scans the transcriptions
+table. The index is local to each server, so before searching, the
+transcriptions saved since the user's last sync (on any server, or before
+the index existed) are read from the database in (created_at, id) order
+and indexed. The index keeps the sync cursor of every user.
+
+The user ID is indexed as a column of its own and every query matches it
+together with the search words, so FTS5 only ranks the user's documents
+instead of matching the words across all users and filtering afterwards.
+
+Results are ranked with BM25, matches in the file name weighing more than
+matches in the summary, which weighs more than the raw transcript, and come
+with a highlighted snippet of the best matching column.
+
+Backends:
+1. sqlite - FTS5 index in a local database file (default)
+2. none   - search disabled
+"""
+
+import html
+import os
+import re
+import sqlite3
+import threading
+
+# Marks placed around matches by snippet(), replaced after HTML escaping
+_MATCH_START = '\x02'
+_MATCH_END = '\x03'
+
+# Most words of a query that are used, so a pasted paragraph cannot make a huge query
+MAX_QUERY_TERMS = 16
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    rowid INTEGER PRIMARY KEY,
+    transcription_id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    filename TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS documents_user_idx ON documents (user_id, created_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    user_id, filename, summary, raw_transcription,
+    tokenize = 'porter unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    user_id TEXT PRIMARY KEY,
+    created_at TEXT,
+    transcription_id TEXT,
+    synced_at REAL NOT NULL
+);
+"""
+
+# Tables of index files written before the user_id column; the index is rebuilt from the database
+_OLD_TABLES = ('documents_fts', 'documents', 'indexed_users')
+
+# Columns of documents_fts that snippets are taken from (user_id is column 0)
+_TEXT_COLUMNS = (1, 2, 3)
+
+
+def fts_query(text):
+    """
+    Turn free text into an FTS5 query matching documents that contain every word
+    Words are quoted so FTS5 operators in the input are searched for literally;
+    the last word also matches as a prefix, for search-as-you-type
+    """
+    words = re.findall(r'\w+', text or '')[:MAX_QUERY_TERMS]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def user_query(user_id, query):
+    """
+    Restrict an FTS5 query to one user's documents and to the text columns
+    """
+    user_phrase = '"' + str(user_id).replace('"', '""') + '"'
+    return f'user_id : {user_phrase} AND {{filename summary raw_transcription}} : ({query})'
+
+
+def snippet_html(snippet):
+    """
+    Escape a snippet for HTML and wrap the matches in <mark>
+    """
+    return html.escape(snippet).replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>')
+
+
+class SQLiteSearchIndex:
+    """
+    FTS5 index of transcriptions in a SQLite file, shared by all threads
+
+    Each thread uses its own connection; the database runs in WAL mode so
+    searches are not blocked while a save is being indexed.
+    """
+    available = True
+
+    def __init__(self, path, weights=(5.0, 2.0, 1.0)):
+        self.path = path
+        self.weights = weights
+        self._local = threading.local()
+        with self._connection() as connection:
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(documents_fts)")]
+            if columns and 'user_id' not in columns:
+                for table in _OLD_TABLES:
+                    connection.execute(f"DROP TABLE IF EXISTS {table}")
+            connection.executescript(_SCHEMA)
+
+    def add(self, rows):
+        """
+        Index (or re-index) transcription rows
+        Rows are dicts with id, user_id, filename, summary, raw_transcription and created_at
+        """
+        with self._connection() as connection:
+            for row in rows:
+                rowid = connection.execute(
+                    "INSERT INTO documents (transcription_id, user_id, filename, created_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (transcription_id) DO UPDATE SET filename = excluded.filename RETURNING rowid",
+                    (str(row['id']), str(row['user_id']), row.get('filename'), row.get('created_at'))
+                ).fetchone()[0]
+                connection.execute("DELETE FROM documents_fts WHERE rowid = ?", (rowid,))
+                connection.execute(
+                    "INSERT INTO documents_fts (rowid, user_id, filename, summary, raw_transcription) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (rowid, str(row['user_id']), row.get('filename') or '', row.get('summary') or '',
+                     row.get('raw_transcription') or ''))
+
+    def search(self, user_id, text, limit=20, offset=0):
+        """
+        Ranked matches of text in the user's transcriptions, best first
+        Returns dicts with id, filename, created_at and snippet_html
+        """
+        query = fts_query(text)
+        if query is None:
+            return []
+        query = user_query(user_id, query)
+        snippets = ', '.join(f"snippet(documents_fts, {column}, '{_MATCH_START}', '{_MATCH_END}', '…', 24)"
+                             for column in _TEXT_COLUMNS)
+        try:
+            rows = self._connection().execute(
+                f"SELECT d.transcription_id, d.filename, d.created_at, {snippets} "
+                "FROM documents_fts JOIN documents d ON d.rowid = documents_fts.rowid "
+                "WHERE documents_fts MATCH ? AND d.user_id = ? "
+                "ORDER BY bm25(documents_fts, 0.0, ?, ?, ?) LIMIT ? OFFSET ?",
+                (query, str(user_id), *self.weights, limit, offset)).fetchall()
+        except sqlite3.OperationalError as e:
+            # Queries are built from quoted words only, so this is unexpected - log and find nothing
+            print(f"Warning: search query {query!r} failed: {e}")
+            return []
+        # The snippet of the column with the most matches, like snippet() picks with column -1,
+        # which would pick the user_id column here
+        return [{"id": transcription_id, "filename": filename, "created_at": created_at,
+                 "snippet_html": snippet_html(max(snippets, key=lambda snippet: snippet.count(_MATCH_START)))}
+                for transcription_id, filename, created_at, *snippets in rows]
+
+    def sync_state(self, user_id):
+        """
+        Where the last sync of a user's transcriptions stopped
+        Returns (cursor, synced_at) - cursor is the (created_at, id) of the last
+        transcription indexed, or None - or None if the user was never synced
+        """
+        row = self._connection().execute(
+            "SELECT created_at, transcription_id, synced_at FROM sync_state WHERE user_id = ?",
+            (str(user_id),)).fetchone()
+        if row is None:
+            return None
+        created_at, transcription_id, synced_at = row
+        return ((created_at, transcription_id) if transcription_id else None), synced_at
+
+    def set_sync_state(self, user_id, cursor, synced_at):
+        created_at, transcription_id = cursor or (None, None)
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO sync_state (user_id, created_at, transcription_id, synced_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET created_at = excluded.created_at, "
+                "transcription_id = excluded.transcription_id, synced_at = excluded.synced_at",
+                (str(user_id), created_at, transcription_id, synced_at))
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+
+class NullSearchIndex:
+    """
+    Search disabled: nothing is indexed and searches find nothing
+    """
+    available = False
+
+    def add(self, rows):
+        pass
+
+    def search(self, user_id, text, limit=20, offset=0):
+        return []
+
+    def sync_state(self, user_id):
+        return None
+
+    def set_sync_state(self, user_id, cursor, synced_at):
+        pass
+
+
+def create_search_index():
+    """
+    Build the search index configured through environment variables
+
+    SEARCH_BACKEND    - sqlite or none (default: sqlite)
+    SEARCH_INDEX_PATH - SQLite database file (default: search_index.db)
+    """
+    backend = os.getenv('SEARCH_BACKEND', 'sqlite')
+    if backend == 'sqlite':
+        try:
+            return SQLiteSearchIndex(os.getenv('SEARCH_INDEX_PATH', 'search_index.db'))
+        except sqlite3.Error as e:
+            # e.g. a SQLite build without FTS5 - run without search rather than not at all
+            print(f"Warning: search index unavailable: {e}")
+            return NullSearchIndex()
+    if backend == 'none':
+        return NullSearchIndex()
+    raise ValueError(f'Unknown search backend: {backend}')
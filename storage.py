@@ -0,0 +1,474 @@
+"""
+Storage of users and transcriptions for Staky AI
+
+The routes read and write users and transcriptions through one interface
+(Storage) with two implementations:
+
+1. SupabaseStorage - the Supabase (PostgREST) tables, used for logged-in
+                     users while the database is available
+2. SQLiteStorage   - users and transcriptions in an embedded SQLite file,
+                     the history of a single-user install without Supabase,
+                     so saving, the dashboard and the transcription pages
+                     still work
+
+Rows are plain dicts with the column names of the Supabase tables, so the
+routes do not depend on the backend. Columns are passed as the same comma
+separated lists PostgREST selects take.
+
+Keyset cursors are (created_at, id) of the last row of the previous page.
+"""
+
+import datetime
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from clients import is_connection_error
+from metrics import timed
+
+USER_COLUMNS = ('id', 'name', 'email', 'created_at', 'usage_count', 'is_admin')
+
+TRANSCRIPTION_COLUMNS = ('id', 'user_id', 'filename', 'raw_transcription', 'summary', 'summary_html',
+                         'preview', 'created_at')
+
+# Columns the transcriptions table may lack in Supabase, detected by detect_columns()
+OPTIONAL_TRANSCRIPTION_COLUMNS = ('preview', 'summary_html')
+
+# PostgREST and Postgres error codes for a function that does not exist
+MISSING_FUNCTION_CODES = ('PGRST202', '42883', '404')
+
+# Seconds before the increment_usage_counts function is tried again after it was found missing
+INCREMENT_REPROBE_SECONDS = 300
+
+
+def is_missing_function(error):
+    """
+    True for the error PostgREST returns when an RPC function does not exist
+    """
+    return str(getattr(error, 'code', '')) in MISSING_FUNCTION_CODES
+
+
+class Storage:
+    """
+    Interface implemented by every storage backend
+    """
+    preview_available = False
+    summary_html_available = False
+
+    def insert_user(self, row):
+        raise NotImplementedError
+
+    def get_user(self, user_id, columns, stage='users_select'):
+        """
+        One user's row with the given columns, or None
+        """
+        raise NotImplementedError
+
+    def update_user(self, user_id, changes, stage='users_update'):
+        raise NotImplementedError
+
+    def list_users(self, columns, sort, desc, q, offset, limit, count=True):
+        """
+        One page of users sorted by sort (then id), optionally filtered by a
+        case-insensitive prefix of email or name
+        Returns (rows, total); total is None unless count is true
+        """
+        raise NotImplementedError
+
+    def increment_usage(self, deltas):
+        """
+        Add usage increments {user_id: amount} and return the new counts
+        """
+        raise NotImplementedError
+
+    def usage_count(self, user_id):
+        user = self.get_user(user_id, 'usage_count', stage='users_select_usage')
+        return (user.get('usage_count') or 0) if user else 0
+
+    def transcription_rows(self, rows):
+        """
+        Rows without the optional columns the backend does not have
+        """
+        return rows
+
+    def insert_transcriptions(self, rows):
+        """
+        Insert transcription rows and return the inserted rows
+        """
+        raise NotImplementedError
+
+    def get_transcription(self, user_id, transcription_id, columns, stage='transcriptions_select'):
+        """
+        One of the user's transcriptions, or None if it does not exist or belongs to someone else
+        """
+        raise NotImplementedError
+
+    def update_transcription(self, user_id, transcription_id, changes, stage='transcriptions_update'):
+        raise NotImplementedError
+
+    def list_transcriptions(self, user_id, columns, limit, before=None, stage='transcriptions_list'):
+        """
+        The user's transcriptions newest first, continuing before the (created_at, id) cursor
+        """
+        raise NotImplementedError
+
+    def list_transcriptions_ascending(self, user_id, columns, limit, after=None, since=None,
+                                      stage='transcriptions_page'):
+        """
+        The user's transcriptions oldest first, continuing after the (created_at, id)
+        cursor, or else after the since timestamp
+        """
+        raise NotImplementedError
+
+
+class SupabaseStorage(Storage):
+    """
+    Users and transcriptions in the Supabase tables
+
+    client  - the Supabase client (or a lazy wrapper around it)
+    execute - execute(stage, query) runs a query, with timing and circuit breaking
+    """
+
+    def __init__(self, client, execute):
+        self.client = client
+        self.execute = execute
+        self.preview_available = False
+        self.summary_html_available = False
+        self.columns_checked = False
+        self.increment_available = True
+        self.increment_checked_at = 0.0
+
+    def detect_columns(self):
+        """
+        Check which optional transcriptions columns exist
+        Queries bypass execute() so this can run from the health probe
+        """
+        self.preview_available = self._column_exists('transcriptions', 'preview')
+        if not self.preview_available:
+            print("Note: transcriptions.preview column not found, the dashboard will list transcriptions without previews")
+        self.summary_html_available = self._column_exists('transcriptions', 'summary_html')
+        if not self.summary_html_available:
+            print("Note: transcriptions.summary_html column not found, summaries will be rendered when viewed")
+        self.columns_checked = True
+
+    def insert_user(self, row):
+        self.execute('users_insert', self.client.table('users').insert(row))
+
+    def get_user(self, user_id, columns, stage='users_select'):
+        """
+        One user's row with the given columns, or None
+        """
+        result = self.execute(stage, self.client.table('users').select(columns).eq('id', user_id))
+        return result.data[0] if result.data else None
+
+    def update_user(self, user_id, changes, stage='users_update'):
+        self.execute(stage, self.client.table('users').update(changes).eq('id', user_id))
+
+    def list_users(self, columns, sort, desc, q, offset, limit, count=True):
+        """
+        One page of users sorted by sort (then id), optionally filtered by a
+        case-insensitive prefix of email or name
+        Returns (rows, total); total is None unless count is true
+        """
+        query = self.client.table('users').select(columns, count='exact' if count else None)
+        if q:
+            query = query.or_(f'email.ilike.{q}*,name.ilike.{q}*')
+        query = query.order(sort, desc=desc).order('id', desc=desc).range(offset, offset + limit - 1)
+        result = self.execute('users_list', query)
+        return result.data, (result.count or 0) if count else None
+
+    def increment_usage(self, deltas):
+        """
+        Add usage increments {user_id: amount} and return the new counts
+        Uses the increment_usage_counts SQL function so the increments are
+        atomic; only while that function is missing is each count read and
+        written back. A missing function is looked for again every
+        INCREMENT_REPROBE_SECONDS. Any other error is raised, so the caller
+        keeps the increments and retries them
+        """
+        if self.increment_available or time.monotonic() - self.increment_checked_at >= INCREMENT_REPROBE_SECONDS:
+            payload = [{"user_id": str(user_id), "amount": amount} for user_id, amount in deltas.items()]
+            try:
+                result = self.execute('users_increment_usage',
+                                      self.client.rpc('increment_usage_counts', {"deltas": payload}))
+            except Exception as e:
+                if is_connection_error(e) or not is_missing_function(e):
+                    raise
+                if self.increment_available:
+                    print("Note: increment_usage_counts function not found, usage counts will be "
+                          f"read and written back by this process ({e})")
+                self.increment_available = False
+                self.increment_checked_at = time.monotonic()
+            else:
+                self.increment_available = True
+                return {row['id']: row['usage_count'] for row in result.data}
+        counts = {}
+        for user_id, amount in deltas.items():
+            usage_count = self.usage_count(user_id) + amount
+            self.update_user(user_id, {"usage_count": usage_count}, stage='users_update_usage')
+            counts[user_id] = usage_count
+        return counts
+
+    def transcription_rows(self, rows):
+        """
+        Rows without the optional columns the table does not have
+        """
+        if self.summary_html_available:
+            return rows
+        return [{column: value for column, value in row.items() if column != 'summary_html'} for row in rows]
+
+    def insert_transcriptions(self, rows):
+        """
+        Insert transcription rows with one request and return the inserted rows
+        """
+        return self.execute('transcriptions_insert',
+                            self.client.table('transcriptions').insert(self.transcription_rows(rows))).data
+
+    def get_transcription(self, user_id, transcription_id, columns, stage='transcriptions_select'):
+        """
+        One of the user's transcriptions, or None if it does not exist or belongs to someone else
+        """
+        result = self.execute(stage, self.client.table('transcriptions').select(columns)
+                              .eq('id', transcription_id).eq('user_id', user_id))
+        return result.data[0] if result.data else None
+
+    def update_transcription(self, user_id, transcription_id, changes, stage='transcriptions_update'):
+        changes = self.transcription_rows([changes])[0]
+        self.execute(stage, self.client.table('transcriptions').update(changes)
+                     .eq('id', transcription_id).eq('user_id', user_id))
+
+    def list_transcriptions(self, user_id, columns, limit, before=None, stage='transcriptions_list'):
+        """
+        The user's transcriptions newest first, continuing before the (created_at, id) cursor
+        """
+        query = self.client.table('transcriptions').select(columns).eq('user_id', user_id)
+        if before:
+            created_at, row_id = before
+            query = query.or_(f'created_at.lt."{created_at}",'
+                              f'and(created_at.eq."{created_at}",id.lt."{row_id}")')
+        query = query.order('created_at', desc=True).order('id', desc=True).limit(limit)
+        return self.execute(stage, query).data
+
+    def list_transcriptions_ascending(self, user_id, columns, limit, after=None, since=None,
+                                      stage='transcriptions_page'):
+        """
+        The user's transcriptions oldest first, continuing after the (created_at, id)
+        cursor, or else after the since timestamp
+        """
+        query = self.client.table('transcriptions').select(columns).eq('user_id', user_id)
+        if after:
+            created_at, row_id = after
+            query = query.or_(f'created_at.gt."{created_at}",'
+                              f'and(created_at.eq."{created_at}",id.gt."{row_id}")')
+        elif since:
+            query = query.gt('created_at', since)
+        query = query.order('created_at').order('id').limit(limit)
+        return self.execute(stage, query).data
+
+    def _column_exists(self, table, column):
+        try:
+            self.client.table(table).select(column).limit(1).execute()
+            return True
+        except Exception as e:
+            if is_connection_error(e):
+                raise
+            return False
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    created_at TEXT NOT NULL,
+    usage_count INTEGER NOT NULL DEFAULT 0,
+    is_admin INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_created_idx ON users (created_at, id);
+CREATE TABLE IF NOT EXISTS transcriptions (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    filename TEXT,
+    raw_transcription TEXT,
+    summary TEXT,
+    summary_html TEXT,
+    created_at TEXT NOT NULL,
+    preview TEXT GENERATED ALWAYS AS (substr(summary, 1, 200)) VIRTUAL
+);
+CREATE INDEX IF NOT EXISTS transcriptions_user_created_idx ON transcriptions (user_id, created_at, id);
+"""
+
+
+class SQLiteStorage(Storage):
+    """
+    Users and transcriptions in an embedded SQLite file, shared by all threads
+
+    Each thread uses its own connection. The database runs in WAL mode so
+    reads are never blocked by a write, and batches of rows are written
+    with one statement in one transaction (one fsync per batch at most).
+    Transcriptions are listed from the (user_id, created_at, id) index.
+    Usage increments are added in SQL, in one transaction per batch.
+    """
+    preview_available = True
+    summary_html_available = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(_SCHEMA)
+
+    def insert_user(self, row):
+        row = dict(row, created_at=row.get('created_at') or datetime.datetime.now().isoformat())
+        names = _columns(','.join(row), USER_COLUMNS)
+        with timed('local_users_insert'), self._connection() as connection:
+            connection.execute(f"INSERT INTO users ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                               [row[name] for name in names])
+
+    def get_user(self, user_id, columns, stage='users_select'):
+        with timed(f'local_{stage}'):
+            row = self._connection().execute(
+                f"SELECT {', '.join(_columns(columns, USER_COLUMNS))} FROM users WHERE id = ?",
+                (str(user_id),)).fetchone()
+        return _user_row(row) if row else None
+
+    def update_user(self, user_id, changes, stage='users_update'):
+        names = _columns(','.join(changes), USER_COLUMNS)
+        with timed(f'local_{stage}'), self._connection() as connection:
+            connection.execute(f"UPDATE users SET {', '.join(f'{name} = ?' for name in names)} WHERE id = ?",
+                               [changes[name] for name in names] + [str(user_id)])
+
+    def list_users(self, columns, sort, desc, q, offset, limit, count=True):
+        sort = _columns(sort, USER_COLUMNS)[0]
+        direction = 'DESC' if desc else 'ASC'
+        where, params = "1", []
+        if q:
+            pattern = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            where, params = "(email LIKE ? ESCAPE '\\' OR name LIKE ? ESCAPE '\\')", [pattern, pattern]
+        connection = self._connection()
+        with timed('local_users_list'):
+            rows = connection.execute(
+                f"SELECT {', '.join(_columns(columns, USER_COLUMNS))} FROM users WHERE {where} "
+                f"ORDER BY {sort} {direction}, id {direction} LIMIT ? OFFSET ?", params + [limit, offset]).fetchall()
+            total = connection.execute(f"SELECT count(*) FROM users WHERE {where}", params).fetchone()[0] if count else None
+        return [_user_row(row) for row in rows], total
+
+    def increment_usage(self, deltas):
+        counts = {}
+        with timed('local_users_increment_usage'), self._connection() as connection:
+            for user_id, amount in deltas.items():
+                connection.execute("UPDATE users SET usage_count = usage_count + ? WHERE id = ?",
+                                   (amount, str(user_id)))
+                row = connection.execute("SELECT usage_count FROM users WHERE id = ?", (str(user_id),)).fetchone()
+                if row:
+                    counts[user_id] = row[0]
+        return counts
+
+    def insert_transcriptions(self, rows):
+        """
+        Insert transcription rows in one transaction and return the inserted rows
+        Rows without an id get a random UUID, like rows inserted into Supabase
+        """
+        rows = [dict(row, id=str(row.get('id') or uuid.uuid4()),
+                     created_at=row.get('created_at') or datetime.datetime.now().isoformat())
+                for row in rows]
+        names = [name for name in TRANSCRIPTION_COLUMNS if name != 'preview']
+        with timed('local_transcriptions_insert'), self._connection() as connection:
+            connection.executemany(
+                f"INSERT INTO transcriptions ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                [[row.get(name) for name in names] for row in rows])
+        return rows
+
+    def get_transcription(self, user_id, transcription_id, columns, stage='transcriptions_select'):
+        with timed(f'local_{stage}'):
+            row = self._connection().execute(
+                f"SELECT {', '.join(_columns(columns, TRANSCRIPTION_COLUMNS))} FROM transcriptions "
+                "WHERE id = ? AND user_id = ?", (str(transcription_id), str(user_id))).fetchone()
+        return dict(row) if row else None
+
+    def update_transcription(self, user_id, transcription_id, changes, stage='transcriptions_update'):
+        names = _columns(','.join(changes), TRANSCRIPTION_COLUMNS)
+        with timed(f'local_{stage}'), self._connection() as connection:
+            connection.execute(
+                f"UPDATE transcriptions SET {', '.join(f'{name} = ?' for name in names)} WHERE id = ? AND user_id = ?",
+                [changes[name] for name in names] + [str(transcription_id), str(user_id)])
+
+    def list_transcriptions(self, user_id, columns, limit, before=None, stage='transcriptions_list'):
+        where, params = "user_id = ?", [str(user_id)]
+        if before:
+            where += " AND (created_at, id) < (?, ?)"
+            params += list(before)
+        with timed(f'local_{stage}'):
+            rows = self._connection().execute(
+                f"SELECT {', '.join(_columns(columns, TRANSCRIPTION_COLUMNS))} FROM transcriptions "
+                f"WHERE {where} ORDER BY created_at DESC, id DESC LIMIT ?", params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_transcriptions_ascending(self, user_id, columns, limit, after=None, since=None,
+                                      stage='transcriptions_page'):
+        where, params = "user_id = ?", [str(user_id)]
+        if after:
+            where += " AND (created_at, id) > (?, ?)"
+            params += list(after)
+        elif since:
+            where += " AND created_at > ?"
+            params.append(since)
+        with timed(f'local_{stage}'):
+            rows = self._connection().execute(
+                f"SELECT {', '.join(_columns(columns, TRANSCRIPTION_COLUMNS))} FROM transcriptions "
+                f"WHERE {where} ORDER BY created_at, id LIMIT ?", params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+
+def _user_row(row):
+    """
+    A users row as a dict, with is_admin as a bool like the Supabase column
+    """
+    row = dict(row)
+    if 'is_admin' in row:
+        row['is_admin'] = bool(row['is_admin'])
+    return row
+
+
+def _columns(columns, allowed):
+    """
+    Column names from a comma separated list, checked against the table's columns
+    """
+    names = [name.strip() for name in columns.split(',') if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise ValueError(f'Unknown columns: {", ".join(unknown)}')
+    return names
+
+
+def create_local_storage():
+    """
+    Build the storage used without Supabase, configured through environment variables
+    Returns None when local history is turned off
+
+    LOCAL_STORAGE      - sqlite or none (default: sqlite)
+    LOCAL_STORAGE_PATH - SQLite database file (default: staky_local.db)
+    """
+    backend = os.getenv('LOCAL_STORAGE', 'sqlite')
+    if backend == 'sqlite':
+        try:
+            return SQLiteStorage(os.getenv('LOCAL_STORAGE_PATH', 'staky_local.db'))
+        except sqlite3.Error as e:
+            # e.g. a SQLite build without generated columns - run without local history
+            print(f"Warning: local storage unavailable: {e}")
+            return None
+    if backend == 'none':
+        return None
+    raise ValueError(f'Unknown local storage backend: {backend}')
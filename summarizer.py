@@ -0,0 +1,225 @@
+"""
+Hierarchical (map-reduce) summarization for Staky AI
+
+Transcripts of long meetings do not fit in the context window of the
+summary model. They are split into token-sized chunks, each chunk is
+summarized concurrently (map), and the partial summaries are merged into
+one headed markdown document (reduce). If the partial summaries are still
+too long to merge in one request, they are reduced again in groups.
+
+The module does not talk to Groq directly. Callers pass a complete()
+function taking (system_prompt, user_text) and returning the model reply.
+summarize_async() does the same with an async complete() function.
+"""
+
+import asyncio
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Prompts used for the map and reduce passes
+MAP_PROMPT = "you are given one part of a longer transcript. summarize this part in markdown, keeping every important detail, decision, name, number and action item. use short headings where helpful. do not use hr elements. do not include any message from your side."
+REDUCE_PROMPT = "you are given partial summaries of consecutive parts of one transcript. merge them into a single well arranged summary in markdown. use headings and subheadings without overdoing it, remove repetition between the parts and make sure that you dont miss any important details. do not use hr elements. do not include any message from your side."
+
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def estimate_tokens(text):
+    """
+    Rough token count for llama-style tokenizers
+    Uses the larger of ~4 characters per token and ~1.3 tokens per word
+    """
+    return int(max(len(text) / 4.0, len(text.split()) * 1.3))
+
+
+def chunk_transcript(text, max_tokens):
+    """
+    Split a transcript into chunks of at most max_tokens estimated tokens
+    Chunks end at sentence boundaries; overly long sentences are split by words
+    """
+    pieces = []
+    for sentence in _SENTENCE_END.split(text.strip()):
+        if estimate_tokens(sentence) <= max_tokens:
+            pieces.append(sentence)
+            continue
+        words = sentence.split()
+        step = max(1, int(max_tokens / 1.3))
+        pieces.extend(' '.join(words[i:i + step]) for i in range(0, len(words), step))
+
+    chunks, current, current_tokens = [], [], 0
+    for piece in pieces:
+        piece_tokens = estimate_tokens(piece) + 1
+        if current and current_tokens + piece_tokens > max_tokens:
+            chunks.append(' '.join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+
+def summarize(complete, text, system_prompt, chunk_tokens=5000, workers=4, timings=None,
+              reduce_prompt=REDUCE_PROMPT):
+    """
+    Summarize text, using map-reduce when it is longer than chunk_tokens
+
+    complete      - function(system_prompt, user_text) -> reply text
+    system_prompt - prompt used when the text fits in a single request
+    reduce_prompt - prompt of the final merge of partial summaries, so
+                    long texts can be summarized in the same style
+    timings       - optional dict filled with per-stage latency in seconds
+                    ('chunk', 'map', 'reduce') and the number of chunks
+    """
+    if timings is None:
+        timings = {}
+
+    start = time.perf_counter()
+    chunks = chunk_transcript(text, chunk_tokens)
+    timings['chunk'] = time.perf_counter() - start
+    timings['chunks'] = len(chunks)
+
+    if len(chunks) <= 1:
+        start = time.perf_counter()
+        summary = complete(system_prompt, text)
+        timings['reduce'] = time.perf_counter() - start
+        return summary
+
+    partials = map_chunks(complete, chunks, workers, timings)
+
+    start = time.perf_counter()
+    summary = reduce_summaries(complete, partials, chunk_tokens, workers, reduce_prompt)
+    timings['reduce'] = time.perf_counter() - start
+    return summary
+
+
+def map_chunks(complete, chunks, workers=4, timings=None):
+    """
+    Summarize every chunk concurrently (map pass)
+    Returns the partial summaries in chunk order
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        partials = list(executor.map(lambda chunk: complete(MAP_PROMPT, chunk), chunks))
+    if timings is not None:
+        timings['map'] = time.perf_counter() - start
+    return partials
+
+
+def group_partials(complete, partials, chunk_tokens=5000, workers=4):
+    """
+    Shrink partial summaries until they fit in a single reduce request
+    Groups that fit in chunk_tokens are merged concurrently, level by level
+    """
+    while len(partials) > 1 and estimate_tokens('\n\n'.join(partials)) > chunk_tokens:
+        groups = group_by_tokens(partials, chunk_tokens)
+        if len(groups) == len(partials):
+            # Every partial is already as large as a chunk, merging cannot shrink further
+            break
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            partials = list(executor.map(lambda group: complete(REDUCE_PROMPT, '\n\n'.join(group)), groups))
+    return partials
+
+
+def group_by_tokens(partials, chunk_tokens):
+    """
+    Split partial summaries into consecutive groups of at most chunk_tokens
+    """
+    groups, current = [], []
+    for partial in partials:
+        if current and estimate_tokens('\n\n'.join(current + [partial])) > chunk_tokens:
+            groups.append(current)
+            current = []
+        current.append(partial)
+    groups.append(current)
+    return groups
+
+
+def reduce_summaries(complete, partials, chunk_tokens=5000, workers=4, reduce_prompt=REDUCE_PROMPT):
+    """
+    Merge partial summaries into the final markdown document (reduce pass)
+    """
+    partials = group_partials(complete, partials, chunk_tokens, workers)
+    if len(partials) == 1 and reduce_prompt == REDUCE_PROMPT:
+        return partials[0]
+    return complete(reduce_prompt, '\n\n'.join(partials))
+
+
+def summarize_stream(complete, complete_stream, text, system_prompt, chunk_tokens=5000, workers=4, timings=None):
+    """
+    Streaming variant of summarize() that yields the summary piece by piece
+
+    complete_stream - function(system_prompt, user_text) yielding reply tokens
+
+    Only the final request is streamed: the whole summary for short texts,
+    or the reduce pass after the map pass has finished for long ones.
+    """
+    if timings is None:
+        timings = {}
+
+    start = time.perf_counter()
+    chunks = chunk_transcript(text, chunk_tokens)
+    timings['chunk'] = time.perf_counter() - start
+    timings['chunks'] = len(chunks)
+
+    if len(chunks) <= 1:
+        prompt, user_text = system_prompt, text
+    else:
+        partials = map_chunks(complete, chunks, workers, timings)
+        partials = group_partials(complete, partials, chunk_tokens, workers)
+        if len(partials) == 1:
+            yield partials[0]
+            return
+        prompt, user_text = REDUCE_PROMPT, '\n\n'.join(partials)
+
+    start = time.perf_counter()
+    for token in complete_stream(prompt, user_text):
+        if 'first_token' not in timings:
+            timings['first_token'] = time.perf_counter() - start
+        yield token
+    timings['reduce'] = time.perf_counter() - start
+
+
+async def summarize_async(complete, text, system_prompt, chunk_tokens=5000, workers=4, timings=None):
+    """
+    Async variant of summarize()
+
+    complete - async function(system_prompt, user_text) -> reply text
+    At most workers requests of the map and reduce passes run at once
+    """
+    if timings is None:
+        timings = {}
+
+    start = time.perf_counter()
+    chunks = chunk_transcript(text, chunk_tokens)
+    timings['chunk'] = time.perf_counter() - start
+    timings['chunks'] = len(chunks)
+
+    if len(chunks) <= 1:
+        start = time.perf_counter()
+        summary = await complete(system_prompt, text)
+        timings['reduce'] = time.perf_counter() - start
+        return summary
+
+    slots = asyncio.Semaphore(workers)
+
+    async def limited(prompt, user_text):
+        async with slots:
+            return await complete(prompt, user_text)
+
+    start = time.perf_counter()
+    partials = await asyncio.gather(*(limited(MAP_PROMPT, chunk) for chunk in chunks))
+    timings['map'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    while len(partials) > 1 and estimate_tokens('\n\n'.join(partials)) > chunk_tokens:
+        groups = group_by_tokens(partials, chunk_tokens)
+        if len(groups) == len(partials):
+            break
+        partials = await asyncio.gather(*(limited(REDUCE_PROMPT, '\n\n'.join(group)) for group in groups))
+    if len(partials) == 1:
+        summary = partials[0]
+    else:
+        summary = await complete(REDUCE_PROMPT, '\n\n'.join(partials))
+    timings['reduce'] = time.perf_counter() - start
+    return summary
@@ -0,0 +1,101 @@
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, TokenBucket
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(rate=1.0, capacity=2)
+    bucket.tokens = 0
+    start = bucket.updated_at
+    assert bucket.wait_time() == pytest.approx(1.0)
+    bucket.refill(start + 0.5)
+    assert bucket.tokens == pytest.approx(0.5)
+    bucket.refill(start + 10)
+    assert bucket.tokens == 2
+
+
+def test_burst_then_rate_limited():
+    controller = AdmissionController(tier_limits={'free': (3600, 2)})
+    controller.reserve('u1', 'free').release()
+    controller.reserve('u1', 'free').release()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.reserve('u1', 'free')
+    assert rejected.value.retry_after >= 1
+    # Buckets are per user
+    controller.reserve('u2', 'free').release()
+
+
+def test_queue_full_and_release():
+    controller = AdmissionController(tier_limits={'free': (3600, 100)}, max_concurrent=1, max_waiting=1)
+    first = controller.reserve('u1', 'free')
+    second = controller.reserve('u2', 'free')
+    with pytest.raises(AdmissionRejected):
+        controller.reserve('u3', 'free')
+    second.release()
+    second.release()
+    assert controller.stats()['default']['waiting'] == 1
+    controller.reserve('u3', 'free').release()
+    first.release()
+
+
+def test_ticket_holds_a_slot_while_used():
+    controller = AdmissionController(max_concurrent=1, max_waiting=4)
+    with controller.reserve('u1', 'free'):
+        stats = controller.stats()['default']
+        assert stats['running'] == 1
+    stats = controller.stats()['default']
+    assert stats['running'] == 0 and stats['waiting'] == 0
+
+
+def test_released_ticket_cannot_be_used():
+    controller = AdmissionController()
+    ticket = controller.reserve('u1', 'free')
+    ticket.release()
+    with pytest.raises(AdmissionRejected):
+        ticket.acquire()
+
+
+def test_admins_use_their_own_lane():
+    controller = AdmissionController(max_concurrent=1, max_waiting=0)
+    user_ticket = controller.reserve('u1', 'free')
+    admin_ticket = controller.reserve('admin1', 'admin')
+    assert admin_ticket.lane.name == 'admin'
+    admin_ticket.release()
+    user_ticket.release()
+
+
+def test_token_and_lane_place_can_be_taken_separately():
+    controller = AdmissionController(tier_limits={'free': (3600, 1)}, max_concurrent=1, max_waiting=0)
+    controller.take_token('u1', 'free')
+    with pytest.raises(AdmissionRejected):
+        controller.take_token('u1', 'free')
+    # The token was already taken, so the lane place does not need another one
+    ticket = controller.reserve('u1', 'free', charge=False)
+    with pytest.raises(AdmissionRejected):
+        controller.reserve('u2', 'free', charge=False)
+    ticket.release()
+
+
+def test_admit_waits_for_a_slot_even_when_the_queue_is_full():
+    controller = AdmissionController(max_concurrent=1, max_waiting=0)
+    upload = controller.reserve('u1', 'free')
+    window = controller.admit('free')
+    assert controller.stats()['default']['waiting'] == 2
+    upload.release()
+    with window:
+        assert controller.stats()['default']['running'] == 1
+    assert controller.stats()['default']['waiting'] == 0
+
+
+def test_refund_returns_the_token_of_an_unprocessed_upload():
+    controller = AdmissionController(tier_limits={'free': (1, 1)})
+    ticket = controller.reserve('u1', 'free')
+    ticket.refund()
+    ticket.refund()
+    assert controller.stats()['default']['waiting'] == 0
+    with controller.reserve('u1', 'free') as ticket:
+        pass
+    # A ticket that held a slot keeps its token
+    ticket.refund()
+    with pytest.raises(AdmissionRejected):
+        controller.reserve('u1', 'free')
@@ -0,0 +1,114 @@
+import math
+import struct
+import wave
+
+import pytest
+
+from audio import merge_segment_texts, preprocess_wav, split_wav, write_wav
+
+
+def tone(seconds, rate=8000, silence_every=None):
+    """
+    16-bit mono PCM: a tone, with a short quiet gap every silence_every seconds
+    """
+    samples = []
+    for i in range(int(seconds * rate)):
+        quiet = silence_every and (i / rate) % silence_every < 0.2
+        samples.append(0 if quiet else int(8000 * math.sin(2 * math.pi * 440 * i / rate)))
+    return struct.pack(f'<{len(samples)}h', *samples)
+
+
+def wav_file(path, pcm, rate=8000, channels=1):
+    with wave.open(str(path), 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm)
+    return str(path)
+
+
+def frames(path):
+    with wave.open(path, 'rb') as wav:
+        return wav.getnframes()
+
+
+def test_merge_removes_repeated_overlap():
+    texts = ['the meeting started with the budget review', 'the budget review was followed by hiring plans']
+    assert merge_segment_texts(texts) == 'the meeting started with the budget review was followed by hiring plans'
+
+
+def test_merge_ignores_mis_transcribed_edge_words():
+    merged = merge_segment_texts(['alpha beta gamma delta epsi', 'gamma delta epsilon zeta'])
+    assert merged == 'alpha beta gamma delta epsilon zeta'
+
+
+def test_merge_without_overlap_joins_texts():
+    assert merge_segment_texts(['one two', 'three four']) == 'one two three four'
+    assert merge_segment_texts([]) == ''
+
+
+def test_short_file_is_not_split(tmp_path):
+    path = wav_file(tmp_path / 'short.wav', tone(2))
+    assert split_wav(path, str(tmp_path), segment_seconds=5) == [path]
+
+
+def test_split_covers_the_whole_file_with_overlap(tmp_path):
+    path = wav_file(tmp_path / 'long.wav', tone(30, silence_every=4))
+    segments = split_wav(path, str(tmp_path), segment_seconds=10, overlap_seconds=1, search_seconds=2)
+    assert len(segments) >= 3
+    assert all(frames(segment) <= 10 * 8000 for segment in segments)
+    assert sum(frames(segment) for segment in segments) >= frames(path)
+
+
+def test_split_search_window_is_clamped_to_the_segment(tmp_path):
+    # A search window longer than the segment used to let every cut land
+    # right after the overlap, producing a large number of tiny segments
+    path = wav_file(tmp_path / 'clamped.wav', tone(12))
+    segments = split_wav(path, str(tmp_path), segment_seconds=5, overlap_seconds=1, search_seconds=30)
+    assert len(segments) == 4
+    assert min(frames(segment) for segment in segments[:-1]) >= 5 * 8000 * 3 // 4
+
+
+def test_preprocess_downmixes_resamples_and_trims(tmp_path):
+    pytest.importorskip('numpy')
+    rate = 44100
+    speech = tone(2, rate=rate)
+    silence = b'\x00\x00' * rate
+    mono = silence + speech + silence
+    stereo = b''.join(mono[i:i + 2] * 2 for i in range(0, len(mono), 2))
+    path = wav_file(tmp_path / 'stereo.wav', stereo, rate=rate, channels=2)
+
+    out_path = preprocess_wav(path, str(tmp_path), target_rate=16000)
+    with wave.open(out_path, 'rb') as wav:
+        assert wav.getnchannels() == 1
+        assert wav.getframerate() == 16000
+        duration = wav.getnframes() / 16000
+    assert 2.0 <= duration < 3.0
+
+
+def test_preprocess_skips_silence_and_non_wav(tmp_path):
+    pytest.importorskip('numpy')
+    assert preprocess_wav(wav_file(tmp_path / 'silent.wav', b'\x00\x00' * 8000), str(tmp_path)) is None
+    other = tmp_path / 'audio.mp3'
+    other.write_bytes(b'ID3 not a wav file')
+    assert preprocess_wav(str(other), str(tmp_path)) is None
+
+
+def test_preprocess_removes_partial_output_on_error(tmp_path, monkeypatch):
+    np = pytest.importorskip('numpy')
+    path = wav_file(tmp_path / 'in.wav', tone(1, rate=44100), rate=44100)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('resampling failed')
+    monkeypatch.setattr(np, 'interp', fail)
+    with pytest.raises(RuntimeError):
+        preprocess_wav(path, str(tmp_path), target_rate=16000)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['in.wav']
+
+
+def test_write_wav_round_trip(tmp_path):
+    pcm = tone(1)
+    path = str(tmp_path / 'out.wav')
+    write_wav(path, pcm, 8000)
+    with wave.open(path, 'rb') as wav:
+        assert wav.readframes(wav.getnframes()) == pcm
@@ -0,0 +1,58 @@
+import os
+import time
+
+from cache import DiskCache, MemoryCache, cache_key
+
+
+def age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_cache_key_depends_on_models():
+    assert cache_key('abc', 'm1') == cache_key('abc', 'm1')
+    assert cache_key('abc', 'm1') != cache_key('abc', 'm2')
+
+
+def test_memory_cache_hit_and_miss():
+    cache = MemoryCache()
+    assert cache.get('k') is None
+    cache.set('k', {'v': 1})
+    assert cache.get('k') == {'v': 1}
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+
+
+def test_disk_cache_round_trip(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.set('k', {'raw_text': 'hello'})
+    assert cache.get('k') == {'raw_text': 'hello'}
+    # A new instance sees the entries and their size
+    assert DiskCache(str(tmp_path)).size == cache.size
+
+
+def test_disk_cache_deletes_expired_entry_on_read(tmp_path):
+    cache = DiskCache(str(tmp_path), ttl=60)
+    cache.set('k', {'v': 1})
+    age(tmp_path / 'k.json', 120)
+    assert cache.get('k') is None
+    assert not (tmp_path / 'k.json').exists()
+    assert cache.size == 0
+
+
+def test_disk_cache_sweeps_expired_entries(tmp_path):
+    cache = DiskCache(str(tmp_path), ttl=60, sweep_interval=0)
+    cache.set('old', {'v': 1})
+    age(tmp_path / 'old.json', 120)
+    cache.set('new', {'v': 2})
+    assert sorted(os.listdir(tmp_path)) == ['new.json']
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=20)
+    cache.set('a', {'v': 'aaaa'})
+    age(tmp_path / 'a.json', 10)
+    cache.set('b', {'v': 'bbbb'})
+    assert cache.get('a') is None
+    assert cache.get('b') == {'v': 'bbbb'}
+    assert cache.size <= 20
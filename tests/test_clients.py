@@ -0,0 +1,82 @@
+import email.utils
+import time
+
+import httpx
+import pytest
+
+from clients import LazyClient, RetryPolicy, RetryTransport, retry_after_seconds
+
+
+def response(status, headers=None):
+    return httpx.Response(status, headers=headers, request=httpx.Request('GET', 'http://test/'))
+
+
+def test_retry_after_accepts_seconds_milliseconds_and_dates():
+    assert retry_after_seconds(response(429, {'retry-after': '3'})) == 3.0
+    assert retry_after_seconds(response(429, {'retry-after-ms': '1500', 'retry-after': '9'})) == 1.5
+    date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < retry_after_seconds(response(503, {'retry-after': date})) <= 60
+    assert retry_after_seconds(response(503)) is None
+
+
+def test_retry_decisions_depend_on_what_may_have_been_processed():
+    policy = RetryPolicy('test', max_retries=2)
+    assert policy.retry_reason(0, False, error=httpx.ConnectError('refused')) == ('connect', None)
+    # A POST that timed out may still be running on the server
+    assert policy.retry_reason(0, True, error=httpx.ReadTimeout('slow'), idempotent=False) is None
+    assert policy.retry_reason(0, True, error=httpx.ReadTimeout('slow'), idempotent=True) == ('read', None)
+    assert policy.retry_reason(0, False, response=response(500)) is None
+    assert policy.retry_reason(0, False, response=response(503, {'retry-after': '2'})) == ('503', 2.0)
+    assert policy.retry_reason(0, True, response=response(404)) is None
+    assert policy.retry_reason(2, True, response=response(503)) is None
+
+
+def test_backoff_uses_full_jitter_and_caps_retry_after():
+    policy = RetryPolicy('test', backoff_base=1.0, backoff_max=5.0)
+    assert all(0 <= policy.backoff(2) <= 4.0 for _ in range(50))
+    assert policy.backoff(10) <= 5.0
+    assert policy.backoff(0, retry_after=60) == 5.0
+
+
+def scripted(monkeypatch, statuses):
+    calls = []
+
+    def handle_request(self, request):
+        calls.append(request)
+        return httpx.Response(statuses[len(calls) - 1], request=request)
+    monkeypatch.setattr(httpx.HTTPTransport, 'handle_request', handle_request)
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    return calls
+
+
+def test_transport_retries_until_success(monkeypatch):
+    calls = scripted(monkeypatch, [503, 502, 200])
+    with httpx.Client(transport=RetryTransport('test-retry')) as client:
+        assert client.get('http://test/').status_code == 200
+    assert len(calls) == 3
+
+
+def test_streamed_post_bodies_are_sent_once(monkeypatch):
+    calls = scripted(monkeypatch, [500, 200])
+    transport = RetryTransport('test-stream', retry_non_idempotent=True, max_buffer_bytes=4)
+    with httpx.Client(transport=transport) as client:
+        body = iter([b'audio ', b'data that is not buffered'])
+        assert client.post('http://test/', content=body).status_code == 500
+    assert len(calls) == 1
+
+
+def test_lazy_client_retries_a_failed_factory():
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError('down')
+        return 'client'
+    lazy = LazyClient(factory)
+    assert not lazy.initialized
+    with pytest.raises(ConnectionError):
+        lazy.get()
+    assert lazy.get() == 'client'
+    assert lazy.get() == 'client'
+    assert len(attempts) == 2
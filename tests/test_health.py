@@ -0,0 +1,48 @@
+from health import CircuitBreaker, HealthMonitor
+
+
+def test_breaker_opens_at_threshold_and_closes_on_success():
+    changes = []
+    breaker = CircuitBreaker(failure_threshold=3, on_change=changes.append)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.closed
+    breaker.record_failure()
+    assert breaker.is_open
+    assert breaker.stats()['state'] == 'open'
+    breaker.record_failure()
+    breaker.record_success()
+    assert breaker.closed
+    assert breaker.failures == 0
+    assert changes == [False, True]
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.closed
+
+
+def test_trip_opens_at_once():
+    breaker = CircuitBreaker(failure_threshold=5)
+    breaker.record_failure(trip=True)
+    assert breaker.is_open
+
+
+def test_first_failed_probe_opens_the_breaker():
+    def probe():
+        raise ConnectionError('database missing')
+    breaker = CircuitBreaker(failure_threshold=3)
+    monitor = HealthMonitor(probe, breaker)
+    assert not monitor.check(first=True)
+    assert breaker.is_open
+    assert monitor.last_error == 'database missing'
+
+
+def test_check_closes_the_breaker_when_the_probe_succeeds():
+    breaker = CircuitBreaker(is_open=True)
+    monitor = HealthMonitor(lambda: None, breaker)
+    assert monitor.check()
+    assert breaker.closed
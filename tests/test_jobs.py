@@ -0,0 +1,55 @@
+import threading
+import time
+
+import pytest
+
+from jobs import LocalJobQueue, QueueFullError, JOB_DONE, JOB_FAILED
+
+
+def wait_finished(job, timeout=5):
+    deadline = time.time() + timeout
+    while not job.finished and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+def test_job_result_and_owner():
+    queue = LocalJobQueue(max_workers=1)
+    job = queue.submit(lambda job, a, b: a + b, 2, 3, owner='u1')
+    wait_finished(job)
+    assert job.status == JOB_DONE
+    assert job.result == 5
+    assert queue.get(job.id) is job
+    assert job.owner == 'u1'
+    queue.shutdown()
+
+
+def test_failed_job_records_error():
+    def fail(job):
+        raise RuntimeError('boom')
+
+    queue = LocalJobQueue(max_workers=1)
+    job = wait_finished(queue.submit(fail))
+    assert job.status == JOB_FAILED
+    assert job.error == 'boom'
+    queue.shutdown()
+
+
+def test_submit_refuses_when_full():
+    release = threading.Event()
+    queue = LocalJobQueue(max_workers=1, max_pending=2)
+    queue.submit(lambda job: release.wait(5))
+    queue.submit(lambda job: release.wait(5))
+    with pytest.raises(QueueFullError):
+        queue.submit(lambda job: None)
+    release.set()
+    queue.shutdown()
+
+
+def test_finished_jobs_expire():
+    queue = LocalJobQueue(max_workers=1, result_ttl=0)
+    job = wait_finished(queue.submit(lambda job: 'done'))
+    job.finished_at -= 1
+    queue.submit(lambda job: None)
+    assert queue.get(job.id) is None
+    queue.shutdown()
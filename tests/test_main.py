@@ -0,0 +1,336 @@
+import io
+import json
+import os
+import re
+import time
+import zipfile
+
+import pytest
+
+from admission import create_admission_controller
+from cache import MemoryCache
+from search import SQLiteSearchIndex
+from storage import SQLiteStorage
+
+
+@pytest.fixture(scope='session')
+def main(tmp_path_factory):
+    # Import the app in local-only mode, with its data files in a temp directory
+    data = tmp_path_factory.mktemp('staky')
+    env = pytest.MonkeyPatch()
+    env.setenv('API_KEY', 'test')
+    env.delenv('SUPABASE_URL', raising=False)
+    env.delenv('SUPABASE_KEY', raising=False)
+    env.setenv('SEARCH_INDEX_PATH', str(data / 'search_index.db'))
+    env.setenv('LOCAL_STORAGE_PATH', str(data / 'staky_local.db'))
+    import main
+    main.app.secret_key = 'test'
+    yield main
+    env.undo()
+
+
+@pytest.fixture
+def app(main, monkeypatch, tmp_path):
+    # Groq is replaced by canned transcripts and summaries; every test gets empty storage
+    monkeypatch.setattr(main, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(main.recording_store, 'upload_folder', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(main, 'local_storage', SQLiteStorage(str(tmp_path / 'local.db')))
+    monkeypatch.setattr(main, 'search_index', SQLiteSearchIndex(str(tmp_path / 'search.db')))
+    monkeypatch.setattr(main, 'result_cache', MemoryCache())
+    monkeypatch.setattr(main, 'admission', create_admission_controller())
+    monkeypatch.setattr(main, 'transcribe_audio', lambda filename, path: f'transcript of {filename}')
+    monkeypatch.setattr(main, 'summarize_transcript', lambda text, style='default': f'# Summary\n\n{style}: {text}')
+    monkeypatch.setattr(main, 'stream_summary', lambda text: iter(['# Summary', '\n\n', text]))
+    return main
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
+
+
+def saved_rows(app):
+    return app.local_storage.list_transcriptions(app.LOCAL_USER_ID, 'id, filename, summary, raw_transcription', 50)
+
+
+def audio(data=b'audio bytes', name='memo.mp3'):
+    return {"file": (io.BytesIO(data), name)}
+
+
+def test_upload_is_transcribed_summarized_and_saved(client, app):
+    response = client.post('/file_upload', data=audio(), content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert b'transcript of memo.mp3' in response.data
+    assert b'<h1>Summary</h1>' in response.data
+    assert [(row['filename'], row['raw_transcription']) for row in saved_rows(app)] == [
+        ('memo.mp3', 'transcript of memo.mp3')]
+    assert os.listdir(app.UPLOAD_FOLDER) == []
+
+
+def test_upload_without_audio_goes_back_to_the_workshop(client):
+    response = client.post('/file_upload', data={}, content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/workshop')
+
+
+def wait_for_job(client, job):
+    deadline = time.time() + 10
+    status = client.get(job['status_url']).get_json()
+    while status['status'] not in ('done', 'failed') and time.time() < deadline:
+        time.sleep(0.05)
+        status = client.get(job['status_url']).get_json()
+    return status
+
+
+def test_job_mode_returns_a_job_to_poll(client, app):
+    response = client.post('/file_upload?mode=job', data=audio(), content_type='multipart/form-data')
+    assert response.status_code == 202
+    job = response.get_json()
+    assert wait_for_job(client, job)['status'] == 'done'
+    result = client.get(job['result_url'])
+    assert result.status_code == 200
+    assert b'transcript of memo.mp3' in result.data
+    assert len(saved_rows(app)) == 1
+    assert client.get('/jobs/unknown').status_code == 404
+
+
+def sse_events(body):
+    events = []
+    for block in body.decode('utf-8').strip().split('\n\n'):
+        event, data = block.split('\n')
+        events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+def test_stream_mode_sends_transcript_tokens_and_rendered_summary(client, app):
+    page = client.post('/file_upload?mode=stream', data=audio(), content_type='multipart/form-data')
+    assert page.status_code == 200
+    stream_url = re.search(r"new EventSource\('([^']+)'\)", page.get_data(as_text=True)).group(1)
+    events = sse_events(client.get(stream_url).data)
+    assert events[0] == ('transcription', 'transcript of memo.mp3')
+    assert ''.join(data for event, data in events if event == 'token') == '# Summary\n\ntranscript of memo.mp3'
+    assert events[-1][0] == 'done'
+    assert '<h1>Summary</h1>' in events[-1][1]
+    assert len(saved_rows(app)) == 1
+    # Each stream is delivered once
+    assert sse_events(client.get(stream_url).data)[0][0] == 'failed'
+
+
+def test_repeated_stream_upload_is_answered_from_the_cache(client, app):
+    for _ in range(2):
+        page = client.post('/file_upload?mode=stream', data=audio(), content_type='multipart/form-data')
+        stream_url = re.search(r"new EventSource\('([^']+)'\)", page.get_data(as_text=True)).group(1)
+        events = sse_events(client.get(stream_url).data)
+    assert [event for event, _ in events] == ['transcription', 'token', 'done']
+
+
+def test_chunked_recording_is_processed_when_finished(client, app):
+    recording = client.post('/recordings', data={"mime_type": "audio/webm;codecs=opus"}).get_json()
+    assert recording['live'] is False
+    assert client.post(recording['chunk_url'] + '?seq=0', data=b'first ').get_json() == {"received": 6}
+    # A retried chunk is ignored and a gap is refused
+    assert client.post(recording['chunk_url'] + '?seq=0', data=b'first ').get_json() == {"received": 6}
+    assert client.post(recording['chunk_url'] + '?seq=2', data=b'third').status_code == 409
+    assert client.post(recording['chunk_url'] + '?seq=1', data=b'second').get_json() == {"received": 12}
+    response = client.post(recording['finish_url'])
+    assert response.status_code == 200
+    assert b'transcript of browser-recording.webm' in response.data
+    assert len(saved_rows(app)) == 1
+    assert client.post(recording['finish_url']).status_code == 302
+
+
+def test_live_recording_is_transcribed_while_recording(client, app):
+    recording = client.post('/recordings', data={"mime_type": "audio/pcm", "sample_rate": "16000"}).get_json()
+    assert recording['live'] is True
+    client.post(recording['chunk_url'] + '?seq=0', data=b'\x00\x00' * 16000)
+    assert client.get(recording['transcript_url']).get_json()['windows_done'] == 0
+    response = client.post(recording['finish_url'] + '?mode=job')
+    assert response.status_code == 202
+    assert wait_for_job(client, response.get_json())['status'] == 'done'
+    assert saved_rows(app)[0]['raw_transcription'].startswith('transcript of ')
+
+
+def test_discarded_recording_is_gone(client):
+    recording = client.post('/recordings', data={"mime_type": "audio/webm"}).get_json()
+    assert client.delete(recording['recording_url']).status_code == 204
+    assert client.post(recording['chunk_url'] + '?seq=0', data=b'late').status_code == 404
+
+
+@pytest.fixture
+def rendered(app, monkeypatch):
+    # Records the template context of pages whose templates are not part of the repository
+    pages = []
+
+    def render_template(name, **context):
+        pages.append(context)
+        return name
+    monkeypatch.setattr(app, 'render_template', render_template)
+    return pages
+
+
+@pytest.fixture
+def admin_client(client, app, monkeypatch, tmp_path):
+    users = SQLiteStorage(str(tmp_path / 'users.db'))
+    for i, name in enumerate(['Ann', 'Bob', 'Anna', 'Cid', 'Andy']):
+        users.insert_user({"id": f"u{i}", "name": name, "email": f"{name.lower()}@example.com",
+                           "created_at": f"2024-01-01T00:00:0{i}", "usage_count": i, "is_admin": i == 0})
+    monkeypatch.setattr(app, 'supabase_storage', users)
+    monkeypatch.setattr(app, 'user_counts', {})
+    monkeypatch.setattr(app, 'ADMIN_PAGE_SIZE', 2)
+    with client.session_transaction() as session:
+        session['user_id'] = 'u0'
+        session['is_admin'] = True
+    return client
+
+
+def test_admin_listing_is_paged_sorted_and_searched(admin_client, rendered):
+    admin_client.get('/admin?sort=name&order=asc')
+    page = rendered[-1]
+    assert [user['name'] for user in page['users']] == ['Andy', 'Ann']
+    assert (page['total'], page['pages'], page['prev_url']) == (5, 3, None)
+    assert 'page=2' in page['next_url'] and 'sort=name' in page['next_url']
+    admin_client.get('/admin?sort=name&order=asc&page=3')
+    assert [user['name'] for user in rendered[-1]['users']] == ['Cid']
+    admin_client.get('/admin?q=an&sort=usage_count&order=desc')
+    page = rendered[-1]
+    assert [user['name'] for user in page['users']] == ['Andy', 'Anna']
+    assert page['total'] == 3
+    assert 'q=an' in page['next_url']
+    assert page['list_args'] == {"page": 1, "sort": "usage_count", "order": "desc", "q": "an"}
+
+
+def test_admin_toggle_returns_to_the_same_page(admin_client, app):
+    response = admin_client.post('/admin/toggle_admin/u1', data={"page": "2", "sort": "email", "q": "b"})
+    assert response.status_code == 302
+    assert 'page=2' in response.headers['Location'] and 'q=b' in response.headers['Location']
+    assert app.supabase_storage.get_user('u1', 'is_admin') == {"is_admin": True}
+
+
+def test_admin_listing_needs_an_admin(client):
+    with client.session_transaction() as session:
+        session['user_id'] = 'u1'
+    assert client.get('/admin').headers['Location'].endswith('/dashboard')
+
+
+def save_row(app, filename='memo.mp3', raw_text='we agreed on the budget', summary='# Budget'):
+    return app.local_storage.insert_transcriptions([app.transcription_row(
+        app.LOCAL_USER_ID, filename, raw_text, summary)])[0]['id']
+
+
+def test_unchanged_transcription_is_answered_with_304(client, app):
+    row_id = save_row(app)
+    response = client.get(f'/transcription/{row_id}')
+    assert response.status_code == 200
+    assert b'<h1>Budget</h1>' in response.data
+    etag = response.headers['ETag']
+    repeat = client.get(f'/transcription/{row_id}', headers={"If-None-Match": etag})
+    assert repeat.status_code == 304
+    assert repeat.data == b''
+    app.local_storage.update_transcription(app.LOCAL_USER_ID, row_id, {"summary": "# New budget"})
+    assert client.get(f'/transcription/{row_id}', headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_missing_transcription_redirects_to_the_dashboard(client):
+    assert client.get('/transcription/999').headers['Location'].endswith('/dashboard')
+
+
+def test_batch_streams_one_line_per_file_and_saves_once(client, app, monkeypatch):
+    def transcribe_audio(filename, path):
+        if filename == 'broken.mp3':
+            raise RuntimeError('unreadable audio')
+        return f'transcript of {filename}'
+    monkeypatch.setattr(app, 'transcribe_audio', transcribe_audio)
+    files = [(io.BytesIO(f'audio {name}'.encode()), name) for name in ('a.mp3', 'broken.mp3', 'c.mp3')]
+    response = client.post('/batch_upload', data={"files": files}, content_type='multipart/form-data')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    results = {line['filename']: line for line in lines[:-1]}
+    assert results['a.mp3']['status'] == 'done' and results['a.mp3']['index'] == 0
+    assert results['broken.mp3'] == {"index": 1, "filename": "broken.mp3", "status": "failed",
+                                     "error": "unreadable audio"}
+    assert lines[-1] == {"status": "complete", "saved": 2}
+    assert sorted(row['filename'] for row in saved_rows(app)) == ['a.mp3', 'c.mp3']
+
+
+def test_batch_needs_files(client, app, monkeypatch):
+    assert client.post('/batch_upload', data={}, content_type='multipart/form-data').status_code == 400
+    monkeypatch.setattr(app, 'BATCH_MAX_FILES', 1)
+    files = [(io.BytesIO(b'audio'), name) for name in ('a.mp3', 'b.mp3')]
+    assert client.post('/batch_upload', data={"files": files}, content_type='multipart/form-data').status_code == 400
+
+
+def test_search_finds_saved_transcriptions_page_by_page(client, app, monkeypatch):
+    monkeypatch.setattr(app, 'SEARCH_PAGE_SIZE', 1)
+    first = save_row(app, 'q1.mp3', 'the budget for the first quarter', '# Q1')
+    second = save_row(app, 'q2.mp3', 'budget and budget again for the second quarter', '# Q2')
+    save_row(app, 'party.mp3', 'plans for the office party', '# Party')
+    results = client.get('/search?q=budget').get_json()
+    assert [match['id'] for match in results['results']] == [str(second)]
+    assert '<mark>budget</mark>' in results['results'][0]['snippet_html']
+    assert results['results'][0]['url'] == f'/transcription/{second}'
+    results = client.get(results['next_url']).get_json()
+    assert [match['id'] for match in results['results']] == [str(first)]
+    assert results['next_url'] is None
+
+
+def test_new_uploads_are_searchable_at_once(client, app):
+    assert client.get('/search?q=memo').get_json()['results'] == []
+    client.post('/file_upload', data=audio(), content_type='multipart/form-data')
+    assert [match['filename'] for match in client.get('/search?q=memo').get_json()['results']] == ['memo.mp3']
+
+
+def save_dated_rows(app, count):
+    return app.local_storage.insert_transcriptions([
+        {"user_id": app.LOCAL_USER_ID, "filename": f"memo {i}.mp3", "raw_transcription": f"transcript {i}",
+         "summary": f"summary {i}", "created_at": f"2024-01-0{i + 1}T09:00:00"} for i in range(count)])
+
+
+def test_export_streams_ndjson_oldest_first_in_pages(client, app, monkeypatch):
+    monkeypatch.setattr(app, 'EXPORT_PAGE_SIZE', 2)
+    save_dated_rows(app, 3)
+    response = client.get('/export')
+    assert response.mimetype == 'application/x-ndjson'
+    assert 'attachment; filename="staky-transcriptions-' in response.headers['Content-Disposition']
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row['filename'] for row in rows] == ['memo 0.mp3', 'memo 1.mp3', 'memo 2.mp3']
+    assert set(rows[0]) == {'id', 'filename', 'created_at', 'summary', 'raw_transcription'}
+    newer = client.get('/export?since=2024-01-02T09:00:00').get_data(as_text=True).splitlines()
+    assert [json.loads(line)['filename'] for line in newer] == ['memo 2.mp3']
+
+
+def test_export_zip_has_one_markdown_file_per_transcription(client, app):
+    rows = save_dated_rows(app, 2)
+    response = client.get('/export?format=zip')
+    assert response.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        names = archive.namelist()
+        assert names == [f"2024-01-0{i + 1}_memo_{i}_{str(row['id'])[:8]}.md" for i, row in enumerate(rows)]
+        assert '## Transcript\n\ntranscript 1' in archive.read(names[1]).decode('utf-8')
+
+
+def test_export_checks_its_arguments(client):
+    assert client.get('/export?format=csv').status_code == 400
+    assert client.get('/export?since=yesterday').status_code == 400
+
+
+def test_resummarize_caches_each_style_and_saves_on_request(client, app, monkeypatch):
+    calls = []
+
+    def summarize_transcript(text, style='default'):
+        calls.append(style)
+        return f'# {style}\n\n{text}'
+    monkeypatch.setattr(app, 'summarize_transcript', summarize_transcript)
+    row_id = save_row(app)
+    first = client.post(f'/transcription/{row_id}/summary', json={"style": "brief"}).get_json()
+    assert (first['summary'], first['cached'], first['saved']) == ('# brief\n\nwe agreed on the budget', False, False)
+    assert first['summary_html'] == '<h1>brief</h1>\n<p>we agreed on the budget</p>'
+    again = client.post(f'/transcription/{row_id}/summary', data={"style": "brief", "save": "1"}).get_json()
+    assert (again['cached'], again['saved']) == (True, True)
+    assert calls == ['brief']
+    assert app.local_storage.get_transcription(app.LOCAL_USER_ID, row_id, 'summary')['summary'].startswith('# brief')
+
+
+def test_resummarize_refuses_unknown_styles_and_transcriptions(client, app):
+    row_id = save_row(app)
+    assert client.post(f'/transcription/{row_id}/summary', json={"style": "haiku"}).status_code == 400
+    assert client.post('/transcription/999/summary', json={"style": "brief"}).status_code == 404
@@ -0,0 +1,62 @@
+import pytest
+from flask import Flask, g
+
+from metrics import Registry, server_timing_header, stage_duration, stage_errors, timed
+
+
+def test_counter_and_gauge_render_with_labels():
+    registry = Registry()
+    counter = registry.counter('test_requests_total', 'Requests', ['status'])
+    gauge = registry.gauge('test_in_flight', 'In flight')
+    counter.inc(status=200)
+    counter.inc(2, status=200)
+    counter.inc(status='5"xx')
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    text = registry.render()
+    assert '# TYPE test_requests_total counter' in text
+    assert 'test_requests_total{status="200"} 3' in text
+    assert 'test_requests_total{status="5\\"xx"} 1' in text
+    assert 'test_in_flight 1' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 5.0):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="1.0"} 3' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_count 4' in lines
+    assert 'test_latency_seconds_sum 6.25' in lines
+
+
+def test_collectors_add_lines():
+    registry = Registry()
+    registry.add_collector(lambda: ['test_cache_hits 7'])
+    assert registry.render() == 'test_cache_hits 7\n'
+
+
+def stage_count(stage):
+    entry = stage_duration._values.get((stage,))
+    return entry['count'] if entry else 0
+
+
+def test_timed_records_duration_errors_and_request_timings():
+    app = Flask(__name__)
+    with app.test_request_context('/'):
+        with timed('test_stage'):
+            pass
+        with pytest.raises(ValueError):
+            with timed('test_stage'):
+                raise ValueError('failed')
+        assert set(g.server_timings) == {'test_stage'}
+    assert stage_count('test_stage') == 2
+    assert stage_errors._values[('test_stage',)] == 1
+
+
+def test_server_timing_header_is_in_milliseconds():
+    assert server_timing_header({"whisper": 1.23456, "total": 2.0}) == 'whisper;dur=1234.6, total;dur=2000.0'
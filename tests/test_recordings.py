@@ -0,0 +1,99 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from recordings import RecordingError, RecordingStore
+
+
+class FakeSlot:
+    """
+    Counts the windows transcribed inside an admission slot
+    """
+
+    def __init__(self):
+        self.entered = 0
+        self.active = 0
+
+    def __enter__(self):
+        self.entered += 1
+        self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.active -= 1
+        return False
+
+
+@pytest.fixture
+def store(tmp_path):
+    def transcribe(filename, path):
+        return filename
+    return RecordingStore(str(tmp_path), max_bytes=64000, transcribe=transcribe,
+                          executor=ThreadPoolExecutor(max_workers=2), window_seconds=1.0,
+                          overlap_seconds=0.1, search_seconds=0.2, max_open=1)
+
+
+def send(store, recording, data, chunk=16000):
+    for seq, start in enumerate(range(0, len(data), chunk)):
+        store.append(recording.id, recording.owner, seq, io.BytesIO(data[start:start + chunk]))
+
+
+def test_chunks_are_appended_in_order(store):
+    recording = store.create('u1', 'audio/webm')
+    store.append(recording.id, 'u1', 0, io.BytesIO(b'abc'))
+    store.append(recording.id, 'u1', 0, io.BytesIO(b'abc'))
+    with pytest.raises(RecordingError) as gap:
+        store.append(recording.id, 'u1', 2, io.BytesIO(b'ghi'))
+    assert gap.value.status == 409
+    store.append(recording.id, 'u1', 1, io.BytesIO(b'def'))
+    filename, path, transcript = store.finish(recording.id, 'u1')
+    with open(path, 'rb') as f:
+        assert f.read() == b'abcdef'
+    assert filename == 'browser-recording.webm' and transcript is None
+
+
+def test_open_recordings_are_capped_per_client(store):
+    store.create('u1', 'audio/webm')
+    with pytest.raises(RecordingError) as refused:
+        store.create('u1', 'audio/webm')
+    assert refused.value.status == 429
+    store.create('u2', 'audio/webm')
+
+
+def test_live_pcm_file_only_keeps_untranscribed_audio(store):
+    slot = FakeSlot()
+    recording = store.create('u1', 'audio/pcm', sample_rate=8000, admit=lambda: slot)
+    # 10 seconds of audio, far more than max_bytes
+    send(store, recording, b'\x10\x00' * 8000 * 10)
+    assert recording.size == 160000
+    assert os.path.getsize(recording.path) <= 64000
+    filename, path, transcript = store.finish(recording.id, 'u1')
+    assert path is None
+    assert len(recording.windows) >= 9
+    assert transcript()
+    # Every window's Groq call ran inside an admission slot
+    assert slot.entered == len(recording.windows) and slot.active == 0
+
+
+def test_discard_deletes_the_audio(store):
+    recording = store.create('u1', 'audio/webm')
+    store.discard(recording.id, 'u1')
+    assert not os.path.exists(recording.path)
+    with pytest.raises(RecordingError):
+        store.get(recording.id, 'u1')
+
+
+def test_non_wav_file_recordings_are_limited_to_one_request(tmp_path):
+    store = RecordingStore(str(tmp_path), max_bytes=64000, max_file_bytes=1000)
+    webm = store.create('user', 'audio/webm')
+    send(store, webm, b'\x1aE\xdf\xa3' + b'\0' * 996, chunk=500)
+    with pytest.raises(RecordingError) as error:
+        store.append(webm.id, 'user', 2, io.BytesIO(b'\0'))
+    assert error.value.status == 413
+
+    store.discard(webm.id, 'user')
+    wav = store.create('user', 'audio/wav')
+    send(store, wav, b'RIFF\0\0\0\0WAVE' + b'\0' * 1988, chunk=500)
+    assert store.get(wav.id, 'user').size == 2000
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from routing import DEFAULT_POLICY, ModelRouter, load_policy
+
+POLICY = {
+    "transcription": [
+        {"name": "memo", "max_seconds": 60, "model": "distil-whisper-large-v3-en"},
+        {"name": "default", "model": "whisper-large-v3-turbo"},
+    ],
+    "summary": [
+        {"name": "short", "max_tokens": 2000, "model": "llama-3.1-8b-instant"},
+        {"name": "long", "model": "llama3-70b-8192", "chunk_tokens": 5000},
+    ],
+}
+
+
+def test_first_matching_rule_is_used():
+    router = ModelRouter(POLICY)
+    assert router.transcription(30).model == 'distil-whisper-large-v3-en'
+    assert router.transcription(600).model == 'whisper-large-v3-turbo'
+    # An unknown duration never satisfies a max_seconds limit
+    assert router.transcription(None).rule == 'default'
+    assert router.summary(1500).model == 'llama-3.1-8b-instant'
+    long = router.summary(9000)
+    assert (long.model, long.chunk_tokens) == ('llama3-70b-8192', 5000)
+
+
+def test_decisions_record_cost_and_stats():
+    router = ModelRouter(POLICY)
+    with router.transcription(1800):
+        pass
+    with router.summary(9000) as decision:
+        decision.add_usage(1000000, 500000)
+    assert decision.cost == pytest.approx(0.59 + 0.395)
+    stats = router.stats()
+    assert [(rule['kind'], rule['rule'], rule['count']) for rule in stats['rules']] == [
+        ('summary', 'long', 1), ('transcription', 'default', 1)]
+    assert stats['recent'][0]['cost'] == pytest.approx(0.02)
+
+
+def test_failed_work_is_counted_as_an_error():
+    router = ModelRouter(POLICY)
+    with pytest.raises(RuntimeError):
+        with router.summary(10):
+            raise RuntimeError('groq failed')
+    assert router.stats()['rules'][0]['errors'] == 1
+
+
+def test_fingerprint_changes_with_the_policy():
+    assert ModelRouter(POLICY).fingerprint == ModelRouter(json.loads(json.dumps(POLICY))).fingerprint
+    assert ModelRouter(POLICY).fingerprint != ModelRouter(DEFAULT_POLICY).fingerprint
+
+
+def test_policy_needs_rules_with_models():
+    with pytest.raises(ValueError):
+        ModelRouter({"transcription": [], "summary": POLICY['summary']})
+    with pytest.raises(ValueError):
+        ModelRouter({"transcription": [{"name": "x"}], "summary": POLICY['summary']})
+
+
+def test_policy_loads_from_json_or_a_file(tmp_path):
+    assert load_policy(json.dumps(POLICY)) == POLICY
+    path = tmp_path / 'policy.json'
+    path.write_text(json.dumps(POLICY))
+    assert load_policy(str(path)) == POLICY
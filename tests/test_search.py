@@ -0,0 +1,28 @@
+from search import SQLiteSearchIndex
+
+
+def row(row_id, user_id, summary, filename='memo.wav'):
+    return {"id": row_id, "user_id": user_id, "filename": filename, "summary": summary,
+            "raw_transcription": "", "created_at": "2024-01-01T00:00:00"}
+
+
+def test_search_only_returns_the_users_documents(tmp_path):
+    index = SQLiteSearchIndex(str(tmp_path / 'search.db'))
+    index.add([row('1', 'u1', 'quarterly budget review'), row('2', 'u2', 'budget budget budget')])
+    results = index.search('u1', 'budget')
+    assert [result['id'] for result in results] == ['1']
+    assert '<mark>budget</mark>' in results[0]['snippet_html']
+
+
+def test_prefix_and_operators_in_queries(tmp_path):
+    index = SQLiteSearchIndex(str(tmp_path / 'search.db'))
+    index.add([row('1', 'u1', 'hiring plans for next year')])
+    assert [result['id'] for result in index.search('u1', 'hir')] == ['1']
+    assert index.search('u1', 'NOT AND "') == []
+
+
+def test_sync_state_round_trip(tmp_path):
+    index = SQLiteSearchIndex(str(tmp_path / 'search.db'))
+    assert index.sync_state('u1') is None
+    index.set_sync_state('u1', ('2024-01-01T00:00:00', 'abc'), 100.0)
+    assert index.sync_state('u1') == (('2024-01-01T00:00:00', 'abc'), 100.0)
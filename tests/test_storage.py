@@ -0,0 +1,172 @@
+import pytest
+
+from storage import SQLiteStorage
+
+COLUMNS = 'id, user_id, filename, summary, preview, created_at'
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return SQLiteStorage(str(tmp_path / 'local.db'))
+
+
+def rows(user_id, count):
+    return [{"user_id": user_id, "filename": f"f{i}.wav", "raw_transcription": f"raw {i}",
+             "summary": f"summary {i}", "created_at": f"2024-01-01T00:00:{i:02d}"} for i in range(count)]
+
+
+def test_insert_assigns_ids_and_reads_back(storage):
+    inserted = storage.insert_transcriptions(rows('local', 1))
+    row = storage.get_transcription('local', inserted[0]['id'], COLUMNS)
+    assert row['filename'] == 'f0.wav'
+    assert row['preview'] == 'summary 0'
+    assert storage.get_transcription('someone-else', inserted[0]['id'], COLUMNS) is None
+
+
+def test_list_pages_newest_first_with_keyset_cursor(storage):
+    storage.insert_transcriptions(rows('local', 5) + rows('other', 2))
+    first = storage.list_transcriptions('local', COLUMNS, 3)
+    assert [row['filename'] for row in first] == ['f4.wav', 'f3.wav', 'f2.wav']
+    second = storage.list_transcriptions('local', COLUMNS, 3, before=(first[-1]['created_at'], first[-1]['id']))
+    assert [row['filename'] for row in second] == ['f1.wav', 'f0.wav']
+
+
+def test_list_ascending_after_cursor_and_since(storage):
+    storage.insert_transcriptions(rows('local', 4))
+    first = storage.list_transcriptions_ascending('local', COLUMNS, 2)
+    assert [row['filename'] for row in first] == ['f0.wav', 'f1.wav']
+    rest = storage.list_transcriptions_ascending('local', COLUMNS, 10,
+                                                 after=(first[-1]['created_at'], first[-1]['id']))
+    assert [row['filename'] for row in rest] == ['f2.wav', 'f3.wav']
+    since = storage.list_transcriptions_ascending('local', COLUMNS, 10, since='2024-01-01T00:00:02')
+    assert [row['filename'] for row in since] == ['f3.wav']
+
+
+def test_update_changes_only_the_users_row(storage):
+    inserted = storage.insert_transcriptions(rows('local', 1))
+    storage.update_transcription('other', inserted[0]['id'], {"summary": "hijacked"})
+    storage.update_transcription('local', inserted[0]['id'], {"summary": "new summary"})
+    row = storage.get_transcription('local', inserted[0]['id'], 'summary, preview')
+    assert row == {"summary": "new summary", "preview": "new summary"}
+
+
+def test_unknown_columns_are_refused(storage):
+    with pytest.raises(ValueError):
+        storage.list_transcriptions('local', 'id, password', 10)
+
+
+def add_users(storage):
+    for i, (name, email) in enumerate([('Ann', 'ann@example.com'), ('Bob', 'bob@example.com'),
+                                       ('Anna', 'anna@test.org')]):
+        storage.insert_user({"id": f"u{i}", "name": name, "email": email,
+                             "created_at": f"2024-01-01T00:00:0{i}", "usage_count": 0, "is_admin": i == 1})
+
+
+def test_users_read_back_with_boolean_admin_flag(storage):
+    add_users(storage)
+    assert storage.get_user('u1', 'name, is_admin') == {"name": "Bob", "is_admin": True}
+    storage.update_user('u1', {"is_admin": False})
+    assert storage.get_user('u1', 'is_admin') == {"is_admin": False}
+    assert storage.get_user('missing', 'name') is None
+
+
+def test_list_users_filters_by_prefix_sorts_and_counts(storage):
+    add_users(storage)
+    users, total = storage.list_users('id, name', 'name', False, 'an', 0, 1)
+    assert users == [{"id": "u0", "name": "Ann"}]
+    assert total == 2
+    users, total = storage.list_users('id', 'created_at', True, '', 1, 10, count=False)
+    assert [user['id'] for user in users] == ['u1', 'u0']
+    assert total is None
+    assert storage.list_users('id', 'name', False, '%', 0, 10)[1] == 0
+
+
+def test_sqlite_increment_usage_adds_to_the_stored_counts(storage):
+    add_users(storage)
+    assert storage.increment_usage({"u0": 2, "u1": 1, "missing": 1}) == {"u0": 2, "u1": 1}
+    assert storage.increment_usage({"u0": 3}) == {"u0": 5}
+    assert storage.usage_count('u0') == 5
+    assert storage.usage_count('missing') == 0
+
+
+class APIError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class FakeSupabase:
+    """
+    Supabase client stand-in: queries are (table or function, arguments) tuples run by execute()
+    """
+
+    def __init__(self):
+        self.counts = {'u1': 1}
+        self.rpc_error = None
+        self.rpc_calls = 0
+
+    def rpc(self, name, params):
+        return ('rpc', params)
+
+    def table(self, name):
+        return FakeQuery()
+
+    def execute(self, stage, query):
+        if stage == 'users_increment_usage':
+            self.rpc_calls += 1
+            if self.rpc_error:
+                raise self.rpc_error
+            for delta in query[1]['deltas']:
+                self.counts[delta['user_id']] += delta['amount']
+            return FakeResult([{"id": user_id, "usage_count": count} for user_id, count in self.counts.items()])
+        if stage == 'users_select_usage':
+            return FakeResult([{"usage_count": self.counts['u1']}])
+        self.counts['u1'] = query.changes['usage_count']
+        return FakeResult([])
+
+
+class FakeQuery:
+    def select(self, columns):
+        return self
+
+    def update(self, changes):
+        self.changes = changes
+        return self
+
+    def eq(self, column, value):
+        return self
+
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+
+def supabase_storage():
+    from storage import SupabaseStorage
+    fake = FakeSupabase()
+    return fake, SupabaseStorage(fake, fake.execute)
+
+
+def test_increment_errors_other_than_a_missing_function_are_raised():
+    fake, storage = supabase_storage()
+    fake.rpc_error = APIError('PGRST301')
+    with pytest.raises(APIError):
+        storage.increment_usage({'u1': 1})
+    assert storage.increment_available
+    fake.rpc_error = None
+    assert storage.increment_usage({'u1': 1}) == {'u1': 2}
+
+
+def test_missing_function_falls_back_and_is_probed_again(monkeypatch):
+    import storage as storage_module
+    fake, storage = supabase_storage()
+    fake.rpc_error = APIError('PGRST202')
+    assert storage.increment_usage({'u1': 2}) == {'u1': 3}
+    assert not storage.increment_available
+    storage.increment_usage({'u1': 1})
+    assert fake.rpc_calls == 1
+    monkeypatch.setattr(storage_module, 'INCREMENT_REPROBE_SECONDS', 0)
+    fake.rpc_error = None
+    assert storage.increment_usage({'u1': 1}) == {'u1': 5}
+    assert storage.increment_available and fake.rpc_calls == 2
@@ -0,0 +1,51 @@
+import threading
+
+from summarizer import MAP_PROMPT, REDUCE_PROMPT, chunk_transcript, estimate_tokens, summarize
+
+
+def sentences(count):
+    return ' '.join(f'Sentence number {i} talks about the quarterly budget.' for i in range(count))
+
+
+def test_chunks_respect_the_token_limit_and_keep_all_text():
+    text = sentences(200)
+    chunks = chunk_transcript(text, 100)
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk) <= 100 for chunk in chunks)
+    assert ' '.join(chunks).split() == text.split()
+
+
+def test_chunks_end_at_sentence_boundaries():
+    for chunk in chunk_transcript(sentences(50), 60):
+        assert chunk.endswith('.')
+
+
+def test_overly_long_sentence_is_split_by_words():
+    text = ' '.join(['word'] * 1000)
+    chunks = chunk_transcript(text, 100)
+    assert len(chunks) > 1
+    assert sum(len(chunk.split()) for chunk in chunks) == 1000
+
+
+def test_short_text_is_summarized_in_one_request():
+    calls = []
+    summary = summarize(lambda prompt, text: calls.append(prompt) or 'summary', 'Short text.', 'system')
+    assert summary == 'summary'
+    assert calls == ['system']
+
+
+def test_long_text_is_mapped_then_reduced():
+    calls = []
+    lock = threading.Lock()
+
+    def complete(prompt, text):
+        with lock:
+            calls.append(prompt)
+        return 'partial' if prompt == MAP_PROMPT else 'final'
+
+    timings = {}
+    summary = summarize(complete, sentences(200), 'system', chunk_tokens=100, timings=timings)
+    assert summary == 'final'
+    assert calls.count(MAP_PROMPT) == timings['chunks'] > 1
+    assert calls[-1] == REDUCE_PROMPT
+    assert 'system' not in calls
@@ -0,0 +1,101 @@
+import threading
+
+from usage import UsageAccounting
+
+
+class FakeDatabase:
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+        self.fail = False
+        self.increments = []
+
+    def increment(self, deltas):
+        if self.fail:
+            raise ConnectionError('database down')
+        self.increments.append(dict(deltas))
+        for user_id, amount in deltas.items():
+            self.counts[user_id] = self.counts.get(user_id, 0) + amount
+        return {user_id: self.counts[user_id] for user_id in deltas}
+
+    def fetch(self, user_id):
+        return self.counts.get(user_id, 0)
+
+
+def test_increments_are_buffered_and_flushed_together():
+    db = FakeDatabase({'u1': 2})
+    usage = UsageAccounting(db.increment, db.fetch)
+    assert usage.usage('u1') == 2
+    assert usage.add('u1') == 3
+    usage.add('u2', 2)
+    assert db.increments == []
+    usage.flush()
+    assert db.increments == [{'u1': 1, 'u2': 2}]
+    assert db.counts == {'u1': 3, 'u2': 2}
+    assert usage.stats()['pending'] == 0
+
+
+def test_failed_flush_is_requeued():
+    db = FakeDatabase()
+    usage = UsageAccounting(db.increment, db.fetch)
+    usage.add('u1')
+    db.fail = True
+    usage.flush()
+    assert usage.stats()['pending'] == 1
+    usage.add('u1')
+    db.fail = False
+    usage.flush()
+    assert db.counts == {'u1': 2}
+    assert usage.usage('u1') == 2
+
+
+def test_reservations_count_until_settled():
+    db = FakeDatabase()
+    usage = UsageAccounting(db.increment, db.fetch)
+    first = usage.reserve('u1', limit=1)
+    assert first is not None
+    assert usage.reserve('u1', limit=1) is None
+    first.release()
+    second = usage.reserve('u1', limit=1)
+    assert second.commit() == 1
+    second.release()
+    assert usage.usage('u1') == 1
+    assert usage.stats()['reserved'] == 0
+
+
+def test_reservation_can_be_extended_within_the_limit():
+    db = FakeDatabase()
+    usage = UsageAccounting(db.increment, db.fetch)
+    reservation = usage.reserve('u1', limit=3)
+    assert reservation.extend(2, limit=3)
+    assert not reservation.extend(1, limit=3)
+    assert usage.usage('u1') == 3
+
+
+def test_unsettled_reservations_expire():
+    db = FakeDatabase()
+    usage = UsageAccounting(db.increment, db.fetch, reservation_ttl=0)
+    usage.reserve('u1', limit=1)
+    assert usage.usage('u1') == 0
+
+
+def test_stale_fetch_does_not_overwrite_a_flushed_count():
+    db = FakeDatabase({'u1': 0})
+    fetch_started, finish_fetch = threading.Event(), threading.Event()
+
+    def slow_fetch(user_id):
+        count = db.counts[user_id]
+        fetch_started.set()
+        finish_fetch.wait(5)
+        return count
+
+    usage = UsageAccounting(db.increment, slow_fetch, cache_ttl=0)
+    results = []
+    reader = threading.Thread(target=lambda: results.append(usage.usage('u1')))
+    reader.start()
+    fetch_started.wait(5)
+    usage.add('u1', 2)
+    usage.flush()
+    finish_fetch.set()
+    reader.join()
+    assert results == [2]
+    assert usage._cache['u1'][0] == 2
@@ -0,0 +1,297 @@
+"""
+Usage accounting for Staky AI
+
+Every saved transcription counts towards the user's usage_count, which the
+free trial limit is checked against. Counting works in three parts:
+
+1. Atomic increments: counts are only ever added to on the database
+   server (usage_count = usage_count + n), never written back as an
+   absolute value read earlier, so concurrent uploads from several tabs,
+   workers or processes cannot lose increments.
+2. Write-behind buffer: increments are added to an in-process buffer and
+   a background thread flushes the buffer every flush_interval seconds,
+   all users together in one request. Saving a transcription costs no
+   extra round-trip, and a failed flush is retried with the next one.
+3. Quota cache: the limit check reads the count last seen from the
+   database, cached for cache_ttl seconds, plus the increments still in
+   the buffer. It never trusts the cookie session, which a second tab or
+   an old cookie would have stale.
+4. Reservations: the limit check reserves the upload's increment before
+   processing starts, so concurrent uploads of one user cannot all pass
+   the check. A reservation counts as usage until it is committed (turned
+   into a buffered increment when the result is saved) or released (the
+   upload failed). Reservations older than reservation_ttl are dropped in
+   case an upload path never settles its reservation.
+
+The buffer lives in memory, so increments made in the last flush_interval
+seconds are lost if the process is killed; they are flushed on a normal
+exit.
+"""
+
+import atexit
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+usage_pending = REGISTRY.gauge('staky_usage_pending', 'Usage increments buffered and not yet flushed')
+usage_flushes = REGISTRY.counter('staky_usage_flushes_total', 'Usage buffer flushes by result', ['result'])
+usage_cache_lookups = REGISTRY.counter('staky_usage_cache_lookups_total',
+                                       'Usage count lookups by the quota check, by result', ['result'])
+usage_reservations = REGISTRY.counter('staky_usage_reservations_total',
+                                      'Usage reservations by result', ['result'])
+
+
+class Reservation:
+    """
+    Usage increments reserved for one upload, handed out by UsageAccounting.reserve()
+
+    commit() counts the saved transcriptions and ends the reservation,
+    release() gives it up; once settled both have no effect
+    """
+
+    def __init__(self, accounting, user_id, amount):
+        self.accounting = accounting
+        self.user_id = user_id
+        self.amount = amount
+        self.created_at = time.monotonic()
+        self.settled = False
+
+    def extend(self, amount, limit):
+        """
+        Reserve amount more increments if that stays within limit
+        Returns False (and reserves nothing) otherwise
+        """
+        return self.accounting._extend(self, amount, limit)
+
+    def commit(self, amount=None):
+        """
+        Turn the reservation into amount buffered increments (default: the reserved amount)
+        Returns the user's count including them if it is known, else None
+        """
+        return self.accounting.add(self.user_id, self.amount if amount is None else amount, reservation=self)
+
+    def release(self):
+        self.accounting._settle(self)
+
+
+class UsageAccounting:
+    """
+    Write-behind usage counters with a short-TTL cache of the stored counts
+
+    increment(deltas) - adds {user_id: amount} to the stored counts atomically
+                        and returns the new counts as {user_id: usage_count}
+    fetch(user_id)    - returns the stored count of one user
+    """
+
+    def __init__(self, increment, fetch, flush_interval=2.0, cache_ttl=10.0, reservation_ttl=3600.0,
+                 name='staky-usage'):
+        self.increment = increment
+        self.fetch = fetch
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.reservation_ttl = reservation_ttl
+        self.name = name
+        self._pending = {}
+        self._cache = {}
+        self._reserved = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Start the flush thread if it is not running yet
+        Cheap to call on every request
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Stop the flush thread and flush what is left in the buffer
+        """
+        self._stop.set()
+        self.flush()
+
+    def add(self, user_id, amount=1, reservation=None):
+        """
+        Buffer an increment of a user's usage count
+        A reservation of the user is settled in the same step, so the count never drops in between
+        Returns the user's count including the increment if it is known, else None
+        """
+        with self._lock:
+            if reservation is not None:
+                self._unreserve(reservation)
+                usage_reservations.inc(result='committed')
+            self._pending[user_id] = self._pending.get(user_id, 0) + amount
+            usage_pending.set(sum(self._pending.values()))
+            cached = self._cache.get(user_id)
+            return cached[0] + self._pending[user_id] + self._reserved_amount(user_id) if cached else None
+
+    def reserve(self, user_id, limit, amount=1):
+        """
+        Reserve amount increments for an upload if the user's usage stays within limit
+        Returns a Reservation, or None when the limit is reached
+        Raises the fetch error when the user's count is not known
+        """
+        self.usage(user_id)
+        with self._lock:
+            cached = self._cache.get(user_id)
+            usage_count = (cached[0] if cached else 0) + self._pending.get(user_id, 0)
+            if usage_count + self._reserved_amount(user_id) + amount > limit:
+                usage_reservations.inc(result='refused')
+                return None
+            reservation = Reservation(self, user_id, amount)
+            self._reserved.setdefault(user_id, []).append(reservation)
+            return reservation
+
+    def prime(self, user_id, usage_count):
+        """
+        Cache a count just read from the database (e.g. at login)
+        """
+        with self._lock:
+            self._store(user_id, usage_count, time.monotonic())
+
+    def usage(self, user_id):
+        """
+        Current usage count of a user: the cached stored count plus buffered increments
+        The stored count is fetched again once it is older than cache_ttl; if that
+        fails the expired count is used, and without one the error is raised
+        Reserved increments are included
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached and now - cached[1] < self.cache_ttl:
+                usage_cache_lookups.inc(result='hit')
+                return cached[0] + self._pending.get(user_id, 0) + self._reserved_amount(user_id)
+        usage_cache_lookups.inc(result='miss')
+        try:
+            usage_count = self.fetch(user_id)
+        except Exception as e:
+            if not cached:
+                raise
+            print(f"Warning: Could not refresh usage count, using the cached count: {e}")
+            usage_count = cached[0]
+        else:
+            with self._lock:
+                # A flush or login may have stored a fresher count while this one was
+                # being fetched; only an entry that did not change is replaced
+                current = self._cache.get(user_id)
+                if current is None or current == cached:
+                    self._store(user_id, usage_count, now)
+                else:
+                    usage_count = current[0]
+        with self._lock:
+            return usage_count + self._pending.get(user_id, 0) + self._reserved_amount(user_id)
+
+    def flush(self):
+        """
+        Write the buffered increments to the database in one request
+        On failure they are put back in the buffer for the next flush
+        """
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._pending = self._pending, {}
+            if not deltas:
+                return
+            try:
+                counts = self.increment(deltas)
+            except Exception as e:
+                usage_flushes.inc(result='error')
+                print(f"Warning: Could not flush usage counts, will retry: {e}")
+                with self._lock:
+                    for user_id, amount in deltas.items():
+                        self._pending[user_id] = self._pending.get(user_id, 0) + amount
+                    usage_pending.set(sum(self._pending.values()))
+                return
+            usage_flushes.inc(result='ok')
+            now = time.monotonic()
+            with self._lock:
+                # The returned counts include the flushed increments; newer ones stay in the buffer
+                for user_id, usage_count in counts.items():
+                    self._store(user_id, usage_count, now)
+                usage_pending.set(sum(self._pending.values()))
+
+    def stats(self):
+        with self._lock:
+            return {"pending_users": len(self._pending), "pending": sum(self._pending.values()),
+                    "cached_users": len(self._cache),
+                    "reserved": sum(self._reserved_amount(user_id) for user_id in list(self._reserved))}
+
+    def _extend(self, reservation, amount, limit):
+        with self._lock:
+            if reservation.settled:
+                return False
+            user_id = reservation.user_id
+            cached = self._cache.get(user_id)
+            usage_count = (cached[0] if cached else 0) + self._pending.get(user_id, 0)
+            if usage_count + self._reserved_amount(user_id) + amount > limit:
+                usage_reservations.inc(result='refused')
+                return False
+            reservation.amount += amount
+            return True
+
+    def _settle(self, reservation):
+        with self._lock:
+            if not reservation.settled:
+                self._unreserve(reservation)
+                usage_reservations.inc(result='released')
+
+    def _unreserve(self, reservation):
+        # Called with the lock held
+        reservation.settled = True
+        reservations = self._reserved.get(reservation.user_id, [])
+        if reservation in reservations:
+            reservations.remove(reservation)
+        if not reservations:
+            self._reserved.pop(reservation.user_id, None)
+
+    def _reserved_amount(self, user_id):
+        # Called with the lock held; drops reservations that were never settled
+        reservations = self._reserved.get(user_id)
+        if not reservations:
+            return 0
+        cutoff = time.monotonic() - self.reservation_ttl
+        for reservation in [reservation for reservation in reservations if reservation.created_at < cutoff]:
+            self._unreserve(reservation)
+            usage_reservations.inc(result='expired')
+        return sum(reservation.amount for reservation in reservations)
+
+    def _store(self, user_id, usage_count, now):
+        # Called with the lock held
+        if user_id not in self._cache and len(self._cache) >= 10000:
+            self._prune(now)
+        self._cache[user_id] = (usage_count, now)
+
+    def _prune(self, now):
+        # Drop expired counts, they would be fetched again anyway
+        for user_id in [user_id for user_id, (_, fetched_at) in self._cache.items()
+                        if now - fetched_at >= self.cache_ttl]:
+            del self._cache[user_id]
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+def create_usage_accounting(increment, fetch):
+    """
+    Build the usage accounting configured through environment variables
+
+    USAGE_FLUSH_INTERVAL - seconds between flushes of buffered increments (default: 2)
+    USAGE_CACHE_TTL      - seconds a stored usage count is trusted by the quota check (default: 10)
+    USAGE_RESERVATION_TTL - seconds before an unsettled usage reservation is dropped (default: 3600)
+    """
+    return UsageAccounting(increment, fetch,
+                           flush_interval=float(os.getenv('USAGE_FLUSH_INTERVAL', '2')),
+                           cache_ttl=float(os.getenv('USAGE_CACHE_TTL', '10')),
+                           reservation_ttl=float(os.getenv('USAGE_RESERVATION_TTL', '3600')))